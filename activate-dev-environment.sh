@@ -38,6 +38,9 @@ export ANTMAPS_DB_PORT="5432"
 export ANTMAPS_DB_USER="antmaps"
 export ANTMAPS_DB_PASSWORD="password"
 
+# Read replicas for the API's queries (optional, see queries/routers.py)
+#export ANTMAPS_DB_REPLICAS="127.0.0.1:5433,127.0.0.1:5434"
+
 
 
 # Credentials for the email account that AntMaps uses to send email, for error reports.
@@ -0,0 +1,205 @@
+"""
+ASGI config for antmaps_dataserver project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+for an ASGI server, eg.
+
+    uvicorn antmaps_dataserver.asgi:application --workers 2
+
+This needs Python 3.6 (for async/await, and Django 1.10 doesn't run on newer
+versions) and uvicorn 0.16 (the last release for Python 3.6,) see 
+python-package-requirements.txt.  The WSGI entry point still runs on Python
+3.4.
+
+Django 1.10's views and database layer are synchronous, so each request is
+handled by the same Django handler as in wsgi.py, on a thread from a bounded
+pool, while the event loop goes on accepting and reading other requests.
+Views that can run long queries (settings.ANTMAPS_ASGI_SLOW_VIEWS) get their
+own pool of ANTMAPS_ASGI_SLOW_THREADS threads, so they can't tie up the
+threads for cheap requests (like the list endpoints,) which never queue
+behind them.  Each thread has its own database connection, so a process has
+at most ANTMAPS_ASGI_THREADS + ANTMAPS_ASGI_SLOW_THREADS connections.
+
+A request stays on one thread from start to finish, including streaming its
+response, because Django's database connections and transactions (eg. the
+server-side cursors in queries.views.server_side_rows) belong to a thread.
+If the client disconnects, the rest of the response isn't made.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+if sys.version_info < (3, 6):
+    raise ImportError('antmaps_dataserver.asgi needs Python 3.6, see README.md')
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "antmaps_dataserver.settings")
+
+from django.conf import settings
+from django.core.urlresolvers import get_resolver, Resolver404
+from django.core.wsgi import get_wsgi_application
+
+
+_application = get_wsgi_application()
+
+_executor = ThreadPoolExecutor(settings.ANTMAPS_ASGI_THREADS)
+_slow_executor = ThreadPoolExecutor(settings.ANTMAPS_ASGI_SLOW_THREADS)
+
+
+
+
+def executor_for(path_info):
+    """
+    Return the thread pool to handle a request for 'path_info' on.
+    """
+
+    try:
+        view = get_resolver().resolve(path_info).func
+    except Resolver404:
+        return _executor
+
+    name = '%s.%s' % (view.__module__, view.__name__)
+    return _slow_executor if name in settings.ANTMAPS_ASGI_SLOW_VIEWS else _executor
+
+
+
+
+def wsgi_environ(scope, body):
+    """
+    Return the WSGI environ for an ASGI HTTP request 'scope' with 'body'.
+    """
+
+    script_name = scope.get('root_path', '')
+    path_info = scope['path']
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # (WSGI strings are bytes decoded as latin-1)
+        'SCRIPT_NAME': script_name.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path_info.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': str(client[0]),
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+
+    return environ
+
+
+
+
+def handle(environ, send, loop, disconnected):
+    """
+    Run the Django handler for 'environ' and send its response with the ASGI
+    'send' function on the event loop 'loop'.  This runs on a pool thread,
+    and waits for each message to be sent (so a slow client holds up the
+    thread instead of the response piling up in memory.)  Stop when the
+    threading.Event 'disconnected' is set (sending to a client that's gone
+    doesn't fail, so the rest of the response would be made for nothing.)
+    """
+
+    def send_message(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    start = {}
+    def start_response(status, headers, exc_info=None):
+        start['status'] = int(status.split(' ', 1)[0])
+        start['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    result = _application(environ, start_response)
+    try:
+        send_message(dict(start, type='http.response.start'))
+        for chunk in result:
+            if disconnected.is_set():
+                return
+            if chunk:
+                send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        send_message({'type': 'http.response.body', 'body': b''})
+
+    finally:
+        # (sends Django's request_finished signal, which closes the database
+        # connection if it's too old, on this thread)
+        if hasattr(result, 'close'):
+            result.close()
+
+
+
+
+async def watch_disconnect(receive, disconnected):
+    """
+    Wait for the client to disconnect (after the request body has been read,)
+    and set the threading.Event 'disconnected'.
+    """
+
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+
+
+async def application(scope, receive, send):
+    """
+    The ASGI application: read the request, then handle it on a pool thread.
+    """
+
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                _executor.shutdown()
+                _slow_executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    elif scope['type'] != 'http':
+        raise ValueError("Can't handle ASGI '%s' connections." % scope['type'])
+
+
+    # read the whole request body (it's small, if there is one)
+    body = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+
+    environ = wsgi_environ(scope, b''.join(body))
+    executor = executor_for(environ['PATH_INFO'].encode('latin-1').decode('utf-8', 'replace'))
+    loop = asyncio.get_event_loop()
+    disconnected = threading.Event()
+    watcher = loop.create_task(watch_disconnect(receive, disconnected))
+    try:
+        await loop.run_in_executor(executor, handle, environ, send, loop, disconnected)
+    finally:
+        watcher.cancel()
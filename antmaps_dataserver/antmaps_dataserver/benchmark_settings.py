@@ -0,0 +1,15 @@
+"""
+Settings for benchmarking AntMaps against a local SQLite database of synthetic
+data, instead of the GABI database (see the make_synthetic_data and benchmark
+management commands.)  Set ANTMAPS_BENCHMARK_DB to use a different database file.
+"""
+
+from antmaps_dataserver.settings import *
+
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('ANTMAPS_BENCHMARK_DB') or os.path.join(BASE_DIR, 'benchmark.sqlite3'),
+    }
+}
@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+from urllib.request import pathname2url
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 
@@ -53,7 +54,8 @@ INSTALLED_APPS = (
 
 
 MIDDLEWARE_CLASSES = (
-    'django.middleware.cache.UpdateCacheMiddleware', # must be first
+    'queries.middleware.MetricsMiddleware', # SQL/serialization timing for every request (see queries/metrics.py)
+    'queries.middleware.UpdateCacheMiddleware', # must be first after metrics (caches pages by data version)
     #'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     #'django.middleware.csrf.CsrfViewMiddleware', # security-related
@@ -61,7 +63,8 @@ MIDDLEWARE_CLASSES = (
     #'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     #'django.contrib.messages.middleware.MessageMiddleware',
     #'django.middleware.clickjacking.XFrameOptionsMiddleware', # security-related
-    'django.middleware.cache.FetchFromCacheMiddleware', # must be last
+    'django.middleware.http.ConditionalGetMiddleware', # 304 Not Modified for cached pages, too
+    'queries.middleware.FetchFromCacheMiddleware', # must be last
 )
 
 
@@ -105,10 +108,48 @@ DATABASES = {
         'client_encoding': 'UTF8',
         'default_transaction_isolation': 'read committed',
         
+        # keep connections open between requests (one per thread)
+        'CONN_MAX_AGE': int(os.environ.get('ANTMAPS_DB_CONN_MAX_AGE') or 600),
+        
+        # so an unreachable replica fails over quickly
+        'OPTIONS': {'connect_timeout': int(os.environ.get('ANTMAPS_DB_CONNECT_TIMEOUT') or 3)},
+        
     }
 }
 
 
+# Read replicas for the queries app, as a comma-separated list of host:port in 
+# ANTMAPS_DB_REPLICAS (eg. "10.0.0.2:5432,10.0.0.3:5432".)  They use the same
+# database name and credentials as the primary.  See queries/routers.py.
+for _i, _replica in enumerate(filter(None, (os.environ.get('ANTMAPS_DB_REPLICAS') or '').split(',')), 1):
+    _host, _, _port = _replica.strip().partition(':')
+    DATABASES['replica%d' % _i] = dict(DATABASES['default'], HOST=_host, PORT=_port or DATABASES['default']['PORT'],
+        TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['queries.routers.ReplicaRouter']
+
+# Snapshot mode: serve the API from a snapshot file made by "manage.py 
+# export_snapshot" instead of Postgres (see queries/snapshot.py.)  The 
+# snapshot is read-only, and read through a memory map of up to 
+# ANTMAPS_SNAPSHOT_MMAP_BYTES.
+ANTMAPS_SNAPSHOT = os.environ.get('ANTMAPS_SNAPSHOT')
+ANTMAPS_SNAPSHOT_MMAP_BYTES = int(os.environ.get('ANTMAPS_SNAPSHOT_MMAP_BYTES') or 2 ** 32)
+if ANTMAPS_SNAPSHOT:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': 'file:%s?mode=ro&immutable=1' % pathname2url(os.path.abspath(ANTMAPS_SNAPSHOT)),
+            'OPTIONS': {'uri': True},
+            'CONN_MAX_AGE': None,
+        }
+    }
+
+# How often to check that each thread's replica connection works (seconds,) and
+# how long to skip a replica that's down before trying it again
+ANTMAPS_DB_HEALTH_CHECK_SECONDS = int(os.environ.get('ANTMAPS_DB_HEALTH_CHECK_SECONDS') or 30)
+ANTMAPS_DB_RETRY_SECONDS = int(os.environ.get('ANTMAPS_DB_RETRY_SECONDS') or 30)
+
+
 
 
 
@@ -187,3 +228,63 @@ if os.environ.get('ANTMAPS_USE_MEMCACHED'):
         }
     }
     CACHE_MIDDLEWARE_SECONDS = 60 * 60 * 4 # cache for 4 hours
+
+
+
+
+
+# The data only changes when the GABI materialized views are refreshed, so
+# in-memory indexes are kept until the "data version" changes (see
+# queries/dataversion.py.)  This is how often (in seconds) to check the database
+# for a new data version.
+ANTMAPS_DATA_VERSION_CHECK_SECONDS = int(os.environ.get('ANTMAPS_DATA_VERSION_CHECK_SECONDS') or 60)
+
+# Set this to pin the data version instead of checking the database
+ANTMAPS_DATA_VERSION = os.environ.get('ANTMAPS_DATA_VERSION')
+
+# A directory to keep the in-memory indexes in as memory-mapped files, so
+# they're built once and shared by all of the worker processes instead of
+# built in each one (see queries/sharedarrays.py.)  Unset to build them in
+# each process.
+ANTMAPS_SHARED_INDEX_DIR = os.environ.get('ANTMAPS_SHARED_INDEX_DIR')
+
+# Directory for the bulk download files (see queries/bulkexport.py and the
+# export_bulk_data command.)  Unset to turn off bulk downloads.
+ANTMAPS_BULK_EXPORT_DIR = os.environ.get('ANTMAPS_BULK_EXPORT_DIR')
+
+# How many data versions to keep the species hashes for, which the
+# species-changes endpoint compares (see queries/deltas.py)
+ANTMAPS_DELTA_VERSIONS = int(os.environ.get('ANTMAPS_DELTA_VERSIONS') or 30)
+
+# How long to keep map tiles in the cache (they're keyed by data version, so
+# they never go stale, but they take up cache space)
+ANTMAPS_TILE_CACHE_SECONDS = int(os.environ.get('ANTMAPS_TILE_CACHE_SECONDS') or 60 * 60 * 24 * 7)
+
+# Longest streaming response (in bytes) to keep a copy of for the page cache
+# (see queries/middleware.py.)  Longer ones are only streamed.  memcached
+# doesn't store items over 1 MB unless it's started with a bigger -I.
+ANTMAPS_CACHE_STREAMING_MAX_BYTES = int(os.environ.get('ANTMAPS_CACHE_STREAMING_MAX_BYTES') or 1024 * 1024)
+
+# Client IP addresses allowed to read the /metrics endpoint (see 
+# queries/metrics.py,) eg. "127.0.0.1,10.0.0.5" for a Prometheus server.  
+# Everyone else gets a 404; unset to turn the endpoint off.  (Behind a proxy,
+# this is the proxy's address.)
+ANTMAPS_METRICS_ALLOWED_IPS = [ip.strip() for ip in (os.environ.get('ANTMAPS_METRICS_ALLOWED_IPS') or '').split(',') if ip.strip()]
+
+# Most records to return in one page of citations (see queries.views.citations)
+ANTMAPS_MAX_PAGE_SIZE = int(os.environ.get('ANTMAPS_MAX_PAGE_SIZE') or 5000)
+
+# Serving with ASGI (see antmaps_dataserver/asgi.py): the number of threads
+# (and database connections) per process for most requests, and for the views
+# that can run long queries, which get their own threads.
+ANTMAPS_ASGI_THREADS = int(os.environ.get('ANTMAPS_ASGI_THREADS') or 8)
+ANTMAPS_ASGI_SLOW_THREADS = int(os.environ.get('ANTMAPS_ASGI_SLOW_THREADS') or 4)
+ANTMAPS_ASGI_SLOW_VIEWS = (
+    'queries.views.citations',
+    'queries.views.species_points',
+    'queries.views.species_batch',
+    'queries.views.species_in_common',
+    'queries.views.species_per_bentity',
+    'queries.views.tile',
+    'queries.bulkexport.bulk_download',
+)
@@ -7,12 +7,21 @@ from django.conf.urls import include, url
 
 
 import queries.views
+import queries.metrics
+import queries.bulkexport
+import queries.deltas
 import error_report.views
 
 
 # regular expression to capture the file extension as CSV or JSON
 f = r'\.?(?P<format>csv|json)?' 
 
+# same, but also allow the compact binary format (see queries/pointformat.py)
+fb = r'\.?(?P<format>csv|json|bin)?'
+
+# JSON only
+fj = r'\.?(?P<format>json)?'
+
 
 urlpatterns = [
     # Examples:
@@ -43,7 +52,13 @@ urlpatterns = [
     url(r'^bentity-search'+f, queries.views.bentity_autocomplete),
     
     # get points for a species to plot on map
-    url(r'^species-points'+f, queries.views.species_points), 
+    url(r'^species-points'+fb, queries.views.species_points), 
+    
+    # species range and/or points for several species at once
+    url(r'^species-batch'+f, queries.views.species_batch),
+
+    # which species changed since a data version (and their range and points)
+    url(r'^species-changes'+fj, queries.deltas.species_changes),
 
     # citations, for each species-location-paper occurrence
     url(r'^citations'+f, queries.views.citations),
@@ -56,6 +71,13 @@ urlpatterns = [
     url(r'^species'+f, queries.views.species_list), # must be after the other URLs starting with 'species'
     url(r'^bentities'+f, queries.views.bentity_list),
     
+    # map tiles with points and bentity attributes
+    url(r'^tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)'+fj, queries.views.tile),
+    
+    # bulk downloads of all of the ranges, points and bentity counts
+    url(r'^bulk/?$', queries.bulkexport.bulk_list),
+    url(r'^bulk/(?P<filename>[\w.-]+)$', queries.bulkexport.bulk_download),
+    
     
     
     
@@ -68,5 +90,8 @@ urlpatterns = [
     # report data error
     url(r'^error-report', error_report.views.report),
     
+    # request metrics, in Prometheus text format
+    url(r'^metrics$', queries.metrics.metrics),
+    
  
 ]
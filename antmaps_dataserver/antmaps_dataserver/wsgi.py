@@ -7,7 +7,9 @@ For more information on this file, see
 https://docs.djangoproject.com/en/1.7/howto/deployment/wsgi/
 """
 
+import logging
 import os
+import threading
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "antmaps_dataserver.settings")
 
 from django.core.wsgi import get_wsgi_application
@@ -21,4 +23,41 @@ def application(environ, start_response):
     
     
     _application = get_wsgi_application()
+    _load_indexes()
     return _application(environ, start_response)
+
+
+
+_indexes_lock = threading.Lock()
+_indexes_loader = None
+
+def _load_indexes():
+    """
+    Start loading the in-memory indexes in a background thread, on the first
+    request to this worker process.  (Not when this module is imported, since
+    the ANTMAPS_ settings only come with the first request's environ.)  With
+    ANTMAPS_SHARED_INDEX_DIR set, the workers attach to one shared copy (see
+    queries/sharedarrays.py,) which only the first of them builds.
+    
+    Requests don't wait for it: a view that needs an index before it's loaded
+    waits for that index only (see queries.indexes.VersionedIndex.)  This is
+    only tried once.  If it fails (eg. the database is down,) the error is 
+    logged; the views build the indexes when they first need them.
+    """
+    
+    global _indexes_loader
+    with _indexes_lock:
+        if _indexes_loader is None:
+            _indexes_loader = threading.Thread(target=_run_load_indexes, name='load_indexes', daemon=True)
+            _indexes_loader.start()
+
+
+def _run_load_indexes():
+    try:
+        from queries.indexes import load_indexes
+        load_indexes()
+    except Exception:
+        logging.getLogger(__name__).exception('Loading the in-memory indexes failed')
+    finally:
+        from django.db import connections
+        connections.close_all()
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+
+
+
+
+class QueriesConfig(AppConfig):
+    name = 'queries'
+
+    def ready(self):
+        from queries.snapshot import configure_connection
+        connection_created.connect(configure_connection)
@@ -0,0 +1,423 @@
+"""
+Bulk downloads of the whole AntMaps dataset, so nobody has to request
+species-range and species-points one species at a time to get all of it.
+
+export_bulk_data() writes gzipped CSV and NDJSON (one JSON object per line)
+files of every species range, every species point, and the species and record
+counts for each bentity, to settings.ANTMAPS_BULK_EXPORT_DIR, with a
+manifest.json listing them and the data version they're from.  It's run in
+the background after each data refresh by the export_bulk_data command (eg.
+with --watch, which exports whenever the data version changes.)
+
+The export is incremental: each file is a series of gzip members (which
+gzip and every gzip library read as one stream,) one per genus.  A genus
+whose rows are the same as in the last export is copied from the last
+export's file instead of being compressed again, so after a refresh only the
+genera that changed are compressed.
+
+The bulk_download view serves the files, with Range requests for resuming
+interrupted downloads.
+
+The export also records a hash of each species' ranges and points, for
+finding the species that changed between data versions (see
+queries/deltas.py.)
+"""
+
+import csv
+import hashlib
+import json
+import os
+import re
+import zlib
+from io import StringIO
+from itertools import groupby
+from operator import itemgetter
+from time import gmtime, strftime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # (no locking, so don't run two exports at once)
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date
+from django.views.decorators.cache import never_cache
+
+from queries.models import Species, SpeciesBentityPair, SpeciesPoints
+from queries.serializers import ObjectEncoder
+from queries.dataversion import get_data_version, invalidate_data_version
+from queries.deltas import HASHED_EXPORTS, species_hash, record_species_hashes
+from queries.views import JSONResponse, errorResponse, server_side_rows, with_bentity_names, bentity_counts
+
+
+MANIFEST = 'manifest.json'
+
+FORMATS = ('csv', 'ndjson')
+
+# gzip compression level for the files
+COMPRESS_LEVEL = 9
+
+# bytes to read from a file (and write to the client) at a time
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+
+
+def _species_ranges(using):
+    pairs = ( SpeciesBentityPair.objects.using(using)
+              .exclude(valid_species_name=None)
+              .order_by('valid_species_name', 'bentity', 'category')
+              .values_list('valid_species_name', 'bentity', 'category',
+                           'num_records', 'literature_count', 'museum_count', 'database_count') )
+    return with_bentity_names(server_side_rows(pairs), 1)
+
+
+def _species_points(using):
+    points = ( SpeciesPoints.objects.using(using)
+               .exclude(valid_species_name=None)
+               .filter(lon__isnull=False)
+               .filter(lat__isnull=False)
+               .order_by('valid_species_name', 'gabi_acc_number')
+               .values_list('gabi_acc_number', 'valid_species_name', 'lat', 'lon', 'bentity', 'status',
+                            'num_records', 'literature_count', 'museum_count', 'database_count') )
+    return with_bentity_names(server_side_rows(points), 4)
+
+
+def _bentity_counts(using):
+    return with_bentity_names(sorted(bentity_counts(using=using)), 0)
+
+
+# (name, fields, function returning the rows for a database alias, column
+# with the species name, which the files are split up by genus on)
+EXPORTS = (
+    ('species-ranges', ('species', 'bentity_id', 'bentity_name', 'status',
+        'num_records', 'literature_count', 'museum_count', 'database_count'), _species_ranges, 0),
+    ('species-points', ('gabi_acc_number', 'species', 'lat', 'lon', 'bentity_id', 'bentity_name', 'status',
+        'num_records', 'literature_count', 'museum_count', 'database_count'), _species_points, 1),
+    ('bentity-counts', ('bentity_id', 'bentity_name', 'species_count',
+        'num_records', 'literature_count', 'museum_count', 'database_count'), _bentity_counts, None),
+)
+
+
+
+
+def read_manifest(directory=None):
+    """
+    Return the manifest of the bulk export in 'directory' (by default
+    settings.ANTMAPS_BULK_EXPORT_DIR), or None if there isn't one.
+    """
+
+    directory = directory or settings.ANTMAPS_BULK_EXPORT_DIR
+    if not directory:
+        return None
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+
+
+def _gzip_member(data):
+    # (wbits 31 writes a gzip header with no timestamp, so the same data
+    # always compresses to the same bytes)
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+
+
+class _ArchiveWriter(object):
+    """
+    Writes a gzip file one member at a time, copying members that are the
+    same as in the previous version of the file (described by its manifest
+    entry 'previous') from it.  The new file replaces the old one on
+    replace().
+    """
+
+    def __init__(self, path, previous):
+        self.path = path
+        self.temp_path = '%s.%d.tmp' % (path, os.getpid())
+        self.file = open(self.temp_path, 'wb')
+        self.members = []
+        self.reused = 0
+
+        # (only if the file is the one the manifest describes)
+        self.old_file = None
+        self.old_members = {}
+        if previous and os.path.exists(path) and os.path.getsize(path) == previous['size']:
+            self.old_file = open(path, 'rb')
+            self.old_members = dict((digest, (offset, length)) for digest, offset, length in previous['members'])
+
+
+    def write(self, data):
+        digest = hashlib.sha1(data).hexdigest()
+        if digest in self.old_members:
+            offset, length = self.old_members[digest]
+            self.old_file.seek(offset)
+            member = self.old_file.read(length)
+            self.reused += 1
+        else:
+            member = _gzip_member(data)
+
+        self.members.append((digest, self.file.tell(), len(member)))
+        self.file.write(member)
+
+
+    def close(self):
+        """
+        Finish writing, and return the file's manifest entry.
+        """
+
+        if not self.members:
+            self.file.write(_gzip_member(b''))  # (an empty file isn't a gzip file)
+        self.file.close()
+        if self.old_file is not None:
+            self.old_file.close()
+        return {'size': os.path.getsize(self.temp_path), 'members': self.members}
+
+
+    def replace(self):
+        os.replace(self.temp_path, self.path)
+
+
+    def discard(self):
+        self.file.close()
+        if self.old_file is not None:
+            self.old_file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+
+
+def _encode_chunk(rows, fields, format, header=False):
+    if format == 'csv':
+        csvfile = StringIO()
+        writer = csv.writer(csvfile)
+        if header:
+            writer.writerow(fields)
+        writer.writerows(rows)
+        return csvfile.getvalue().encode('utf-8')
+
+    else:
+        encoder = ObjectEncoder(fields)
+        return ''.join(encoder(row) + '\n' for row in rows).encode('utf-8')
+
+
+
+
+def _genus(species_name):
+    return (species_name or '').split('.')[0]
+
+
+
+
+def export_bulk_data(directory=None, progress=None):
+    """
+    Write the bulk export files for the current data to 'directory' (by
+    default settings.ANTMAPS_BULK_EXPORT_DIR) and return the new manifest.
+    Every file is read from the database as of the same moment, and the
+    files and manifest replace the previous export's when they're all
+    written.  'progress' is called with (file name, manifest entry) after
+    each file.
+    """
+
+    directory = directory or settings.ANTMAPS_BULK_EXPORT_DIR
+    os.makedirs(directory, exist_ok=True)
+
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+        previous = (read_manifest(directory) or {}).get('files', {})
+        using = router.db_for_read(Species)
+        files = {}
+        writers = []
+        hashes = {}
+
+        try:
+            with transaction.atomic(using=using):
+                if connections[using].vendor == 'postgresql':
+                    # read every table as of the same moment
+                    with connections[using].cursor() as cursor:
+                        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+
+                invalidate_data_version()
+                version = get_data_version(using)
+
+                for name, fields, get_rows, species_column in EXPORTS:
+                    export_writers = {}
+                    for format in FORMATS:
+                        filename = '%s.%s.gz' % (name, format)
+                        export_writers[filename] = (format, _ArchiveWriter(os.path.join(directory, filename), previous.get(filename)))
+                        writers.append(export_writers[filename][1])
+
+                    # the CSV header is a member by itself
+                    for format, writer in export_writers.values():
+                        if format == 'csv':
+                            writer.write(_encode_chunk((), fields, format, header=True))
+
+                    rows = get_rows(using)
+                    count = 0
+                    chunks = groupby(rows, lambda row: _genus(row[species_column])) if species_column is not None else [('', rows)]
+                    for genus, chunk in chunks:
+                        chunk = list(chunk)
+                        count += len(chunk)
+
+                        if name in HASHED_EXPORTS:
+                            position = HASHED_EXPORTS.index(name)
+                            for species, species_rows in groupby(chunk, itemgetter(species_column)):
+                                species_hashes = hashes.setdefault(species, [None] * len(HASHED_EXPORTS))
+                                species_hashes[position] = species_hash(_encode_chunk(list(species_rows), fields, 'csv'))
+
+                        for format, writer in export_writers.values():
+                            writer.write(_encode_chunk(chunk, fields, format))
+
+                    for filename, (format, writer) in sorted(export_writers.items()):
+                        files[filename] = dict(writer.close(), rows=count, reused_members=writer.reused)
+                        if progress is not None:
+                            progress(filename, files[filename])
+
+            for writer in writers:
+                writer.replace()
+
+        finally:
+            for writer in writers:
+                writer.discard()
+
+        manifest = {
+            'data_version': version,
+            'created': strftime('%Y-%m-%dT%H:%M:%SZ', gmtime()),
+            'files': files,
+        }
+
+        temp_path = os.path.join(directory, '%s.%d.tmp' % (MANIFEST, os.getpid()))
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, os.path.join(directory, MANIFEST))
+
+        record_species_hashes(version, hashes, directory)
+
+    return manifest
+
+
+
+
+@never_cache
+def bulk_list(request):
+    """
+    JSON list of the bulk download files, with the data version and time of
+    the export they're from.  (The list changes after an export, not when
+    the data version does, so it isn't cached.)
+    """
+
+    manifest = read_manifest()
+    if manifest is None:
+        return errorResponse("The bulk downloads haven't been exported yet.", 'json', {'files': []})
+
+    return JSONResponse({
+        'data_version': manifest['data_version'],
+        'created': manifest['created'],
+        'files': [{'name': name, 'size': entry['size'], 'rows': entry['rows']}
+            for name, entry in sorted(manifest['files'].items())],
+    })
+
+
+
+
+def byte_range(header, size):
+    """
+    Return (start, end) (inclusive) for the HTTP Range header 'header' on a
+    file of 'size' bytes, or None to send the whole file (no header, a
+    header we don't understand, or several ranges.)  Raise a ValueError if
+    the range is past the end of the file.
+    """
+
+    match = re.match(r'^bytes=\s*(\d*)-(\d*)\s*$', header or '')
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+
+    if not match.group(1):
+        # the last N bytes
+        length = int(match.group(2))
+        if length == 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if end < start and match.group(2):
+        return None
+    if start >= size:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+
+
+def _read_file(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(FILE_CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+
+
+def bulk_download(request, filename):
+    """
+    Send one of the bulk download files, or the bytes in a Range of it.
+    """
+
+    manifest = read_manifest()
+    if manifest is None or filename not in manifest['files']:
+        raise Http404('No bulk download file %s' % filename)
+
+    try:
+        f = open(os.path.join(settings.ANTMAPS_BULK_EXPORT_DIR, filename), 'rb')
+    except FileNotFoundError:
+        raise Http404('No bulk download file %s' % filename)
+
+    stat = os.fstat(f.fileno())
+    size = stat.st_size
+    etag = '"%x-%x"' % (int(stat.st_mtime), size)
+
+    # only send a range of the file if it's the same file the client has
+    # part of (If-Range)
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag and if_range != http_date(stat.st_mtime):
+        range_header = None
+
+    try:
+        requested = byte_range(range_header, size)
+    except ValueError:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    if requested is None:
+        response = StreamingHttpResponse(_read_file(f, 0, size), content_type='application/gzip')
+        response['Content-Length'] = size
+    else:
+        start, end = requested
+        response = StreamingHttpResponse(_read_file(f, start, end - start + 1), status=206, content_type='application/gzip')
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
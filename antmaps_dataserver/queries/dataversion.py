@@ -0,0 +1,187 @@
+"""
+Keeps track of which version of the AntMaps data is loaded in the database.
+
+The tables and materialized views that AntMaps reads from only change when the
+GABI data is reloaded and the views are refreshed.  get_data_version() returns
+a short token that changes whenever that happens, so that anything computed
+from the data (eg. the in-process indexes in queries/indexes.py) can be kept
+until the token changes, instead of being recomputed for every request.
+
+The refresh should end with mark_data_version(), which writes a new token to 
+the DATA_VERSION_TABLE on the primary (see the mark_data_version command.) 
+It's a regular table, so it's replicated with the data, and every server 
+reads the same token whether it reads from the primary or a replica.  Without
+it, the token is a hash of the tables' statistics, which replicas don't have.
+"""
+
+import hashlib
+import threading
+import uuid
+from time import time
+
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from queries.models import Species
+
+
+# Tables and materialized views read by the AntMaps views.  If any of these
+# change, the data version changes.
+DATA_VERSION_TABLES = (
+    'subfamily',
+    'genus',
+    'species',
+    'bentity2',
+    'map_taxonomy_list',
+    'map_record',
+    'map_species_points',
+    'map_species_bentity_pair',
+    'map_bentity_count',
+)
+
+# Table with the data version token, written by mark_data_version()
+DATA_VERSION_TABLE = 'antmaps_data_version'
+
+
+_lock = threading.Lock()
+_version = None
+_checked_at = 0
+
+
+
+
+def get_data_version(using=None):
+    """
+    Return the current data version token (a short hex string,) for the 
+    database the queries app reads from (see queries/routers.py) unless 
+    another database alias is given in 'using'.
+
+    To avoid a database round trip on every request, the token is only
+    re-checked every settings.ANTMAPS_DATA_VERSION_CHECK_SECONDS seconds.  If
+    settings.ANTMAPS_DATA_VERSION is set, that value is used instead, and the
+    database is never checked.
+    """
+
+    global _version, _checked_at
+
+    if settings.ANTMAPS_DATA_VERSION:
+        return settings.ANTMAPS_DATA_VERSION
+
+    now = time()
+    if _version is None or now - _checked_at >= settings.ANTMAPS_DATA_VERSION_CHECK_SECONDS:
+        with _lock:
+            if _version is None or now - _checked_at >= settings.ANTMAPS_DATA_VERSION_CHECK_SECONDS:
+                _version = _read_data_version(using)
+                _checked_at = now
+
+    return _version
+
+
+
+
+def data_version_etag(request, *args, **kwargs):
+    """
+    ETag for a response from one of the query views: a hash of the data 
+    version, the URL path and the query string arguments.  The same request 
+    gets the same response until the data changes, so clients (and
+    django.views.decorators.http.etag) can use this to answer If-None-Match 
+    with 304 Not Modified, without running any queries.
+    """
+    
+    arguments = sorted((key, request.GET.getlist(key)) for key in request.GET)
+    state = repr((get_data_version(), request.path, arguments))
+    return hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+
+
+
+def invalidate_data_version():
+    """
+    Forget the cached data version, so the next call to get_data_version()
+    checks the database again.  (Call this after refreshing the data.)
+    """
+
+    global _version
+    with _lock:
+        _version = None
+
+
+
+
+def mark_data_version(version=None, using='default'):
+    """
+    Record a new data version token (a random one, unless 'version' is 
+    given) in the DATA_VERSION_TABLE of database 'using' (the primary,) 
+    creating the table if it isn't there yet, and return it.  Run this at the
+    end of each data refresh; every server picks up the new token within 
+    settings.ANTMAPS_DATA_VERSION_CHECK_SECONDS.
+    """
+    
+    if version is None:
+        version = uuid.uuid4().hex[:12]
+    
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute('CREATE TABLE IF NOT EXISTS "%s" ("version" text NOT NULL)' % DATA_VERSION_TABLE)
+        cursor.execute('DELETE FROM "%s"' % DATA_VERSION_TABLE)
+        cursor.execute('INSERT INTO "%s" ("version") VALUES (%%s)' % DATA_VERSION_TABLE, [version])
+    
+    invalidate_data_version()
+    return version
+
+
+
+
+def _read_data_version(using):
+    """
+    Read the data version token from the database: the one recorded by 
+    mark_data_version(), if there is one.  Otherwise compute it from the
+    tables.
+
+    On Postgres, REFRESH MATERIALIZED VIEW gives the view a new relfilenode,
+    and REFRESH ... CONCURRENTLY (or reloading a regular table) bumps the
+    table's insert/update/delete statistics, so a hash of those for each table
+    changes whenever the data does.  (A read replica doesn't get the primary's
+    statistics, and its relfilenodes aren't the primary's, so with replicas 
+    the version doesn't change with the data, and differs between the 
+    servers: use mark_data_version.)  A snapshot file records its version.  On other databases (eg. SQLite for 
+    testing) fall back to a hash of the row counts.
+    """
+
+    if using is None:
+        using = router.db_for_read(Species)
+
+    connection = connections[using]
+
+    with connection.cursor() as cursor:
+        tables = connection.introspection.table_names(cursor)
+        
+        if DATA_VERSION_TABLE in tables:
+            cursor.execute('SELECT "version" FROM "%s"' % DATA_VERSION_TABLE)
+            row = cursor.fetchone()
+            if row is not None:
+                return row[0]
+        
+        if connection.vendor == 'postgresql':
+            cursor.execute("""
+                SELECT c."relname", c."relfilenode",
+                    s."n_tup_ins", s."n_tup_upd", s."n_tup_del"
+                FROM "pg_class" AS c
+                LEFT JOIN "pg_stat_all_tables" AS s ON s."relid" = c."oid"
+                WHERE c."relname" IN %s
+                ORDER BY c."relname";
+                """, [DATA_VERSION_TABLES])
+            state = cursor.fetchall()
+
+        elif 'snapshot_info' in tables:
+            # a snapshot has the version of the database it was made from (see
+            # queries/snapshot.py)
+            cursor.execute('SELECT "value" FROM "snapshot_info" WHERE "key" = %s', ['data_version'])
+            return cursor.fetchone()[0]
+
+        else:
+            state = []
+            for table in DATA_VERSION_TABLES:
+                cursor.execute('SELECT count(*) FROM "%s"' % table)
+                state.append((table, cursor.fetchone()[0]))
+
+    return hashlib.sha1(repr(state).encode('utf-8')).hexdigest()[:12]
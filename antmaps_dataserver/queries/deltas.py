@@ -0,0 +1,164 @@
+"""
+What changed for each species between two data versions, so clients that keep
+species_range and species_points results can fetch only the species that
+changed after a data refresh.
+
+When the bulk export runs after a refresh (see queries/bulkexport.py,) it
+records a content hash of each species' range rows and point rows for the
+data version, in the species-hashes directory of
+settings.ANTMAPS_BULK_EXPORT_DIR.  The hashes for the last
+settings.ANTMAPS_DELTA_VERSIONS data versions are kept.  The species_changes
+view compares the hashes for two versions.
+"""
+
+import hashlib
+import json
+import os
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.cache import add_never_cache_headers
+
+from queries.dataversion import get_data_version
+from queries.views import (JSONResponse, StreamingGroupedJSONResponse, errorResponse,
+    batch_querysets, batch_json_sections, MAX_BATCH_SPECIES)
+
+
+# the bulk exports that species are hashed from, in the order of the hashes
+# for each species
+HASHED_EXPORTS = ('species-ranges', 'species-points')
+
+HASHES_DIRECTORY = 'species-hashes'
+
+
+
+
+def species_hash(data):
+    """
+    Return the content hash of the (encoded) rows 'data' for one species.
+    """
+
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+
+
+def species_hashes_path(version, directory=None):
+    directory = directory or settings.ANTMAPS_BULK_EXPORT_DIR
+    # (a pinned data version could be any string)
+    return os.path.join(directory, HASHES_DIRECTORY, '%s.json' % re.sub(r'[^\w.]', '_', str(version)))
+
+
+
+
+def record_species_hashes(version, hashes, directory=None):
+    """
+    Save 'hashes' (a dict of taxon code -> list of hashes, one for each of
+    HASHED_EXPORTS, or None if the species has no rows in it) for data
+    version 'version', and delete the hashes for all but the newest
+    settings.ANTMAPS_DELTA_VERSIONS versions.
+    """
+
+    path = species_hashes_path(version, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump({'data_version': version, 'exports': HASHED_EXPORTS, 'species': hashes}, f)
+    os.replace(temp_path, path)
+
+    directory = os.path.dirname(path)
+    paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.json')]
+    for old_path in sorted(paths, key=os.path.getmtime, reverse=True)[settings.ANTMAPS_DELTA_VERSIONS:]:
+        try:
+            os.remove(old_path)
+        except FileNotFoundError:
+            pass
+
+
+
+
+@lru_cache(maxsize=8)
+def _read_species_hashes(path, mtime):
+    with open(path) as f:
+        return json.load(f)['species']
+
+
+def read_species_hashes(version):
+    """
+    Return the dict of taxon code -> hashes recorded for data version
+    'version', or None if there aren't any.
+    """
+
+    if not settings.ANTMAPS_BULK_EXPORT_DIR:
+        return None
+
+    path = species_hashes_path(version)
+    try:
+        return _read_species_hashes(path, os.path.getmtime(path))
+    except FileNotFoundError:
+        return None
+
+
+
+
+def species_changes(request, format='json'):
+    """
+    Return the species whose range or points changed between the data
+    version in "since" (the data_version of an earlier response) and the
+    current data version (or the version in "to".)
+
+    JSON: {"since": ..., "data_version": ..., "changed": [taxon_code, ...],
+    "removed": [taxon_code, ...]}, where "changed" includes new species.
+
+    With "include" ('range', 'points', or 'range,points',) the response also
+    has the species_batch "bentities" and/or "records" for every changed
+    species, if there are at most MAX_BATCH_SPECIES of them (for bigger
+    changes, use species_batch or the bulk downloads.)
+
+    If the hashes for "since" aren't kept anymore (or never were,)
+    "full_refresh" is true in the error response, and the client should
+    fetch everything again, and ask for the changes since the data_version
+    in the error response next time.
+    """
+
+    since = request.GET.get('since')
+    current_version = get_data_version()
+    to = request.GET.get('to') or current_version
+    empty = {'data_version': to, 'changed': [], 'removed': []}
+    include = [i for i in (request.GET.get('include') or '').split(',') if i]
+
+    if not since:
+        return errorResponse("Please supply a 'since' data version.", format, empty)
+
+    if not set(include) <= set(['range', 'points']):
+        return errorResponse("The 'include' argument must be 'range', 'points', or 'range,points'.", format, empty)
+
+    new_hashes = read_species_hashes(to)
+    if new_hashes is None:
+        response = errorResponse("The changes for data version '%s' aren't available (yet.)" % to, format, empty)
+        add_never_cache_headers(response)  # (they will be after the next export)
+        return response
+
+    old_hashes = read_species_hashes(since)
+    if old_hashes is None:
+        return errorResponse("The changes since data version '%s' aren't available, please fetch everything again." % since,
+            format, dict(empty, full_refresh=True))
+
+    changed = sorted(code for code, hashes in new_hashes.items() if old_hashes.get(code) != hashes)
+    removed = sorted(code for code in old_hashes if code not in new_hashes)
+    extra = [('since', since), ('data_version', to), ('changed', changed), ('removed', removed)]
+
+    if not include:
+        return JSONResponse(dict(extra))
+
+    if to != current_version:
+        return errorResponse("Records can only be included for the current data version (%s.)" % current_version, format, empty)
+
+    if len(changed) > MAX_BATCH_SPECIES:
+        return errorResponse("%d species changed, too many to include their records (at most %d.)  Leave out 'include' to get the list of changed species."
+            % (len(changed), MAX_BATCH_SPECIES), format, dict(extra))
+
+    ranges, points = batch_querysets(changed)
+    return StreamingGroupedJSONResponse(batch_json_sections(ranges, points, include), changed, extra=extra)
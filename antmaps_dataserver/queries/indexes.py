@@ -0,0 +1,706 @@
+"""
+In-process lookup structures built from the AntMaps data.
+
+Each index is built from the database the first time it's used in a process,
+kept in memory, and rebuilt when the data version changes (see
+queries/dataversion.py).  Views get the current index with e.g.
+species_prefix_index.get().
+
+The larger indexes are SharedVersionedIndexes: with
+settings.ANTMAPS_SHARED_INDEX_DIR set, they're built once per data version
+into a memory-mapped file that all of the worker processes read (see
+queries/sharedarrays.py,) instead of in every process.
+"""
+
+import threading
+from bisect import bisect_left
+from re import split
+
+from django.conf import settings
+
+from queries.dataversion import get_data_version
+from queries.sharedarrays import SharedSegments, SortedMap
+from queries.models import Subfamily, Genus, Species, Bentity, SpeciesBentityPair
+
+
+
+
+class VersionedIndex(object):
+    """
+    Holds the result of calling 'build' (a function that reads the database
+    and returns an index object), and calls it again whenever the data version
+    changes.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self._lock = threading.Lock()
+        self._version = None
+        self._index = None
+
+
+    def get(self):
+        """
+        Return the index for the current data version, building it if needed.
+        """
+
+        version = get_data_version()
+        if self._version != version:
+            with self._lock:
+                if self._version != version:
+                    self._index = self._load(version)
+                    self._version = version
+
+        return self._index
+
+
+    def _load(self, version):
+        return self.build()
+
+
+
+
+class SharedVersionedIndex(VersionedIndex):
+    """
+    A VersionedIndex that's shared between processes when
+    settings.ANTMAPS_SHARED_INDEX_DIR is set: each process makes its index
+    with index_class.from_arrays() from the segment file 'name' for the data
+    version, which the first process to need it writes from the to_arrays()
+    of an index made by calling 'build'.
+    """
+
+    def __init__(self, name, index_class, build):
+        super(SharedVersionedIndex, self).__init__(build)
+        self.name = name
+        self.index_class = index_class
+
+
+    def _load(self, version):
+        if not settings.ANTMAPS_SHARED_INDEX_DIR:
+            return self.build()
+
+        segments = SharedSegments(settings.ANTMAPS_SHARED_INDEX_DIR)
+        return self.index_class.from_arrays(segments.attach(self.name, version, lambda: self.build().to_arrays()))
+
+
+
+
+class ReferenceRegistry(object):
+    """
+    The small reference tables that nearly every view needs: bentity names,
+    and which subfamily each genus is in.  Views look names up here instead of
+    joining bentity2 (or genus) in their queries, or querying it separately.
+    
+    Lists are in the database's sort order (the same as ORDER BY name.)
+    """
+    
+    def __init__(self, bentities, genera, subfamilies):
+        """
+        'bentities' is a list of (bentity_id, bentity_name) sorted by name,
+        'genera' a list of (genus_name, subfamily_name) sorted by genus name,
+        and 'subfamilies' a sorted list of subfamily names.
+        """
+        
+        self.bentities = bentities
+        self.bentity_names = dict(bentities)
+        
+        self.genera = [g for g, subfamily in genera]
+        self.genus_subfamily = dict(genera)
+        self.subfamily_genera = {}
+        for genus, subfamily in genera:
+            self.subfamily_genera.setdefault(subfamily, []).append(genus)
+        
+        self.subfamilies = subfamilies
+        
+        
+    def to_arrays(self):
+        return {
+            'bentity_ids': [b[0] for b in self.bentities],
+            'bentity_names': [b[1] for b in self.bentities],
+            'genera': self.genera,
+            'genus_subfamilies': [self.genus_subfamily[g] for g in self.genera],
+            'subfamilies': self.subfamilies,
+        }
+    
+    
+    @classmethod
+    def from_arrays(cls, arrays):
+        # (it's small, so each process copies it out of the segment)
+        return cls(list(zip(arrays['bentity_ids'], arrays['bentity_names'])),
+                   list(zip(arrays['genera'], arrays['genus_subfamilies'])),
+                   list(arrays['subfamilies']))
+
+
+
+
+def _prefix_range(keys, prefix):
+    """
+    Return (lo, hi) such that keys[lo:hi] are all of the keys in the sorted
+    list 'keys' that start with 'prefix'.
+    """
+
+    lo = bisect_left(keys, prefix)
+    if not prefix:
+        return lo, len(keys)
+
+    # the smallest string that sorts after every string starting with prefix
+    hi = bisect_left(keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo)
+    return lo, hi
+
+
+
+
+class SpeciesPrefixIndex(object):
+    """
+    Sorted arrays of lower-cased species names and genus names, for answering
+    species-search autocomplete queries with bisect instead of a database query.
+
+    Species are numbered in taxon_code order, so sorting a set of species
+    numbers also sorts the results by taxon code.
+    """
+
+    def __init__(self, species):
+        """
+        'species' is a list of (taxon_code, genus_name, species_name) tuples,
+        sorted by taxon_code.
+        """
+
+        self.taxon_codes = [s[0] for s in species]
+        self.labels = [(s[1] or '') + ' ' + (s[2] or '') for s in species]
+        self.labels_by_taxon_code = dict(zip(self.taxon_codes, self.labels))
+        self.genus_names = [(s[1] or '').lower() for s in species]
+        self.species_names = [(s[2] or '').lower() for s in species]
+
+        # sorted species names, with the species number for each
+        by_species_name = sorted((name, i) for i, name in enumerate(self.species_names))
+        self.species_keys = [k[0] for k in by_species_name]
+        self.species_key_ids = [k[1] for k in by_species_name]
+
+        # sorted genus names, with the species numbers in each genus
+        genera = {}
+        for i, name in enumerate(self.genus_names):
+            genera.setdefault(name, []).append(i)
+        self.genus_keys = sorted(genera)
+        self.genus_key_ids = [genera[name] for name in self.genus_keys]
+
+
+    ARRAYS = ('taxon_codes', 'labels', 'genus_names', 'species_names',
+              'species_keys', 'species_key_ids', 'genus_keys', 'genus_key_ids')
+
+    def to_arrays(self):
+        arrays = dict((name, getattr(self, name)) for name in self.ARRAYS)
+        labels = sorted(self.labels_by_taxon_code.items())
+        arrays['label_taxon_codes'] = [code for code, label in labels]
+        arrays['label_values'] = [label for code, label in labels]
+        return arrays
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(index, name, arrays[name])
+        index.labels_by_taxon_code = SortedMap(arrays['label_taxon_codes'], arrays['label_values'])
+        return index
+
+
+    def _count(self, token):
+        """
+        Return roughly how many species match 'token' (without building the
+        set), so the most selective token can be looked up first.
+        """
+
+        lo, hi = _prefix_range(self.species_keys, token)
+        count = hi - lo
+        lo, hi = _prefix_range(self.genus_keys, token)
+        for ids in self.genus_key_ids[lo:hi]:
+            count += len(ids)
+        return count
+
+
+    def _lookup(self, token):
+        """
+        Return the set of species numbers for which 'token' is a prefix of the
+        genus name or species name.
+        """
+
+        lo, hi = _prefix_range(self.species_keys, token)
+        found = set(self.species_key_ids[lo:hi])
+
+        lo, hi = _prefix_range(self.genus_keys, token)
+        for ids in self.genus_key_ids[lo:hi]:
+            found.update(ids)
+
+        return found
+
+
+    def search(self, tokens, limit=None):
+        """
+        Return a list of (taxon_code, label) for species where every token in
+        'tokens' is a (case-insensitive) prefix of the genus name or species
+        name, sorted by taxon code.  Return at most 'limit' results if given.
+        """
+
+        tokens = sorted(set(t.lower() for t in tokens), key=self._count)
+        if not tokens:
+            return []
+
+        # start from the most selective token, and check the rest directly
+        matches = self._lookup(tokens[0])
+        for token in tokens[1:]:
+            matches = [i for i in matches
+                if self.species_names[i].startswith(token) or self.genus_names[i].startswith(token)]
+
+        matches = sorted(matches)
+        if limit is not None:
+            matches = matches[:limit]
+
+        return [(self.taxon_codes[i], self.labels[i]) for i in matches]
+
+
+
+
+class BentityNgramIndex(object):
+    """
+    An n-gram index over bentity names, for answering bentity-search 
+    autocomplete (substring) queries without a database query.
+    
+    Every 1-, 2- and 3-character substring of each lower-cased bentity name
+    maps to the set of bentity numbers containing it.  Tokens up to 3 
+    characters long are looked up directly, and longer tokens are narrowed 
+    down by intersecting the sets for their trigrams, then checked directly.
+    """
+    
+    N = 3
+    
+    def __init__(self, bentities):
+        """
+        'bentities' is a list of (gid, bentity_name) tuples, sorted by name.
+        """
+        
+        self.gids = [b[0] for b in bentities]
+        self.names = [b[1] for b in bentities]
+        self.lower_names = [(b[1] or '').lower() for b in bentities]
+        
+        # words in each name, for ranking matches at the start of a word
+        self.words = [split(r'[\W_]+', name) for name in self.lower_names]
+        
+        self.ngrams = {}
+        for i, name in enumerate(self.lower_names):
+            for n in range(1, self.N + 1):
+                for start in range(len(name) - n + 1):
+                    self.ngrams.setdefault(name[start:start+n], set()).add(i)
+                    
+                    
+    def _lookup(self, token):
+        """
+        Return the set of bentity numbers with names containing 'token'.
+        """
+        
+        if len(token) <= self.N:
+            return self.ngrams.get(token, set())
+        
+        grams = sorted((token[start:start+self.N] for start in range(len(token) - self.N + 1)),
+            key=lambda gram: len(self.ngrams.get(gram, ())))
+        
+        found = set(self.ngrams.get(grams[0], ()))
+        for gram in grams[1:]:
+            found &= self.ngrams.get(gram, set())
+            if not found:
+                break
+                
+        return set(i for i in found if token in self.lower_names[i])
+    
+    
+    def _rank(self, i, tokens):
+        """
+        0 if the bentity name starts with one of the tokens, 1 if one of the
+        words in the name does, 2 otherwise.
+        """
+        
+        name = self.lower_names[i]
+        if any(name.startswith(t) for t in tokens):
+            return 0
+        if any(word.startswith(t) for word in self.words[i] for t in tokens):
+            return 1
+        return 2
+    
+    
+    def search(self, tokens, limit=None):
+        """
+        Return a list of (gid, bentity_name) for bentities with names containing
+        every token in 'tokens' (case-insensitive.)  Names starting with one of
+        the tokens come first, then names with a word starting with one of the
+        tokens, then the rest, each sorted by name.  Return at most 'limit' 
+        results if given.
+        """
+        
+        tokens = [t.lower() for t in tokens if t]
+        
+        if not tokens:
+            matches = range(len(self.gids))
+        
+        else:
+            matches = None
+            for token in sorted(set(tokens), key=len, reverse=True):  # longest (most selective) first
+                found = self._lookup(token)
+                matches = found if matches is None else matches & found
+                if not matches:
+                    return []
+        
+        # bentities are numbered by name, so sorting by number also sorts by name
+        matches = sorted(matches, key=lambda i: (self._rank(i, tokens), i))
+        if limit is not None:
+            matches = matches[:limit]
+            
+        return [(self.gids[i], self.names[i]) for i in matches]
+
+
+
+
+def bitset(indices, size):
+    """
+    Return an int with the bits at each of 'indices' set (all < 'size'.)
+    """
+    
+    bits = bytearray((size + 7) // 8)
+    for i in indices:
+        bits[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bytes(bits), 'little')
+
+
+def bit_indices(bits):
+    """
+    Return a list of the indices of the set bits in the int 'bits', ascending.
+    """
+    
+    indices = []
+    offset = 0
+    for byte in bits.to_bytes((bits.bit_length() + 7) // 8, 'little'):
+        while byte:
+            low = byte & -byte
+            indices.append(offset + low.bit_length() - 1)
+            byte ^= low
+        offset += 8
+    return indices
+
+
+class BitsetRows(object):
+    """
+    A read-only sequence of bitsets (ints) stored as consecutive little-endian
+    rows of 'row_size' bytes.
+    """
+    
+    def __init__(self, data, row_size):
+        self.data = data
+        self.row_size = row_size
+        
+        
+    def __len__(self):
+        return len(self.data) // self.row_size if self.row_size else 0
+    
+    
+    def __getitem__(self, i):
+        start = i * self.row_size
+        return int.from_bytes(self.data[start:start + self.row_size], 'little')
+
+
+# number of set bits in an int (int.bit_count() is only in Python 3.10+)
+popcount = getattr(int, 'bit_count', None) or (lambda bits: bin(bits).count('1'))
+
+
+
+
+class NativeSpeciesMatrix(object):
+    """
+    A species x bentity presence matrix for native species: one bitset (a
+    Python int) per bentity, with bit i set if species number i is native to
+    the bentity.  Species are numbered in the database's taxon_code order 
+    (its collation, the same as ORDER BY taxon_code, which isn't always 
+    Python's string order.)
+    
+    Python's big-int AND works a machine word at a time, so intersecting one 
+    bentity's bitset with every other bentity's and counting the bits is a 
+    fast, in-process replacement for self-joining map_species_bentity_pair.
+    """
+    
+    def __init__(self, pairs):
+        """
+        'pairs' is a list of (taxon_code, bentity_id) for native species, 
+        sorted by taxon_code in the database.
+        """
+        
+        self.taxon_codes = []
+        species_numbers = {}
+        for taxon_code, bentity_id in pairs:
+            if taxon_code not in species_numbers:
+                species_numbers[taxon_code] = len(self.taxon_codes)
+                self.taxon_codes.append(taxon_code)
+        
+        members = {}
+        for taxon_code, bentity_id in pairs:
+            members.setdefault(bentity_id, []).append(species_numbers[taxon_code])
+        
+        size = len(self.taxon_codes)
+        self.bentity_ids = sorted(members)
+        self.bitsets = dict((b, bitset(members[b], size)) for b in self.bentity_ids)
+        
+        
+    def to_arrays(self):
+        row_size = (len(self.taxon_codes) + 7) // 8
+        return {
+            'taxon_codes': self.taxon_codes,
+            'bentity_ids': self.bentity_ids,
+            'bitsets': b''.join(self.bitsets[b].to_bytes(row_size, 'little') for b in self.bentity_ids),
+        }
+    
+    
+    @classmethod
+    def from_arrays(cls, arrays):
+        matrix = cls.__new__(cls)
+        matrix.taxon_codes = arrays['taxon_codes']
+        matrix.bentity_ids = arrays['bentity_ids']
+        matrix.bitsets = SortedMap(matrix.bentity_ids, BitsetRows(arrays['bitsets'], (len(matrix.taxon_codes) + 7) // 8))
+        return matrix
+        
+        
+    def in_common(self, bentity_id):
+        """
+        Return a list of (bentity_id, species_count) for each bentity that has
+        native species in common with 'bentity_id' (including 'bentity_id' 
+        itself,) sorted by bentity_id.
+        """
+        
+        query = self.bitsets.get(bentity_id, 0)
+        if not query:
+            return []
+        
+        counts = ((b, popcount(query & self.bitsets[b])) for b in self.bentity_ids)
+        return [(b, count) for b, count in counts if count]
+    
+    
+    def combine(self, bentity_ids, mode='intersection'):
+        """
+        Return the bitset of native species for a list of bentities:
+        
+        'intersection': species native to all of the bentities
+        'union': species native to any of the bentities
+        'difference': species native to the first bentity, but none of the others
+        
+        Raise a ValueError for any other mode.
+        """
+        
+        bitsets = [self.bitsets.get(b, 0) for b in bentity_ids]
+        if not bitsets:
+            return 0
+        
+        if mode == 'intersection':
+            bits = bitsets[0]
+            for other in bitsets[1:]:
+                bits &= other
+        
+        elif mode == 'union':
+            bits = 0
+            for other in bitsets:
+                bits |= other
+        
+        elif mode == 'difference':
+            bits = bitsets[0]
+            for other in bitsets[1:]:
+                bits &= ~other
+        
+        else:
+            raise ValueError(mode)
+        
+        return bits
+    
+    
+    def species(self, bits):
+        """
+        Return the taxon codes of the species in the bitset 'bits', in the 
+        database's order.
+        """
+        
+        return [self.taxon_codes[i] for i in bit_indices(bits)]
+
+
+
+
+class DiversityRollup(object):
+    """
+    Per-bentity native species counts and record counts, for every genus and 
+    every subfamily.  (The same numbers as map_bentity_count, but for each
+    genus and subfamily instead of all species.)
+    
+    For each genus and subfamily there's a list of (bentity_id, species_count,
+    num_records, literature_count, museum_count, database_count) tuples, 
+    sorted by bentity_id.
+    """
+    
+    def __init__(self, pairs):
+        """
+        'pairs' is an iterable of (genus_name, subfamily_name, taxon_code, 
+        bentity_id, num_records, literature_count, museum_count, database_count)
+        for native species.
+        """
+        
+        # (genus or subfamily, bentity_id) -> [set of species, num_records, literature_count, museum_count, database_count]
+        by_genus = {}
+        by_subfamily = {}
+        
+        for genus, subfamily, taxon_code, bentity_id, num_records, literature_count, museum_count, database_count in pairs:
+            counts = (int(num_records or 0), int(literature_count or 0), int(museum_count or 0), int(database_count or 0))
+            for totals, taxon in ((by_genus, genus), (by_subfamily, subfamily)):
+                if taxon is None:
+                    continue  # (no genus or subfamily to look it up by)
+                key = (taxon, bentity_id)
+                if key not in totals:
+                    totals[key] = [set(), 0, 0, 0, 0]
+                total = totals[key]
+                # (like count(distinct valid_species_name), a NULL species
+                # isn't counted, but its records are)
+                if taxon_code is not None:
+                    total[0].add(taxon_code)
+                for i, count in enumerate(counts, 1):
+                    total[i] += count
+        
+        self.genera = self._by_taxon(by_genus)
+        self.subfamilies = self._by_taxon(by_subfamily)
+        
+        
+    @staticmethod
+    def _by_taxon(totals):
+        by_taxon = {}
+        for (taxon, bentity_id), total in sorted(totals.items()):
+            by_taxon.setdefault(taxon, []).append((bentity_id, len(total[0])) + tuple(total[1:]))
+        return by_taxon
+    
+    
+    def to_arrays(self):
+        arrays = {}
+        for prefix, by_taxon in (('genus', self.genera), ('subfamily', self.subfamilies)):
+            names = sorted(taxon for taxon in by_taxon if taxon is not None)
+            offsets = [0]
+            bentity_ids = []
+            counts = []
+            for name in names:
+                for row in by_taxon[name]:
+                    bentity_ids.append(row[0])
+                    counts.extend(row[1:])
+                offsets.append(len(bentity_ids))
+            
+            arrays.update({prefix + '_names': names, prefix + '_offsets': offsets,
+                           prefix + '_bentity_ids': bentity_ids, prefix + '_counts': counts})
+        return arrays
+    
+    
+    @classmethod
+    def from_arrays(cls, arrays):
+        rollup = cls.__new__(cls)
+        rollup.genera, rollup.subfamilies = (
+            SortedMap(arrays[prefix + '_names'], RollupRows(
+                arrays[prefix + '_offsets'], arrays[prefix + '_bentity_ids'], arrays[prefix + '_counts']))
+            for prefix in ('genus', 'subfamily') )
+        return rollup
+    
+    
+    def genus(self, genus_name):
+        return self.genera.get(genus_name, [])
+    
+    
+    def subfamily(self, subfamily_name):
+        return self.subfamilies.get(subfamily_name, [])
+
+
+
+
+class RollupRows(object):
+    """
+    DiversityRollup lists in flat arrays: list i is made of rows offsets[i]
+    to offsets[i+1], each with a bentity ID and 5 counts.
+    """
+    
+    def __init__(self, offsets, bentity_ids, counts):
+        self.offsets = offsets
+        self.bentity_ids = bentity_ids
+        self.counts = counts
+        
+        
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    
+    def __getitem__(self, i):
+        return [(self.bentity_ids[j],) + tuple(self.counts[j*5:j*5+5])
+                for j in range(self.offsets[i], self.offsets[i+1])]
+
+
+
+
+def _build_reference_registry():
+    bentities = Bentity.objects.order_by('bentity').values_list('gid', 'bentity')
+    genera = Genus.objects.order_by('genus_name').values_list('genus_name', 'subfamily_name')
+    subfamilies = Subfamily.objects.order_by('subfamily_name').values_list('subfamily_name', flat=True)
+    
+    return ReferenceRegistry(list(bentities), list(genera), list(subfamilies))
+
+
+reference_registry = SharedVersionedIndex('reference_registry', ReferenceRegistry, _build_reference_registry)
+
+
+
+def _build_species_prefix_index():
+    species = ( Species.objects.all()
+                .order_by('taxon_code')
+                .values_list('taxon_code', 'genus_name', 'species_name') )
+
+    return SpeciesPrefixIndex(list(species))
+
+
+species_prefix_index = SharedVersionedIndex('species_prefix_index', SpeciesPrefixIndex, _build_species_prefix_index)
+
+
+
+def _build_bentity_ngram_index():
+    return BentityNgramIndex(reference_registry.get().bentities)
+
+
+bentity_ngram_index = VersionedIndex(_build_bentity_ngram_index)
+
+
+
+def _build_native_species_matrix():
+    pairs = ( SpeciesBentityPair.objects
+              .filter(category='N')
+              .order_by('valid_species_name')
+              .values_list('valid_species_name', 'bentity') )
+    
+    return NativeSpeciesMatrix([p for p in pairs if p[0] is not None and p[1] is not None])
+
+
+native_species_matrix = SharedVersionedIndex('native_species_matrix', NativeSpeciesMatrix, _build_native_species_matrix)
+
+
+
+def _build_diversity_rollup():
+    pairs = ( SpeciesBentityPair.objects
+              .filter(category='N')
+              .values_list('genus_name', 'subfamily_name', 'valid_species_name', 'bentity', 
+                           'num_records', 'literature_count', 'museum_count', 'database_count') )
+    
+    return DiversityRollup(pairs.iterator())
+
+
+diversity_rollup = SharedVersionedIndex('diversity_rollup', DiversityRollup, _build_diversity_rollup)
+
+
+
+def load_indexes():
+    """
+    Build the in-memory indexes for the current data version (or attach to
+    the shared ones, see SharedVersionedIndex,) eg. when a worker process
+    starts, so its first requests don't wait for them.
+    """
+    
+    for index in (reference_registry, species_prefix_index, native_species_matrix, diversity_rollup):
+        index.get()
@@ -0,0 +1,392 @@
+"""
+manage.py benchmark
+
+Request every URL in the URLconf through the Django test client, a few times
+each with a few different sets of arguments, and report each request's
+latency percentiles, number of SQL queries, rows fetched from the database
+and response size.  The results are written to a JSON file, so runs (eg.
+before and after a change) can be compared with --baseline.
+
+Use it with the synthetic data from make_synthetic_data, eg.
+
+    ./manage.py make_synthetic_data --settings=antmaps_dataserver.benchmark_settings
+    ./manage.py benchmark --settings=antmaps_dataserver.benchmark_settings --output before.json
+
+The arguments for each view (species, genus, bentity, etc.) are picked from
+the data in the database, so it also works with a copy of the GABI data.
+
+By default the Django cache is swapped for a dummy cache, so every request
+runs the view (in-process indexes are still kept between requests, as in
+production.)  Use --with-cache to measure with the configured cache.
+"""
+
+import json
+import platform
+import re
+from datetime import datetime
+from time import perf_counter
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import get_resolver, RegexURLResolver
+from django.db import connection
+from django.db.models import Count
+from django.db.backends.utils import CursorDebugWrapper
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.http import urlencode
+
+from queries.models import Bentity, SpeciesPoints, SpeciesBentityPair, Record
+from queries.dataversion import DATA_VERSION_TABLES, get_data_version
+
+
+
+
+class RowCountingCursor(CursorDebugWrapper):
+    """
+    CursorDebugWrapper that also counts the rows fetched through it in
+    'counter' (a one-item list.)
+    """
+
+    def __init__(self, cursor, db, counter):
+        super(RowCountingCursor, self).__init__(cursor, db)
+        self.counter = counter
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.counter[0] += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self.cursor.fetchmany(*args, **kwargs)
+        self.counter[0] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.counter[0] += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.counter[0] += 1
+            yield row
+
+
+
+
+def percentile(values, p):
+    """
+    The p-th percentile (nearest rank) of a sorted list of values.
+    """
+
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+
+
+
+def sample_arguments():
+    """
+    Pick arguments for the views from the database.  Return a dict of view
+    name -> list of (label, URL keyword arguments, query string arguments.)
+    """
+
+    def first(queryset):
+        value = queryset.first()
+        if value is None:
+            raise CommandError('The AntMaps tables are empty, run make_synthetic_data first.')
+        return value
+
+    # the species with the most points, and one in the middle
+    species_by_points = list( SpeciesPoints.objects.values_list('valid_species_name')
+        .annotate(n=Count('pk')).order_by('-n', 'valid_species_name') )
+    if not species_by_points:
+        raise CommandError('The AntMaps tables are empty, run make_synthetic_data first.')
+    big_species = species_by_points[0][0]
+    median_species = species_by_points[len(species_by_points) // 2][0]
+    batch_species = ','.join(s for s, n in species_by_points[::max(1, len(species_by_points) // 20)][:20])
+
+    genus = first(SpeciesBentityPair.objects.values_list('genus_name', flat=True)
+        .annotate(n=Count('pk')).order_by('-n', 'genus_name'))
+    subfamily = first(SpeciesBentityPair.objects.values_list('subfamily_name', flat=True)
+        .annotate(n=Count('pk')).order_by('-n', 'subfamily_name'))
+    bentity_ids = list(SpeciesBentityPair.objects.values_list('bentity', flat=True)
+        .annotate(n=Count('valid_species_name')).order_by('-n', 'bentity')[:3])
+
+    bentity_name = first(Bentity.objects.order_by('gid').values_list('bentity', flat=True))
+
+    # a record of the big species with coordinates, for citations and the bounding box
+    record = first(Record.objects.filter(valid_species_name=big_species, lat__isnull=False).order_by('gabi_acc_number'))
+    lat, lon = float(record.lat), float(record.lon)
+    bbox = {'min_lat': lat - 5, 'max_lat': lat + 5, 'min_lon': lon - 5, 'max_lon': lon + 5}
+
+    return {
+        'subfamily_list': [('all', {}, {})],
+        'genus_list': [
+            ('all', {}, {}),
+            ('subfamily', {}, {'subfamily': subfamily}) ],
+        'species_list': [
+            ('genus', {}, {'genus': genus}),
+            ('subfamily', {}, {'subfamily': subfamily}),
+            ('bentity', {}, {'bentity_id': bentity_ids[0]}),
+            ('bentity union', {}, {'bentity_id': ','.join(bentity_ids), 'bentity_mode': 'union'}) ],
+        'antweb_links': [
+            ('species', {}, {'taxon_code': big_species}),
+            ('genus', {}, {'genus_name': genus}) ],
+        'species_autocomplete': [
+            ('1 letter', {}, {'q': big_species[:1]}),
+            ('3 letters', {}, {'q': big_species[:3]}) ],
+        'bentity_autocomplete': [
+            ('1 letter', {}, {'q': bentity_name[:1]}),
+            ('3 letters', {}, {'q': bentity_name[:3]}) ],
+        'bentity_list': [('all', {}, {})],
+        'species_points': [
+            ('big species', {}, {'species': big_species}),
+            ('median species', {}, {'species': median_species}),
+            ('big species zoom 3', {}, {'species': big_species, 'zoom': 3}),
+            ('big species bbox', {}, dict(bbox, species=big_species)),
+            ('bbox', {'format': ('json', 'csv')}, bbox) ],
+        'citations': [
+            ('gabi_acc_number', {}, {'gabi_acc_number': record.gabi_acc_number}),
+            ('species and bentity', {}, {'species': big_species, 'bentity_id': record.bentity_id}),
+            ('species, page of 100 with count', {}, {'species': big_species, 'limit': 100, 'count': 1}),
+            ('lat and lon', {}, {'lat': record.lat, 'lon': record.lon}) ],
+        'species_range': [
+            ('big species', {}, {'species': big_species}),
+            ('median species', {}, {'species': median_species}) ],
+        'species_batch': [
+            ('20 species', {}, {'species': batch_species}),
+            ('20 species range', {}, {'species': batch_species, 'include': 'range'}) ],
+        'species_per_bentity': [
+            ('all', {}, {}),
+            ('genus', {}, {'genus': genus}),
+            ('subfamily', {}, {'subfamily': subfamily}) ],
+        'species_in_common': [
+            ('bentity', {}, {'bentity_id': bentity_ids[0]}) ],
+        'tile': [
+            ('zoom 0 all', {'z': 0, 'x': 0, 'y': 0}, {}),
+            ('zoom 2 genus', {'z': 2, 'x': 1, 'y': 1}, {'genus': genus}),
+            ('zoom 0 species', {'z': 0, 'x': 0, 'y': 0}, {'species': big_species}) ],
+        'report': [('form', {}, {})],
+        'metrics': [('all', {}, {})],
+    }
+
+
+
+
+def url_patterns(resolver=None, prefix=''):
+    """
+    Generate (regex pattern with the prefixes of any includes, view function)
+    for every URL pattern in the URLconf.
+    """
+
+    resolver = resolver or get_resolver()
+    for pattern in resolver.url_patterns:
+        regex = prefix + pattern.regex.pattern.lstrip('^')
+        if isinstance(pattern, RegexURLResolver):
+            yield from url_patterns(pattern, regex)
+        else:
+            yield regex, pattern.callback
+
+
+
+
+def build_path(regex, kwargs):
+    """
+    Fill in the named groups of a URL pattern.  Returns None if the pattern
+    has other regex syntax that can't be filled in.
+    """
+
+    def group(match):
+        return str(kwargs.get(match.group(1), ''))
+
+    path = re.sub(r'\(\?P<(\w+)>[^)]*\)\??', group, regex.rstrip('$'))
+    # the optional dot before the format
+    path = path.replace(r'\.?', '.' if kwargs.get('format') else '')
+    path = path.replace(r'\.', '.')
+
+    if re.search(r'[\\()\[\]*+?|^$]', path):
+        return None
+    return '/' + path
+
+
+def pattern_formats(regex):
+    """
+    The formats a URL pattern accepts (from its 'format' group,) or [None].
+    """
+
+    match = re.search(r'\(\?P<format>([\w|]+)\)', regex)
+    return match.group(1).split('|') if match else [None]
+
+
+
+
+class Command(BaseCommand):
+    help = 'Benchmark every URL through the Django test client, and write latency, query, row and size statistics to a JSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=10,
+            help='Timed requests per URL (default 10)')
+        parser.add_argument('--warmup', type=int, default=1,
+            help='Untimed requests per URL first (default 1)')
+        parser.add_argument('--output', default='benchmark-results.json',
+            help='File to write the results to (default benchmark-results.json)')
+        parser.add_argument('--baseline',
+            help='Results file from an earlier run, to compare with')
+        parser.add_argument('--with-cache', action='store_true',
+            help='Use the configured Django cache, instead of a dummy cache')
+        parser.add_argument('--filter',
+            help='Only benchmark URLs containing this string')
+
+
+    def handle(self, *args, **options):
+
+        overrides = {'ALLOWED_HOSTS': list(settings.ALLOWED_HOSTS) + ['testserver']}
+        if not options['with_cache']:
+            overrides['CACHES'] = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+        with override_settings(**overrides):
+            results, unbenchmarked = self.run(options)
+
+        output = {
+            'created': datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'data_version': get_data_version(),
+            'table_rows': self.table_rows(),
+            'iterations': options['iterations'],
+            'with_cache': options['with_cache'],
+            'results': results,
+            'unbenchmarked_patterns': unbenchmarked,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+        self.report(results, unbenchmarked, options['baseline'])
+        self.stdout.write('Wrote %s' % options['output'])
+
+
+    def table_rows(self):
+        counts = {}
+        with connection.cursor() as cursor:
+            for table in DATA_VERSION_TABLES:
+                cursor.execute('SELECT count(*) FROM "%s"' % table)
+                counts[table] = cursor.fetchone()[0]
+        return counts
+
+
+    def run(self, options):
+        """
+        Request every URL.  Return (list of result dicts, list of URL patterns
+        without any arguments to benchmark them with.)
+        """
+
+        arguments = sample_arguments()
+        client = Client()
+
+        results = []
+        unbenchmarked = []
+        for regex, view in url_patterns():
+            cases = arguments.get(view.__name__)
+            if cases is None:
+                unbenchmarked.append(regex)
+                continue
+
+            for label, kwargs, query in cases:
+                for format in kwargs.get('format', pattern_formats(regex)):
+                    path = build_path(regex, dict(kwargs, format=format))
+                    if path is None:
+                        unbenchmarked.append(regex)
+                        break
+                    if query:
+                        path += '?' + urlencode(query)
+
+                    if options['filter'] and options['filter'] not in path:
+                        continue
+
+                    self.stdout.write(path)
+                    result = self.measure(client, path, options['warmup'], options['iterations'])
+                    result.update({'pattern': regex, 'view': view.__module__ + '.' + view.__name__, 'label': label, 'format': format})
+                    results.append(result)
+
+        return results, unbenchmarked
+
+
+    def measure(self, client, path, warmup, iterations):
+        """
+        Request 'path' 'warmup' + 'iterations' times, and return the statistics
+        for the timed requests.
+        """
+
+        rows = [0]
+        make_debug_cursor = connection.make_debug_cursor
+        connection.make_debug_cursor = lambda cursor: RowCountingCursor(cursor, connection, rows)
+
+        try:
+            for i in range(warmup):
+                response = client.get(path)
+                b''.join(response.streaming_content) if response.streaming else response.content
+
+            seconds = []
+            queries = []
+            fetched = []
+            for i in range(iterations):
+                rows[0] = 0
+                with CaptureQueriesContext(connection) as captured:
+                    start = perf_counter()
+                    response = client.get(path)
+                    content = b''.join(response.streaming_content) if response.streaming else response.content
+                    seconds.append(perf_counter() - start)
+                queries.append(len(captured))
+                fetched.append(rows[0])
+
+        finally:
+            connection.make_debug_cursor = make_debug_cursor
+
+        seconds.sort()
+        return {
+            'path': path,
+            'status': response.status_code,
+            'bytes': len(content),
+            'queries': max(queries) if queries else None,
+            'rows': max(fetched) if fetched else None,
+            'latency_ms': dict((name, round(value * 1000, 3)) for name, value in (
+                ('min', seconds[0]),
+                ('p50', percentile(seconds, 50)),
+                ('p90', percentile(seconds, 90)),
+                ('p99', percentile(seconds, 99)),
+                ('max', seconds[-1]),
+                ('mean', sum(seconds) / len(seconds)),
+            )) if seconds else {},
+        }
+
+
+    def report(self, results, unbenchmarked, baseline_file):
+        """
+        Print a table of the results, compared with the baseline results if given.
+        """
+
+        baseline = {}
+        if baseline_file:
+            with open(baseline_file) as f:
+                baseline = dict((r['path'], r) for r in json.load(f)['results'])
+
+        self.stdout.write('')
+        self.stdout.write('%9s %9s %9s %7s %8s %10s  %s' % ('p50 ms', 'p90 ms', 'p99 ms', 'queries', 'rows', 'bytes', 'path'))
+        for r in results:
+            if not r['latency_ms']:
+                continue
+            line = '%9.2f %9.2f %9.2f %7d %8d %10d  %s' % (r['latency_ms']['p50'], r['latency_ms']['p90'],
+                r['latency_ms']['p99'], r['queries'], r['rows'], r['bytes'], r['path'])
+
+            before = baseline.get(r['path'])
+            if before and before['latency_ms'].get('p50'):
+                line += '  (p50 %+.0f%%, queries %+d)' % (
+                    (r['latency_ms']['p50'] / before['latency_ms']['p50'] - 1) * 100, r['queries'] - before['queries'])
+            self.stdout.write(line)
+
+        for regex in unbenchmarked:
+            self.stdout.write('Not benchmarked (no arguments for this view): %s' % regex)
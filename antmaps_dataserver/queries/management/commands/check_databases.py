@@ -0,0 +1,60 @@
+"""
+manage.py check_databases
+
+Check the connection to the primary database and each read replica (see
+queries/routers.py,) and show which one the queries app reads from.  With
+--watch, keep checking, which is handy for trying out failover against local
+Postgres instances (stop and start one and watch the reads move.)
+"""
+
+from time import sleep, time
+
+from django.core.management.base import BaseCommand
+from django.db import connections, router, DatabaseError
+
+from queries.models import Species
+from queries.dataversion import get_data_version
+
+
+
+
+class Command(BaseCommand):
+    help = 'Check the primary and read replica database connections, and show which one queries read from.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--watch', type=float, default=0,
+            help='Check again every this many seconds, until interrupted')
+
+
+    def handle(self, *args, **options):
+        while True:
+            for alias in connections:
+                self.stdout.write('%-10s %s' % (alias, self.connection_status(alias)))
+
+            alias = router.db_for_read(Species)
+            self.stdout.write('Queries read from %s (data version %s)' % (alias, get_data_version()))
+
+            if not options['watch']:
+                break
+            self.stdout.write('')
+            sleep(options['watch'])
+
+
+    @staticmethod
+    def connection_status(alias):
+        """
+        Return a description of the connection to 'alias': the round trip
+        time for a trivial query, or the error.
+        """
+
+        settings = connections[alias].settings_dict
+        where = '%s:%s' % (settings.get('HOST') or 'localhost', settings.get('PORT') or '-')
+        start = time()
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SELECT 1')
+                cursor.fetchone()
+        except DatabaseError as e:
+            connections[alias].close()
+            return '%-21s down: %s' % (where, str(e).strip().splitlines()[0] if str(e).strip() else e.__class__.__name__)
+        return '%-21s up, %.1f ms' % (where, (time() - start) * 1000)
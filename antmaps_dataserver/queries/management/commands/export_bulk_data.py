@@ -0,0 +1,81 @@
+"""
+manage.py export_bulk_data
+
+Write the bulk download files (all species ranges, points and bentity counts
+as gzipped CSV and NDJSON, see queries/bulkexport.py) to
+settings.ANTMAPS_BULK_EXPORT_DIR, if they aren't already from the current
+data version.  Run it after each data refresh, or keep it running in the
+background with --watch to export whenever the data version changes, eg.
+
+    nohup ./manage.py export_bulk_data --watch 300 &
+"""
+
+import logging
+from time import sleep, time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from queries.bulkexport import export_bulk_data, read_manifest
+from queries.dataversion import get_data_version, invalidate_data_version
+
+
+logger = logging.getLogger(__name__)
+
+
+
+
+class Command(BaseCommand):
+    help = 'Export the bulk download files, if the data has changed since the last export.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', default=None,
+            help='Directory to write the files to (default settings.ANTMAPS_BULK_EXPORT_DIR)')
+        parser.add_argument('--force', action='store_true',
+            help='Export even if the files are from the current data version')
+        parser.add_argument('--watch', type=float, default=0,
+            help='Keep running, checking for a new data version every this many seconds')
+
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or settings.ANTMAPS_BULK_EXPORT_DIR
+        if not directory:
+            raise CommandError('Set ANTMAPS_BULK_EXPORT_DIR or give a --directory.')
+
+        force = options['force']
+        while True:
+            try:
+                self.export_if_changed(directory, force)
+                force = False
+            except Exception:
+                if not options['watch']:
+                    raise
+                logger.exception('Bulk export failed, trying again in %s seconds', options['watch'])
+
+            if not options['watch']:
+                break
+
+            # don't hold a database connection while waiting
+            connections.close_all()
+            sleep(options['watch'])
+
+
+    def export_if_changed(self, directory, force=False):
+        manifest = read_manifest(directory)
+        invalidate_data_version()
+        version = get_data_version()
+
+        if manifest is not None and manifest['data_version'] == version and not force:
+            self.stdout.write('The bulk export is already from data version %s' % version)
+            return
+
+        start = time()
+
+        def progress(filename, entry):
+            self.stdout.write('%9d rows %8.1f MB  %s (%d of %d parts unchanged)' % (
+                entry['rows'], entry['size'] / 1e6, filename, entry['reused_members'], len(entry['members'])))
+
+        manifest = export_bulk_data(directory, progress)
+        self.stdout.write('Exported data version %s to %s in %.1f seconds' % (
+            manifest['data_version'], directory, time() - start))
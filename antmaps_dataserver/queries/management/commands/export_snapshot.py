@@ -0,0 +1,43 @@
+"""
+manage.py export_snapshot
+
+Copy the tables and materialized views the API reads into one read-only
+SQLite snapshot file (see queries/snapshot.py,) eg.
+
+    ./manage.py export_snapshot /srv/antmaps/antmaps-snapshot.sqlite3
+
+then serve the API from it, without a database server, by setting the
+ANTMAPS_SNAPSHOT environment variable to its path.  Run this after each data
+refresh; the new file replaces the old one atomically.
+"""
+
+import os
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from queries.snapshot import export_snapshot
+
+
+
+
+class Command(BaseCommand):
+    help = 'Export the AntMaps data to a read-only snapshot file, for serving the API without Postgres.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path',
+            help='Snapshot file to write (replaced if it exists)')
+        parser.add_argument('--database', default='default',
+            help='Database to export (default "default")')
+
+
+    def handle(self, *args, **options):
+        start = time()
+
+        def progress(table, rows):
+            self.stdout.write('%9d %s' % (rows, table))
+
+        version = export_snapshot(options['path'], options['database'], progress)
+
+        self.stdout.write('Wrote %s (%.1f MB, data version %s) in %.1f seconds' % (
+            options['path'], os.path.getsize(options['path']) / 1e6, version, time() - start))
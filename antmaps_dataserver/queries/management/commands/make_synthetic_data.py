@@ -0,0 +1,264 @@
+"""
+manage.py make_synthetic_data
+
+Create the tables AntMaps reads from (see queries/models.py) in a local
+database, and fill them with made-up data with about the same shape as the
+GABI data: the same tables and columns, similar numbers of subfamilies,
+genera, species and bentities, and a long-tailed number of records per
+species.  This is for benchmarking and testing without access to the GABI
+database (see the benchmark command,) eg.
+
+    ./manage.py make_synthetic_data --settings=antmaps_dataserver.benchmark_settings --scale 0.1
+
+--scale multiplies the number of genera, species and records (1.0 is about
+the size of the real data.)  The same --seed always makes the same data.
+"""
+
+import random
+from math import cos, radians
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from queries.schema import TABLES, INDEXES
+
+
+# about the size of the GABI data at --scale 1.0
+FULL_GENERA = 330
+FULL_SPECIES = 15000
+FULL_RECORDS = 1700000
+BENTITIES = 546
+
+SUBFAMILIES = ('Agroecomyrmecinae', 'Amblyoponinae', 'Aneuretinae', 'Dolichoderinae',
+    'Dorylinae', 'Ectatomminae', 'Formicinae', 'Heteroponerinae', 'Leptanillinae',
+    'Martialinae', 'Myrmeciinae', 'Myrmicinae', 'Paraponerinae', 'Ponerinae',
+    'Proceratiinae', 'Pseudomyrmecinae')
+
+# species-bentity categories, with how often each one comes up
+CATEGORIES = (('N', 80), ('I', 8), ('E', 7), ('D', 5))
+
+TYPES_OF_DATA = ('literature', 'museum', 'database')
+
+# rows per INSERT batch
+BATCH_SIZE = 5000
+
+SYLLABLES = ('ca', 'lo', 'mi', 'ne', 'pho', 'ra', 'si', 'ta', 'ver', 'tri', 'myr', 'do',
+    'le', 'pto', 'the', 'cre', 'ma', 'go', 'ni', 'spi', 'phe', 'ri', 'nu', 'a', 'o')
+GENUS_ENDINGS = ('ex', 'ops', 'ella', 'myrma', 'ponera', 'omyrmex', 'ius', 'otus', 'idris')
+SPECIES_ENDINGS = ('us', 'a', 'um', 'ensis', 'i', 'ae', 'oides', 'ica')
+
+
+
+
+def _make_name(rnd, endings, used):
+    """
+    Return a new made-up Latin-ish name (lower case) that isn't in 'used'.
+    """
+
+    while True:
+        name = ''.join(rnd.choice(SYLLABLES) for i in range(rnd.randint(1, 3))) + rnd.choice(endings)
+        if name not in used:
+            used.add(name)
+            return name
+
+
+
+
+def _weighted_choice(rnd, choices):
+    """
+    Pick from a list of (value, weight) pairs.
+    """
+
+    total = sum(weight for value, weight in choices)
+    r = rnd.uniform(0, total)
+    for value, weight in choices:
+        r -= weight
+        if r <= 0:
+            return value
+    return choices[-1][0]
+
+
+
+
+class Command(BaseCommand):
+    help = 'Create the AntMaps tables in a local database and fill them with synthetic data, for benchmarking.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default',
+            help='Database to create the tables in (default "default")')
+        parser.add_argument('--scale', type=float, default=0.1,
+            help='Size of the data, relative to the real GABI data (default 0.1)')
+        parser.add_argument('--seed', type=int, default=1,
+            help='Random seed (default 1)')
+        parser.add_argument('--replace', action='store_true',
+            help='Drop the AntMaps tables first if they exist')
+
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        rnd = random.Random(options['seed'])
+        scale = options['scale']
+
+        existing = set(connection.introspection.table_names()) & set(name for name, columns in TABLES)
+        if existing and not options['replace']:
+            raise CommandError('The database already has the tables %s.  Use --replace to drop them '
+                '(never on the GABI database!)' % ', '.join(sorted(existing)))
+
+        with transaction.atomic(using=options['database']):
+            with connection.cursor() as cursor:
+                for name in existing:
+                    cursor.execute('DROP TABLE "%s"' % name)
+                for name, columns in TABLES:
+                    cursor.execute('CREATE TABLE "%s" (%s)' % (name, columns))
+
+            counts = self.fill(connection, rnd,
+                num_genera=max(len(SUBFAMILIES), int(FULL_GENERA * scale)),
+                num_species=max(1, int(FULL_SPECIES * scale)),
+                num_records=max(1, int(FULL_RECORDS * scale)) )
+
+            with connection.cursor() as cursor:
+                for table, column in INDEXES:
+                    cursor.execute('CREATE INDEX "%s_%s" ON "%s" ("%s")' % (table, column, table, column))
+
+        for table, count in counts:
+            self.stdout.write('%9d %s' % (count, table))
+
+
+    def fill(self, connection, rnd, num_genera, num_species, num_records):
+        """
+        Generate the data and insert it.  Return a list of (table, rows inserted.)
+        """
+
+        inserter = _Inserter(connection)
+        used_names = set()
+
+        # taxonomy: genera and species are spread over subfamilies and genera
+        # with a long tail (a few very big genera, lots of small ones)
+        inserter.add('subfamily', [(s,) for s in SUBFAMILIES])
+
+        subfamily_weights = [(s, 1.0 / (rank + 1)) for rank, s in enumerate(rnd.sample(SUBFAMILIES, len(SUBFAMILIES)))]
+        genera = []
+        for i in range(num_genera):
+            # (at least one genus in each subfamily)
+            subfamily = SUBFAMILIES[i] if i < len(SUBFAMILIES) else _weighted_choice(rnd, subfamily_weights)
+            genus = _make_name(rnd, GENUS_ENDINGS, used_names).capitalize()
+            genera.append((genus, subfamily))
+            inserter.add('genus', [(i + 1, genus, subfamily)])
+        genus_weights = [(g, 1.0 / (rank + 1)) for rank, g in enumerate(genera)]
+
+
+        # bentities: each one is a circle somewhere on the map
+        bentities = []
+        used_bentity_names = set()
+        for i in range(BENTITIES):
+            name = ' '.join(_make_name(rnd, ('', 'ia', 'land', 'stan'), used_bentity_names).capitalize()
+                            for j in range(rnd.choice((1, 1, 1, 2))))
+            lat = rnd.uniform(-55, 70)
+            lon = rnd.uniform(-180, 180)
+            radius = rnd.uniform(0.5, 12)
+            bentities.append(('B%04d' % (i + 1), name, lat, lon, radius))
+        inserter.add('bentity2', [b[:2] for b in bentities])
+
+        citations = ['%s, %s. %d. %s %s. Journal of %s %d: %d-%d.' % (
+                _make_name(rnd, ('son', 'er', 'i', 'ez'), set()).capitalize(), chr(rnd.randint(65, 90)),
+                rnd.randint(1758, 2016), _make_name(rnd, SPECIES_ENDINGS, set()).capitalize(),
+                _make_name(rnd, SPECIES_ENDINGS, set()), _make_name(rnd, ('ology',), set()).capitalize(),
+                rnd.randint(1, 120), rnd.randint(1, 300), rnd.randint(301, 600) )
+            for i in range(max(10, num_records // 40))]
+
+
+        # species, with a long-tailed number of records and bentities each
+        record_weights = [rnd.paretovariate(1.1) for i in range(num_species)]
+        records_per_weight = num_records / sum(record_weights)
+
+        accession = 0
+        bentity_totals = {}  # bentity_id -> [native species, num_records, literature, museum, database]
+
+        for weight in record_weights:
+            genus, subfamily = _weighted_choice(rnd, genus_weights)
+            species_name = _make_name(rnd, SPECIES_ENDINGS, used_names)
+            taxon_code = genus + '.' + species_name
+            inserter.add('species', [(taxon_code, genus, species_name)])
+            inserter.add('map_taxonomy_list', [(taxon_code, subfamily, genus, species_name)])
+
+            species_records = max(1, int(round(weight * records_per_weight)))
+            num_bentities = min(len(bentities), max(1, int(rnd.paretovariate(1.3)), species_records // 200))
+
+            for bentity_id, bentity_name, center_lat, center_lon, radius in rnd.sample(bentities, num_bentities):
+                category = _weighted_choice(rnd, CATEGORIES) if num_bentities > 1 else 'N'
+                pair_records = max(1, species_records // num_bentities)
+
+                # a few records per collecting locality
+                localities = []
+                for i in range(max(1, pair_records // rnd.randint(2, 6))):
+                    lat = max(-85, min(85, center_lat + rnd.gauss(0, radius / 2)))
+                    lon = (center_lon + rnd.gauss(0, radius / 2 / max(0.2, cos(radians(lat)))) + 180) % 360 - 180
+                    localities.append(('%.4f' % lat, '%.4f' % lon))
+
+                points = {}  # (lat, lon) -> [gabi_acc_number, num_records, literature, museum, database]
+                pair_counts = [0, 0, 0, 0]
+                records = []
+                for i in range(pair_records):
+                    accession += 1
+                    gabi_acc_number = 'GABI%08d' % accession
+                    type_of_data = rnd.choice(TYPES_OF_DATA)
+                    citation = rnd.choice(citations)
+
+                    # some records have no coordinates
+                    if rnd.random() < 0.05:
+                        lat = lon = None
+                    else:
+                        lat, lon = rnd.choice(localities)
+                        point = points.setdefault((lat, lon), [gabi_acc_number, 0, 0, 0, 0])
+                        point[1] += 1
+                        point[2 + TYPES_OF_DATA.index(type_of_data)] += 1
+
+                    pair_counts[0] += 1
+                    pair_counts[1 + TYPES_OF_DATA.index(type_of_data)] += 1
+                    records.append((gabi_acc_number, lat, lon, taxon_code, bentity_id, category,
+                        type_of_data, citation, citation.split('.')[0]))
+
+                inserter.add('map_record', records)
+                inserter.add('map_species_points', [(p[0], lat, lon, taxon_code, bentity_id, category, p[1], p[2], p[3], p[4])
+                    for (lat, lon), p in sorted(points.items())])
+                inserter.add('map_species_bentity_pair', [(subfamily, genus, taxon_code, bentity_id, category) + tuple(pair_counts)])
+
+                if category == 'N':
+                    totals = bentity_totals.setdefault(bentity_id, [0, 0, 0, 0, 0])
+                    totals[0] += 1
+                    for i in range(4):
+                        totals[1 + i] += pair_counts[i]
+
+        inserter.add('map_bentity_count', [(bentity_id,) + tuple(totals) for bentity_id, totals in sorted(bentity_totals.items())])
+
+        inserter.flush()
+        return [(name, inserter.counts.get(name, 0)) for name, columns in TABLES]
+
+
+
+
+class _Inserter(object):
+    """
+    Buffers rows for each table, and inserts them BATCH_SIZE at a time.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = {}
+        self.counts = {}
+
+
+    def add(self, table, rows):
+        buffer = self.rows.setdefault(table, [])
+        buffer.extend(rows)
+        if len(buffer) >= BATCH_SIZE:
+            self.flush(table)
+
+
+    def flush(self, table=None):
+        for name in ([table] if table else list(self.rows)):
+            rows = self.rows.pop(name, [])
+            if rows:
+                with self.connection.cursor() as cursor:
+                    cursor.executemany('INSERT INTO "%s" VALUES (%s)' % (name, ', '.join(['%s'] * len(rows[0]))), rows)
+                self.counts[name] = self.counts.get(name, 0) + len(rows)
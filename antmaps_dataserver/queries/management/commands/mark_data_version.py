@@ -0,0 +1,42 @@
+"""
+manage.py mark_data_version
+
+Record a new data version (see queries/dataversion.py) in the primary 
+database.  Run this as the last step of each data refresh, after the GABI 
+materialized views are refreshed, eg.
+
+    ./manage.py mark_data_version
+
+The version is written to a regular table (antmaps_data_version,) so it 
+reaches the read replicas along with the data, and every server (whichever
+database it reads from) switches to the new version within 
+ANTMAPS_DATA_VERSION_CHECK_SECONDS.  A refresh script that only runs SQL can
+do the same with
+
+    CREATE TABLE IF NOT EXISTS antmaps_data_version (version text NOT NULL);
+    BEGIN;
+    DELETE FROM antmaps_data_version;
+    INSERT INTO antmaps_data_version VALUES (md5(random()::text));
+    COMMIT;
+"""
+
+from django.core.management.base import BaseCommand
+
+from queries.dataversion import mark_data_version
+
+
+
+
+class Command(BaseCommand):
+    help = 'Record a new data version in the primary database, after a data refresh.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--data-version',
+            help='Version to record (default: a random one)')
+        parser.add_argument('--database', default='default',
+            help='Database to write it to (default "default", the primary)')
+
+
+    def handle(self, *args, **options):
+        version = mark_data_version(options['data_version'], options['database'])
+        self.stdout.write('Data version %s' % version)
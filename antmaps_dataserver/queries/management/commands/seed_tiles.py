@@ -0,0 +1,54 @@
+"""
+manage.py seed_tiles
+
+Pre-generate the map tiles for low zoom levels (see queries/tiles.py), so the
+first users after a data refresh don't have to wait for them.
+"""
+
+from time import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from queries.models import Genus, Subfamily
+from queries.views import tile
+
+
+
+
+class Command(BaseCommand):
+    help = ('Pre-generate map tiles for zoom levels 0 to --max-zoom: the unfiltered tiles (species counts for every bentity), '
+        'and the tiles for each subfamily, genus or species asked for with --subfamilies, --genera or --species.')
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--max-zoom', type=int, default=2,
+            help='Generate tiles for zoom levels 0 up to this one (default 2)')
+        parser.add_argument('--subfamilies', action='store_true',
+            help='Also generate tiles for each subfamily')
+        parser.add_argument('--genera', action='store_true',
+            help='Also generate tiles for each genus')
+        parser.add_argument('--species', nargs='*', default=[],
+            help='Also generate tiles for these species (taxon codes)')
+            
+            
+    def handle(self, *args, **options):
+        
+        queries = [{}]
+        if options['subfamilies']:
+            queries += [{'subfamily': s} for s in Subfamily.objects.values_list('subfamily_name', flat=True)]
+        if options['genera']:
+            queries += [{'genus': g} for g in Genus.objects.values_list('genus_name', flat=True)]
+        queries += [{'species': s} for s in options['species']]
+        
+        factory = RequestFactory()
+        start = time()
+        count = 0
+        
+        for query in queries:
+            for z in range(options['max_zoom'] + 1):
+                for x in range(2 ** z):
+                    for y in range(2 ** z):
+                        tile(factory.get('/tiles/%d/%d/%d.json' % (z, x, y), query), str(z), str(x), str(y))
+                        count += 1
+        
+        self.stdout.write('Generated %d tiles in %.1f seconds' % (count, time() - start))
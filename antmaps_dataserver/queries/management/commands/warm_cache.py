@@ -0,0 +1,184 @@
+"""
+manage.py warm_cache
+
+Fill the cache with responses for the finite part of the API that the front
+end uses most: the list endpoints, species_per_bentity for every genus and
+subfamily, species_in_common for every bentity, and species_range for every
+species.  Run this after a data refresh (or a deploy,) so the first users don't
+have to wait for cold queries.
+
+Requests go through the full middleware stack, so responses are stored by
+the page cache middleware under the current data version (see
+queries/middleware.py.)  Since the cache key includes the URL the clients use
+(scheme too,) pass the production site's URL as --base-url, eg.
+
+    ./manage.py warm_cache --base-url https://antmaps.org/api/v01
+
+(or the same --host, --script-name and --secure.)
+"""
+
+from multiprocessing import Pool
+from time import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.utils.http import urlencode
+
+from queries.models import Genus, Subfamily, Bentity, Species
+from queries.indexes import load_indexes
+from queries.dataversion import get_data_version
+
+
+
+
+def warm_paths(formats, prefix=''):
+    """
+    Generate the paths (with query strings) of every response to warm up.
+    """
+
+    subfamilies = list(Subfamily.objects.order_by('subfamily_name').values_list('subfamily_name', flat=True))
+    genera = list(Genus.objects.order_by('genus_name').values_list('genus_name', flat=True))
+    bentities = list(Bentity.objects.order_by('gid').values_list('gid', flat=True))
+    species = list(Species.objects.order_by('taxon_code').values_list('taxon_code', flat=True))
+
+    for format in formats:
+        def path(endpoint, **arguments):
+            return '%s/%s.%s%s' % (prefix, endpoint, format, '?' + urlencode(arguments) if arguments else '')
+
+        # list endpoints
+        yield path('subfamilies')
+        yield path('genera')
+        yield path('bentities')
+        for s in subfamilies:
+            yield path('genera', subfamily=s)
+            yield path('species', subfamily=s)
+        for g in genera:
+            yield path('species', genus=g)
+
+        # diversity modes
+        yield path('species-per-bentity')
+        for s in subfamilies:
+            yield path('species-per-bentity', subfamily=s)
+        for g in genera:
+            yield path('species-per-bentity', genus=g)
+        for b in bentities:
+            yield path('species-in-common', bentity_id=b)
+
+        # species mode
+        for s in species:
+            yield path('species-range', species=s)
+
+
+
+
+def site_options(options):
+    """
+    Return the (host, script name, secure) that the clients use, from the 
+    command's --base-url, or --host, --script-name and --secure.
+    """
+    
+    if not options['base_url']:
+        return (options['host'], options['script_name'], options['secure'])
+    
+    url = urlsplit(options['base_url'])
+    if url.scheme not in ('http', 'https') or not url.netloc:
+        raise CommandError('--base-url should be an http or https URL, eg. https://antmaps.org/api/v01')
+    return (url.netloc, url.path.rstrip('/'), url.scheme == 'https')
+
+
+
+
+_client = None
+_secure = False
+
+def _start_worker(host, script_name, secure):
+    global _client, _secure
+    defaults = {'HTTP_HOST': host, 'SCRIPT_NAME': script_name}
+    if secure and settings.SECURE_PROXY_SSL_HEADER:
+        # (the site is behind a proxy, which says the request was https)
+        header, value = settings.SECURE_PROXY_SSL_HEADER
+        defaults[header] = value
+    _client = Client(**defaults)
+    _secure = secure
+
+
+def _render(path):
+    """
+    Request 'path' in a worker process, and return (path, seconds, status, bytes.)
+    """
+
+    start = time()
+    response = _client.get(path, secure=_secure)
+    size = len(response.content) if not response.streaming else sum(len(chunk) for chunk in response.streaming_content)
+    return (path, time() - start, response.status_code, size)
+
+
+
+
+class Command(BaseCommand):
+    help = 'Fill the response cache for every genus, subfamily, bentity and species, using parallel worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4,
+            help='Number of worker processes (default 4)')
+        parser.add_argument('--host', default='antmaps.org',
+            help='Host name the clients use (part of the cache key, default antmaps.org)')
+        parser.add_argument('--script-name', default='',
+            help='URL prefix the API is served under, eg. /api/v01 (part of the cache key)')
+        parser.add_argument('--secure', action='store_true',
+            help='The clients use https (part of the cache key)')
+        parser.add_argument('--base-url',
+            help='URL the API is served at, eg. https://antmaps.org/api/v01, instead of --host, --script-name and --secure')
+        parser.add_argument('--path-prefix', default='',
+            help='Prefix for the API paths within the site, eg. /api/v01 when ANTMAPS_DEBUG is set')
+        parser.add_argument('--formats', nargs='+', default=['json'], choices=['json', 'csv'],
+            help='Which formats to warm up (default json)')
+        parser.add_argument('--slowest', type=int, default=10,
+            help='How many of the slowest responses to list (default 10)')
+
+
+    def handle(self, *args, **options):
+        site = site_options(options)
+
+        if 'locmem' in settings.CACHES.get('default', {}).get('BACKEND', 'locmem').lower():
+            self.stderr.write('Warning: the cache backend is in-process memory, so the warmed '
+                'responses will disappear with the worker processes.  Set ANTMAPS_USE_MEMCACHED.')
+
+        self.stdout.write('Warming cache for data version %s' % get_data_version())
+        paths = list(warm_paths(options['formats'], options['path_prefix']))
+
+        # build the in-memory indexes before forking, so the workers share them
+        load_indexes()
+
+        # worker processes can't share the parent's database connection
+        connections.close_all()
+
+        start = time()
+        results = []
+        pool = Pool(options['processes'], _start_worker, site)
+        try:
+            for i, result in enumerate(pool.imap_unordered(_render, paths, chunksize=16), 1):
+                results.append(result)
+                if i % 1000 == 0:
+                    self.stdout.write('%d/%d' % (i, len(paths)))
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time() - start
+
+
+        failed = [r for r in results if r[2] != 200]
+        self.stdout.write('Rendered %d responses (%.1f MB) in %.1f seconds, %.1f responses/second' % (
+            len(results), sum(r[3] for r in results) / 1e6, elapsed, len(results) / elapsed if elapsed else 0))
+
+        if failed:
+            self.stdout.write('%d failed:' % len(failed))
+            for path, seconds, status, size in failed[:options['slowest']]:
+                self.stdout.write('  %d %s' % (status, path))
+
+        self.stdout.write('Slowest:')
+        for path, seconds, status, size in sorted(results, key=lambda r: r[1], reverse=True)[:options['slowest']]:
+            self.stdout.write('  %7.3fs %9d bytes  %s' % (seconds, size, path))
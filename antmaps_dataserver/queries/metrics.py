@@ -0,0 +1,348 @@
+"""
+Per-request performance metrics for AntMaps.
+
+queries.middleware.MetricsMiddleware measures each request (see RequestStats):
+
+- the number of SQL queries, and the time spent in the database
+- the time spent serializing the response (JSON/CSV encoding, not counting
+  database time while reading rows)
+- the total time, and the response size
+
+and adds them to histograms in this module's registry, labeled with the
+request's endpoint (the start of its URL pattern, eg. "species-in-common".)
+The metrics view shows the registry in the Prometheus text format, to the
+clients in settings.ANTMAPS_METRICS_ALLOWED_IPS only.
+
+The registry is in-process, so with several server processes each one has its
+own (Prometheus adds them up across processes when it scrapes each one.)
+"""
+
+import re
+import threading
+from time import perf_counter
+
+from django.conf import settings
+from django.core.urlresolvers import get_resolver, RegexURLResolver, Resolver404
+from django.http import Http404, HttpResponse
+from django.views.decorators.cache import never_cache
+
+
+# histogram bucket upper bounds
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250)
+BYTES_BUCKETS = (1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+# name, help text, buckets
+HISTOGRAMS = (
+    ('antmaps_request_seconds', 'Time to handle a request (including streaming the response)', SECONDS_BUCKETS),
+    ('antmaps_request_db_seconds', 'Time spent in SQL queries during a request', SECONDS_BUCKETS),
+    ('antmaps_request_serialize_seconds', 'Time spent serializing the response, not counting SQL', SECONDS_BUCKETS),
+    ('antmaps_request_queries', 'Number of SQL queries per request', QUERY_BUCKETS),
+    ('antmaps_response_bytes', 'Response body size', BYTES_BUCKETS),
+)
+
+
+
+
+class Histogram(object):
+    """
+    Counts of observed values in cumulative buckets, plus the sum and count
+    (a Prometheus histogram.)
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+
+
+class Registry(object):
+    """
+    Histograms for each metric in HISTOGRAMS and each endpoint, and a count of
+    responses by endpoint and status code.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = dict((name, {}) for name, help, buckets in HISTOGRAMS)
+        self.responses = {}
+
+
+    def record(self, endpoint, stats):
+        """
+        Add a finished request's RequestStats to the histograms.
+        """
+
+        values = {
+            'antmaps_request_seconds': stats.total_seconds,
+            'antmaps_request_db_seconds': stats.db_seconds,
+            'antmaps_request_serialize_seconds': stats.serialize_seconds,
+            'antmaps_request_queries': stats.queries,
+            'antmaps_response_bytes': stats.bytes,
+        }
+
+        with self._lock:
+            for name, help, buckets in HISTOGRAMS:
+                histogram = self.histograms[name].get(endpoint)
+                if histogram is None:
+                    histogram = self.histograms[name][endpoint] = Histogram(buckets)
+                histogram.observe(values[name])
+
+            key = (endpoint, stats.status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+
+
+    def prometheus_text(self):
+        """
+        Return the registry in the Prometheus text exposition format.
+        """
+
+        lines = []
+        with self._lock:
+            lines.append('# HELP antmaps_responses_total Responses by endpoint and status code')
+            lines.append('# TYPE antmaps_responses_total counter')
+            for (endpoint, status), count in sorted(self.responses.items()):
+                lines.append('antmaps_responses_total{endpoint="%s",status="%d"} %d' % (_escape(endpoint), status, count))
+
+            for name, help, buckets in HISTOGRAMS:
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s histogram' % name)
+                for endpoint, histogram in sorted(self.histograms[name].items()):
+                    label = 'endpoint="%s"' % _escape(endpoint)
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (name, label, _number(bound), count))
+                    lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, label, histogram.count))
+                    lines.append('%s_sum{%s} %s' % (name, label, _number(histogram.sum)))
+                    lines.append('%s_count{%s} %d' % (name, label, histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+
+
+class RequestStats(object):
+    """
+    Measurements for one request.  The current request's stats are kept in a
+    thread-local (see current_stats,) so the database cursors and serializers
+    can add to them.
+    """
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.total_seconds = 0.0
+        self.bytes = 0
+        self.status = 0
+
+
+    def server_timing(self):
+        """
+        The Server-Timing header value for the measurements so far.
+        """
+
+        elapsed = perf_counter() - self.start
+        return 'db;dur=%.1f;desc="%d queries", serialize;dur=%.1f, app;dur=%.1f' % (
+            self.db_seconds * 1000, self.queries, self.serialize_seconds * 1000,
+            (elapsed - self.db_seconds - self.serialize_seconds) * 1000)
+
+
+_local = threading.local()
+
+
+def current_stats():
+    """
+    The RequestStats for the request being handled in this thread, or None.
+    """
+
+    return getattr(_local, 'stats', None)
+
+
+def set_current_stats(stats):
+    _local.stats = stats
+
+
+
+
+class serializing(object):
+    """
+    Context manager that adds the time spent inside it (minus any database
+    time) to the current request's serialization time.
+    """
+
+    def __enter__(self):
+        self.stats = current_stats()
+        if self.stats is not None:
+            self.start = perf_counter()
+            self.db_seconds = self.stats.db_seconds
+
+
+    def __exit__(self, *exc_info):
+        if self.stats is not None:
+            self.stats.serialize_seconds += (perf_counter() - self.start) - (self.stats.db_seconds - self.db_seconds)
+
+
+
+
+class TimedCursor(object):
+    """
+    Wraps a database cursor, counting queries and timing them (and fetches
+    from them) in the current request's stats.
+    """
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def _timed(self, method, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.stats.db_seconds += perf_counter() - start
+
+
+    def execute(self, *args, **kwargs):
+        self.stats.queries += 1
+        return self._timed(self.cursor.execute, *args, **kwargs)
+
+
+    def executemany(self, *args, **kwargs):
+        self.stats.queries += 1
+        return self._timed(self.cursor.executemany, *args, **kwargs)
+
+
+    def callproc(self, *args, **kwargs):
+        self.stats.queries += 1
+        return self._timed(self.cursor.callproc, *args, **kwargs)
+
+
+    def fetchone(self):
+        return self._timed(self.cursor.fetchone)
+
+
+    def fetchmany(self, *args, **kwargs):
+        return self._timed(self.cursor.fetchmany, *args, **kwargs)
+
+
+    def fetchall(self):
+        return self._timed(self.cursor.fetchall)
+
+
+
+
+def instrument_connection(connection):
+    """
+    Make the cursors of a database connection (django.db.connections[...])
+    count and time queries for the current request, if there is one.
+    """
+
+    if 'make_cursor' in connection.__dict__:
+        return  # already done
+
+    def instrumented(make):
+        def make_cursor(cursor):
+            wrapped = make(cursor)
+            stats = current_stats()
+            return wrapped if stats is None else TimedCursor(wrapped, stats)
+        return make_cursor
+
+    connection.make_cursor = instrumented(connection.make_cursor)
+    connection.make_debug_cursor = instrumented(connection.make_debug_cursor)
+
+
+
+
+_endpoints = None
+
+def endpoint_name(request):
+    """
+    Name of the endpoint a request is for: the literal start of its URL
+    pattern (with any include prefixes,) eg. "species-in-common" or "tiles".
+    """
+
+    global _endpoints
+    if _endpoints is None:
+        endpoints = {}
+        for view, name in _url_pattern_names(get_resolver()):
+            endpoints.setdefault(view, name)
+        _endpoints = endpoints
+
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        try:
+            match = get_resolver().resolve(request.path_info)
+        except Resolver404:
+            return 'unmatched'
+
+    return _endpoints.get(match.func, match.func.__name__)
+
+
+def _url_pattern_names(resolver, prefix=''):
+    """
+    Generate (view function, endpoint name) for every URL pattern.
+    """
+
+    for pattern in resolver.url_patterns:
+        regex = prefix + pattern.regex.pattern.lstrip('^')
+        if isinstance(pattern, RegexURLResolver):
+            yield from _url_pattern_names(pattern, regex)
+        else:
+            yield pattern.callback, re.match(r'[\w/-]*', regex).group(0).strip('/') or pattern.callback.__name__
+
+
+
+
+@never_cache
+def metrics(request):
+    """
+    Return the metrics registry in the Prometheus text format, if the client's
+    IP address is in settings.ANTMAPS_METRICS_ALLOWED_IPS.  (The endpoint and
+    query counts are only for the people running the server, so to everyone 
+    else there's no such page.)
+    """
+
+    if request.META.get('REMOTE_ADDR') not in settings.ANTMAPS_METRICS_ALLOWED_IPS:
+        raise Http404('No metrics for this client')
+
+    return HttpResponse(registry.prometheus_text(), content_type='text/plain; version=0.0.4')
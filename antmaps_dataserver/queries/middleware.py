@@ -0,0 +1,328 @@
+"""
+Middleware for AntMaps.
+
+MetricsMiddleware measures the SQL queries, serialization time and response
+size of each request (see queries/metrics.py.)
+
+The page cache middleware here is Django's, with two additions:
+
+- the data version is part of the cache keys, so pages cached before a data
+  refresh aren't served after it
+- responses are compressed (gzip, and brotli if the brotli package is 
+  installed) once, when they're stored in the cache, and the stored 
+  encodings are served to clients that accept them, so cache hits don't 
+  spend any CPU on compression
+- streaming responses are cached too, if they turn out to be at most 
+  settings.ANTMAPS_CACHE_STREAMING_MAX_BYTES long: a copy of the body is kept
+  as it's sent, and stored when the last of it has been sent
+"""
+
+import gzip
+import re
+
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+from django.middleware import cache
+from django.utils.cache import get_max_age, has_vary_header, learn_cache_key, patch_response_headers, patch_vary_headers
+
+from queries.dataversion import get_data_version
+from queries import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# don't bother compressing responses smaller than this (in bytes)
+MIN_COMPRESS_LENGTH = 200
+
+# content encodings we can store, most preferred first
+ENCODINGS = ('br', 'gzip')
+
+
+
+
+def compress(content):
+    """
+    Return a dict of content encoding -> compressed 'content', for each 
+    encoding that makes 'content' smaller.
+    """
+    
+    encodings = {'gzip': gzip.compress(content, 9)}
+    if brotli is not None:
+        encodings['br'] = brotli.compress(content)
+    
+    return dict((coding, body) for coding, body in encodings.items() if len(body) < len(content))
+
+
+
+
+def accepted_encodings(request):
+    """
+    Return a dict of content coding -> q value from the request's 
+    Accept-Encoding header.
+    """
+    
+    accepted = {}
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        match = re.match(r'^\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([\d.]+))?\s*$', part)
+        if match:
+            try:
+                accepted[match.group(1).lower()] = float(match.group(2) or 1)
+            except ValueError:
+                pass
+    return accepted
+
+
+
+
+def encoded_etag(etag, coding):
+    """
+    Return the ETag for the 'coding' encoded body of a response with ETag
+    'etag'.  It's still a strong validator (a weak one, W/"...", would never
+    match If-None-Match in ConditionalGetMiddleware,) but a different one for
+    each encoding, since the bytes are different.
+    
+    (On a cache miss, the view's ETag doesn't match the encoded one a client
+    sends back, so the client gets the whole response once, from which the 
+    cache is filled again.)
+    """
+    
+    if etag.startswith('"') and etag.endswith('"'):
+        return '"%s-%s"' % (etag[1:-1], coding)
+    return '%s-%s' % (etag, coding)
+
+
+
+
+def encode_response(request, response):
+    """
+    If 'response' has precompressed bodies (see compress) and the client 
+    accepts one of their encodings, swap the body for the compressed one.
+    """
+    
+    encodings = getattr(response, 'precompressed', None)
+    if encodings is None:
+        return response
+    
+    patch_vary_headers(response, ('Accept-Encoding',))
+    
+    accepted = accepted_encodings(request)
+    for coding in ENCODINGS:
+        if coding in encodings and accepted.get(coding, accepted.get('*', 0)) > 0:
+            response.content = encodings[coding]
+            response['Content-Encoding'] = coding
+
+            # (ConditionalGetMiddleware set it from the uncompressed body)
+            if response.has_header('Content-Length'):
+                response['Content-Length'] = str(len(response.content))
+
+            if response.has_header('ETag'):
+                response['ETag'] = encoded_etag(response['ETag'], coding)
+            break
+    
+    # (a cached response comes through here again in UpdateCacheMiddleware)
+    response.precompressed = None
+    return response
+
+
+
+
+class DataVersionKeyPrefixMixin(object):
+    """
+    Adds the current data version to the cache middleware's key prefix, so 
+    pages cached before a data refresh aren't served after it.
+    """
+    
+    @property
+    def key_prefix(self):
+        return '%s:%s' % (self._key_prefix, get_data_version())
+    
+    @key_prefix.setter
+    def key_prefix(self, value):
+        self._key_prefix = value
+
+
+
+
+class UpdateCacheMiddleware(DataVersionKeyPrefixMixin, cache.UpdateCacheMiddleware):
+    """
+    django.middleware.cache.UpdateCacheMiddleware, with the data version in 
+    the cache keys, that stores compressed copies of the response body along
+    with the response.
+    """
+    
+    def process_response(self, request, response):
+        if response.streaming:
+            return self._cache_streaming_response(request, response)
+        
+        if self._should_update_cache(request, response) and response.status_code == 200 and get_max_age(response) != 0:
+            self._precompress(response)
+        
+        response = super(UpdateCacheMiddleware, self).process_response(request, response)
+        
+        # (the uncompressed response is already in the cache)
+        return encode_response(request, response)
+    
+    
+    @staticmethod
+    def _precompress(response):
+        if not response.has_header('Content-Encoding') and len(response.content) >= MIN_COMPRESS_LENGTH:
+            response.precompressed = compress(response.content)
+    
+    
+    def _cache_streaming_response(self, request, response):
+        """
+        The same checks as Django's UpdateCacheMiddleware.process_response,
+        for a streaming response: if it can be cached, keep a copy of its 
+        content as it's sent (see _tee.)
+        """
+        
+        if (not self._should_update_cache(request, response) or response.status_code != 200
+                or settings.ANTMAPS_CACHE_STREAMING_MAX_BYTES <= 0):
+            return response
+        
+        # (the cache would answer Range requests with the whole response)
+        if response.has_header('Accept-Ranges'):
+            return response
+        
+        if not request.COOKIES and response.cookies and has_vary_header(response, 'Cookie'):
+            return response
+        
+        timeout = get_max_age(response)
+        if timeout is None:
+            timeout = self.cache_timeout
+        elif timeout == 0:
+            return response
+        patch_response_headers(response, timeout)
+        if timeout:
+            cache_key = learn_cache_key(request, response, timeout, self.key_prefix, cache=self.cache)
+            # (the headers now, before the middleware above this one adds any)
+            headers = list(response.items())
+            response.streaming_content = self._tee(response.streaming_content, headers, cache_key, timeout)
+        return response
+    
+    
+    def _tee(self, content, headers, cache_key, timeout):
+        """
+        Pass through a streaming response's content, keeping a copy of it
+        until it's more than ANTMAPS_CACHE_STREAMING_MAX_BYTES long.  If the 
+        whole response fit, cache it (as a regular response, precompressed) 
+        after the last chunk has been sent.  If the client goes away before 
+        the end, nothing is cached.
+        """
+        
+        chunks = []
+        size = 0
+        for chunk in content:
+            if chunks is not None:
+                size += len(chunk)
+                if size > settings.ANTMAPS_CACHE_STREAMING_MAX_BYTES:
+                    chunks = None  # too big, stop keeping a copy
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        
+        if chunks is not None:
+            response = HttpResponse(b''.join(chunks))
+            for header, value in headers:
+                response[header] = value
+            self._precompress(response)
+            self.cache.set(cache_key, response, timeout)
+
+
+
+
+class FetchFromCacheMiddleware(DataVersionKeyPrefixMixin, cache.FetchFromCacheMiddleware):
+    """
+    django.middleware.cache.FetchFromCacheMiddleware, with the data version in 
+    the cache keys, that serves the precompressed body stored with the
+    cached response if the client accepts it.
+    """
+    
+    def process_request(self, request):
+        response = super(FetchFromCacheMiddleware, self).process_request(request)
+        if response is not None:
+            response = encode_response(request, response)
+        return response
+
+
+
+
+class MetricsMiddleware(object):
+    """
+    Measures each request (number of SQL queries, database time, serialization
+    time, response size,) adds a Server-Timing header with the measurements,
+    and records them in queries.metrics.registry by endpoint.
+    
+    Put this first in MIDDLEWARE_CLASSES, so it also measures requests answered
+    from the cache, and so the Server-Timing header isn't stored in the cache.
+    
+    A streaming response is recorded when the last of it has been sent, but its
+    Server-Timing header can only have the measurements from before the 
+    response started.
+    """
+    
+    def process_request(self, request):
+        for connection in connections.all():
+            metrics.instrument_connection(connection)
+        metrics.set_current_stats(metrics.RequestStats())
+    
+    
+    def process_response(self, request, response):
+        stats = metrics.current_stats()
+        metrics.set_current_stats(None)
+        if stats is None:
+            return response
+        
+        stats.status = response.status_code
+        response['Server-Timing'] = stats.server_timing()
+        endpoint = metrics.endpoint_name(request)
+        
+        if response.streaming:
+            response.streaming_content = self._measure_stream(response.streaming_content, stats, endpoint)
+        else:
+            stats.bytes = len(response.content)
+            stats.total_seconds = perf_counter() - stats.start
+            metrics.registry.record(endpoint, stats)
+        
+        return response
+    
+    
+    @staticmethod
+    def _measure_stream(content, stats, endpoint):
+        """
+        Pass through a streaming response's content, timing the work to make
+        each chunk (minus database time) as serialization, and record the stats
+        at the end.
+        """
+        
+        try:
+            for chunk in MetricsMiddleware._timed_chunks(content, stats):
+                stats.bytes += len(chunk)
+                yield chunk
+        finally:
+            stats.total_seconds = perf_counter() - stats.start
+            metrics.registry.record(endpoint, stats)
+    
+    
+    @staticmethod
+    def _timed_chunks(content, stats):
+        content = iter(content)
+        while True:
+            # (the stats are only current while making the chunk, not while 
+            # the server sends it)
+            metrics.set_current_stats(stats)
+            try:
+                with metrics.serializing():
+                    chunk = next(content)
+            except StopIteration:
+                return
+            finally:
+                metrics.set_current_stats(None)
+            yield chunk
+
@@ -0,0 +1,182 @@
+"""
+Compact binary encoding for species points (the species-points.bin format.)
+
+The JSON and CSV formats repeat every field name (JSON) and the species and
+bentity name (both) for every point, and send coordinates as strings.  This
+format sends each field as a column of little-endian typed values, so the
+front end can read it straight into JavaScript typed arrays.  All multi-byte
+columns start on a 4-byte boundary.
+
+Layout (n = number of points):
+
+    offset  type          contents
+    0       4 bytes       magic number b'AMPB'
+    4       uint16        format version (1)
+    6       uint16        reserved (0)
+    8       uint32        n
+    12      uint32        coordinate scale (lat/lon = value / scale)
+    16      int32[n]      latitude deltas
+            int32[n]      longitude deltas
+            uint32[n]     num_records
+            uint32[n]     literature_count
+            uint32[n]     museum_count
+            uint32[n]     database_count
+            uint16[n]     bentity, as an index into the bentity table
+            uint8[n]      status, as an index into the status table
+            0-3 bytes     zero padding to a 4-byte boundary
+            uint32        length of the table JSON, in bytes
+            UTF-8 JSON    {"species": taxon code,
+                           "bentities": [[bentity_id, bentity_name], ...],
+                           "statuses": [status, ...]}
+
+Coordinates are quantized to integers (round(degrees * scale)) and each
+point's latitude and longitude is stored as the difference from the previous
+point's (the first point's from 0,) with points sorted by latitude and then
+longitude so the latitude deltas stay small.  Decode with a running sum.
+"""
+
+import json
+import struct
+from array import array
+from sys import byteorder
+
+
+MAGIC = b'AMPB'
+VERSION = 1
+
+# 1e-5 degrees is about 1 meter
+COORDINATE_SCALE = 100000
+
+CONTENT_TYPE = 'application/octet-stream'
+
+
+
+
+def _column(typecode, values):
+    """
+    Return 'values' packed as a little-endian array of 'typecode'.
+    """
+
+    column = array(typecode, values)
+    if byteorder != 'little':
+        column.byteswap()
+    return column.tobytes()
+
+
+
+
+def encode_points(species, rows, scale=COORDINATE_SCALE):
+    """
+    Return the binary encoding (bytes) of a species' points.
+
+    'rows' is an iterable of (lat, lon, status, bentity_id, bentity_name,
+    num_records, literature_count, museum_count, database_count) tuples, with
+    lat and lon as strings or numbers.  Points with coordinates that aren't
+    numbers, or are off the globe (so they might not fit in the int32
+    columns,) are left out.
+    """
+
+    bentities = {}  # bentity_id -> index into the bentity table
+    bentity_table = []
+    statuses = {}  # status -> index into the status table
+    points = []
+
+    for lat, lon, status, bentity_id, bentity_name, num_records, literature_count, museum_count, database_count in rows:
+        try:
+            lat = int(round(float(lat) * scale))
+            lon = int(round(float(lon) * scale))
+        except (TypeError, ValueError, OverflowError):  # (None, NaN, infinity)
+            continue
+
+        if not (-90 * scale <= lat <= 90 * scale and -180 * scale <= lon <= 180 * scale):
+            continue
+
+        if bentity_id not in bentities:
+            bentities[bentity_id] = len(bentity_table)
+            bentity_table.append([bentity_id, bentity_name])
+
+        if status not in statuses:
+            statuses[status] = len(statuses)
+
+        points.append((lat, lon, bentities[bentity_id], statuses[status],
+            int(num_records or 0), int(literature_count or 0), int(museum_count or 0), int(database_count or 0)))
+
+    points.sort()
+
+    lat_deltas = []
+    lon_deltas = []
+    previous_lat = previous_lon = 0
+    for p in points:
+        lat_deltas.append(p[0] - previous_lat)
+        lon_deltas.append(p[1] - previous_lon)
+        previous_lat, previous_lon = p[0], p[1]
+
+    n = len(points)
+    parts = [
+        MAGIC,
+        struct.pack('<HHII', VERSION, 0, n, scale),
+        _column('i', lat_deltas),
+        _column('i', lon_deltas),
+        _column('I', [p[4] for p in points]),
+        _column('I', [p[5] for p in points]),
+        _column('I', [p[6] for p in points]),
+        _column('I', [p[7] for p in points]),
+        _column('H', [p[2] for p in points]),
+        _column('B', [p[3] for p in points]),
+        b'\0' * (-(3 * n) % 4),  # after the uint16 and uint8 columns
+    ]
+
+    tables = json.dumps({
+        'species': species,
+        'bentities': bentity_table,
+        'statuses': sorted(statuses, key=statuses.get),
+    }).encode('utf-8')
+
+    parts.append(struct.pack('<I', len(tables)))
+    parts.append(tables)
+
+    return b''.join(parts)
+
+
+
+
+def decode_points(data):
+    """
+    Decode bytes from encode_points() back into (species, rows), with rows as
+    (lat, lon, status, bentity_id, bentity_name, num_records,
+    literature_count, museum_count, database_count) tuples with float
+    coordinates.  (The inverse of encode_points, for testing and for Python
+    clients.)
+    """
+
+    if data[:4] != MAGIC:
+        raise ValueError('Not an AntMaps points payload')
+
+    version, reserved, n, scale = struct.unpack_from('<HHII', data, 4)
+    if version != VERSION:
+        raise ValueError('Unsupported points format version %d' % version)
+
+    offset = 16
+    columns = []
+    for typecode in 'iiIIIIHB':
+        column = array(typecode)
+        column.frombytes(data[offset:offset + n * column.itemsize])
+        if byteorder != 'little':
+            column.byteswap()
+        columns.append(column)
+        offset += n * column.itemsize
+    offset += -offset % 4
+
+    length, = struct.unpack_from('<I', data, offset)
+    tables = json.loads(data[offset + 4:offset + 4 + length].decode('utf-8'))
+
+    rows = []
+    lat = lon = 0
+    for i in range(n):
+        lat += columns[0][i]
+        lon += columns[1][i]
+        bentity_id, bentity_name = tables['bentities'][columns[6][i]]
+        rows.append((lat / scale, lon / scale, tables['statuses'][columns[7][i]], bentity_id, bentity_name,
+            columns[2][i], columns[3][i], columns[4][i], columns[5][i]))
+
+    return tables['species'], rows
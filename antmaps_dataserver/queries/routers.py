@@ -0,0 +1,138 @@
+"""
+Database router that sends the AntMaps queries to read replicas.
+
+The read replicas are the databases in settings.DATABASES named "replica1",
+"replica2", ... (see ANTMAPS_DB_REPLICAS in settings.py.)  Every read of the
+queries app's models goes to one of them, and everything else (writes, and the
+other apps) goes to "default", the primary that GABI loads data into.
+
+Each process reads from one replica at a time (spread across processes by
+process ID,) so the data version and the in-process indexes (see
+queries/dataversion.py and queries/indexes.py) come from the same database.
+Connections are persistent (settings.CONN_MAX_AGE,) one per thread, so the
+pool of connections in each process is bounded by its number of threads.
+
+Each thread's replica connection is health-checked before it's used, at most
+every settings.ANTMAPS_DB_HEALTH_CHECK_SECONDS seconds.  If a replica can't
+be reached, it's skipped for ANTMAPS_DB_RETRY_SECONDS and the process fails
+over to the next replica (or the primary, if none are up,) then goes back
+to its own replica once it's up again.
+"""
+
+import logging
+import os
+import threading
+from time import time
+
+from django.conf import settings
+from django.db import connections, DatabaseError
+
+
+logger = logging.getLogger(__name__)
+
+
+
+
+def replica_aliases():
+    """
+    Names of the read replicas in settings.DATABASES, in order.
+    """
+
+    replicas = [alias for alias in settings.DATABASES if alias.startswith('replica')]
+    return sorted(replicas, key=lambda alias: int(alias[len('replica'):] or 0))
+
+
+
+
+class ReplicaRouter(object):
+    """
+    Routes reads of the queries app's models to a healthy read replica.
+    """
+
+    def __init__(self):
+        self.replicas = replica_aliases()
+        self.preferred = os.getpid() % len(self.replicas) if self.replicas else 0
+        self._lock = threading.Lock()
+        self._down_until = {}
+        self._local = threading.local()
+
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'queries' or not self.replicas:
+            return None
+        return self.healthy_replica()
+
+
+    def db_for_write(self, model, **hints):
+        return None
+
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get their schema from the primary
+        return False if db in self.replicas else None
+
+
+    def healthy_replica(self):
+        """
+        Return this process's replica if it's up, otherwise the next replica
+        that's up, or "default" (the primary) if none of them are.
+        """
+
+        now = time()
+        for i in range(len(self.replicas)):
+            alias = self.replicas[(self.preferred + i) % len(self.replicas)]
+            if self._down_until.get(alias, 0) > now:
+                continue
+
+            if self._check(alias, now):
+                return alias
+
+            with self._lock:
+                self._down_until[alias] = now + settings.ANTMAPS_DB_RETRY_SECONDS
+            logger.warning("Database replica '%s' is down, retrying in %d seconds", alias, settings.ANTMAPS_DB_RETRY_SECONDS)
+
+        return 'default'
+
+
+    def status(self):
+        """
+        Return a dict of replica alias -> seconds until it's retried (0 if
+        it's up.)
+        """
+
+        now = time()
+        return dict((alias, max(0, self._down_until.get(alias, 0) - now)) for alias in self.replicas)
+
+
+    def _check(self, alias, now):
+        """
+        Make sure this thread's connection to 'alias' works (connecting if it
+        isn't connected,) and return whether it does.
+        """
+
+        connection = connections[alias]
+        checked = self._local.__dict__.setdefault('checked', {})
+
+        if connection.in_atomic_block:
+            return True  # (mid-transaction, eg. reading from a server-side cursor)
+
+        if connection.connection is not None and now - checked.get(alias, 0) < settings.ANTMAPS_DB_HEALTH_CHECK_SECONDS:
+            return True
+
+        try:
+            if connection.connection is not None and not connection.is_usable():
+                connection.close()
+            connection.ensure_connection()
+        except DatabaseError:
+            try:
+                connection.close()
+            except DatabaseError:
+                pass
+            return False
+
+        checked[alias] = now
+        return True
@@ -0,0 +1,51 @@
+"""
+The tables and materialized views that AntMaps reads from (see 
+queries/models.py,) with SQLite-compatible column definitions, for making 
+local copies of them (see the make_synthetic_data and export_snapshot 
+commands.)
+"""
+
+import re
+
+
+# (table, column definitions) for each table, with the columns in 
+# queries/models.py (map_bentity_count is only used with raw SQL in 
+# queries/views.py)
+TABLES = (
+    ('subfamily', '"subfamily_name" text PRIMARY KEY'),
+    ('genus', '"id" integer PRIMARY KEY, "genus_name" text UNIQUE, "subfamily_name" text'),
+    ('species', '"taxon_code" text PRIMARY KEY, "genus_name" text, "species_name" text'),
+    ('map_taxonomy_list', '"taxon_code" text PRIMARY KEY, "subfamily_name" text, "genus_name" text, "species_name" text'),
+    ('bentity2', '"bentity2_id" text PRIMARY KEY, "bentity2_name" text'),
+    ('map_record', '"gabi_acc_number" text PRIMARY KEY, "dec_lat" text, "dec_long" text, '
+        '"valid_species_name" text, "bentity2_id" text, "antmaps_category" text, '
+        '"type_of_data" text, "citation" text, "short_citation" text'),
+    ('map_species_points', '"gabi_acc_number" text PRIMARY KEY, "dec_lat" text, "dec_long" text, '
+        '"valid_species_name" text, "bentity2_id" text, "category" text, "num_records" integer, '
+        '"literature_count" integer, "museum_count" integer, "database_count" integer'),
+    ('map_species_bentity_pair', '"subfamily_name" text, "genus_name" text, "valid_species_name" text, '
+        '"bentity2_id" text, "category" text, "num_records" integer, "literature_count" integer, '
+        '"museum_count" integer, "database_count" integer'),
+    ('map_bentity_count', '"bentity2_id" text, "species_count" integer, "num_records" integer, '
+        '"literature_count" integer, "museum_count" integer, "database_count" integer'),
+)
+
+INDEXES = (
+    ('map_record', 'valid_species_name'),
+    ('map_record', 'bentity2_id'),
+    ('map_species_points', 'valid_species_name'),
+    ('map_species_bentity_pair', 'valid_species_name'),
+    ('map_species_bentity_pair', 'bentity2_id'),
+    ('map_species_bentity_pair', 'genus_name'),
+    ('map_species_bentity_pair', 'subfamily_name'),
+)
+
+
+
+
+def column_names(columns):
+    """
+    Return the names of the columns in a TABLES column definition string.
+    """
+
+    return re.findall(r'(?:^|, )"(\w+)"', columns)
@@ -0,0 +1,150 @@
+"""
+Fast JSON and CSV serialization for query results.
+
+The views read rows from the database as tuples (values_list or raw cursors.)
+Turning each row into a dict and running json.dumps or csv.DictWriter over it
+spends most of the time for large responses building and walking those dicts.
+The encoders here write rows straight from the tuples instead:
+
+- ObjectEncoder writes a row as a JSON object, from fragments for the keys
+  that are encoded once, and values encoded with the same (C-accelerated)
+  functions json.dumps uses, so the output is byte-for-byte the same as
+  json.dumps({key: value, ...}).
+- Strings that repeat across many rows (species, bentity ID's and names,
+  statuses) can be encoded once per process and reused, see encode_cached.
+- csv_row_getter picks the CSV fields out of a row tuple in order, for
+  csv.writer, which writes the same output as csv.DictWriter.
+"""
+
+import json
+from json.encoder import encode_basestring_ascii
+from operator import itemgetter
+
+
+# Most strings to keep in the encode_cached fragment cache.  (The cache is
+# emptied when it's full, which is simpler than LRU and fine for strings that
+# repeat this much.)
+MAX_CACHED_FRAGMENTS = 100000
+
+_fragments = {}
+
+
+
+
+def _encode_float(value):
+    # the same as json.dumps
+    if value != value:
+        return 'NaN'
+    elif value == float('inf'):
+        return 'Infinity'
+    elif value == float('-inf'):
+        return '-Infinity'
+    return float.__repr__(value)
+
+
+_encoders = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    float: _encode_float,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+}
+
+
+def encode_value(value):
+    """
+    Return the JSON for 'value', the same as json.dumps(value).
+    """
+
+    encoder = _encoders.get(type(value))
+    if encoder is None:
+        return json.dumps(value)
+    return encoder(value)
+
+
+
+
+def encode_cached(value):
+    """
+    Like encode_value, but keeps the JSON for strings in a process-wide cache,
+    for values that repeat in many rows (eg. bentity names.)
+    """
+
+    if type(value) is not str:
+        return encode_value(value)
+
+    try:
+        return _fragments[value]
+    except KeyError:
+        if len(_fragments) >= MAX_CACHED_FRAGMENTS:
+            _fragments.clear()
+        fragment = _fragments[value] = encode_basestring_ascii(value)
+        return fragment
+
+
+
+
+class ObjectEncoder(object):
+    """
+    Encodes row tuples as JSON objects.
+
+    'fields' are the keys of the object, and 'columns' the index in the row
+    tuple of each key's value (by default, the keys are the row's columns in
+    order.)  Values for the keys in 'cached' are encoded with encode_cached.
+
+    ObjectEncoder(fields, columns)(row) is byte-for-byte the same as
+    json.dumps(dict((f, row[c]) for f, c in zip(fields, columns))) (with the
+    keys in order.)
+    """
+
+    def __init__(self, fields, columns=None, cached=()):
+        if columns is None:
+            columns = range(len(fields))
+
+        self.parts = []
+        separator = '{'
+        for field, column in zip(fields, columns):
+            self.parts.append((
+                separator + encode_basestring_ascii(field) + ': ',
+                column,
+                encode_cached if field in cached else encode_value ))
+            separator = ', '
+
+
+    def __call__(self, row):
+        if not self.parts:
+            return '{}'
+
+        out = []
+        for prefix, column, encode in self.parts:
+            out.append(prefix)
+            out.append(encode(row[column]))
+        out.append('}')
+        return ''.join(out)
+
+
+
+
+def encode_object_list(key, rows, encoder, extra=()):
+    """
+    Return {key: [object, object, ...]} as JSON, with an object for each row
+    encoded by 'encoder' (the same as json.dumps of the dict.)  'extra' is a
+    list of (key, value) pairs to add after the list.
+    """
+
+    return ('{' + encode_basestring_ascii(key) + ': [' + ', '.join(encoder(row) for row in rows) + ']'
+        + ''.join(', ' + encode_basestring_ascii(k) + ': ' + json.dumps(v) for k, v in extra) + '}')
+
+
+
+
+def csv_row_getter(columns):
+    """
+    Return a function that picks the CSV fields out of a row tuple, in order.
+    'columns' is the index in the row tuple of each CSV field.
+    """
+
+    if len(columns) == 1:
+        column = columns[0]
+        return lambda row: (row[column],)
+    return itemgetter(*columns)
@@ -0,0 +1,342 @@
+"""
+Read-only arrays in a memory-mapped file, shared by every process that maps it.
+
+The in-process indexes (see queries/indexes.py) are built from the database
+by each worker process, and take up memory in every one of them.  Instead,
+an index can be written once as a "segment" file of flat arrays, which every
+worker maps read-only: the data is in the OS page cache once for all of the
+processes, and attaching to it is nearly instant.
+
+A segment holds named arrays of:
+
+- str (or None): UTF-8 text, with an array of offsets (StringArray)
+- int: 64-bit integers (a memoryview)
+- lists of ints: flattened, with an array of offsets (RaggedArray)
+- bytes (a memoryview)
+
+The classes here act like (read-only) lists, so the index classes can use
+them the same way as lists built in-process.
+
+SharedSegments keeps one segment per index name and data version in a
+directory, and builds it (in one process at a time) if it isn't there.  A
+new version is written to a temporary file and renamed into place, so a
+process attaching to it always sees a whole file.
+"""
+
+import json
+import mmap
+import os
+import re
+import struct
+from bisect import bisect_left
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # (no locking, so processes may build the same segment at once)
+
+
+MAGIC = b'ANTMAPS-SEGMENT1'
+
+# (the native byte order and 64-bit integers, since a segment is only read on
+# the machine that wrote it)
+INT_FORMAT = 'q'
+
+# How many versions of each segment to keep, so processes that haven't
+# noticed a new data version yet can still attach to the one they need
+KEEP_VERSIONS = 2
+
+
+
+
+class StringArray(object):
+    """
+    A read-only sequence of strings (or None) stored as UTF-8 text, with the
+    start of each string in 'offsets' (one more offset than strings.)
+    """
+
+    def __init__(self, offsets, text, nulls=()):
+        self.offsets = offsets
+        self.text = text
+        self.nulls = frozenset(nulls)
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if i in self.nulls:
+            return None
+        return str(self.text[self.offsets[i]:self.offsets[i+1]], 'utf-8')
+
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+
+
+class RaggedArray(object):
+    """
+    A read-only sequence of int sequences, stored as one flat array of ints
+    with the start of each sequence in 'offsets' (one more offset than
+    sequences.)
+    """
+
+    def __init__(self, offsets, values):
+        self.offsets = offsets
+        self.values = values
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+
+
+class SortedMap(object):
+    """
+    A read-only mapping over a sorted sequence of keys and a sequence of
+    values in the same order (eg. arrays in a segment,) looked up by binary
+    search.
+    """
+
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        Make a SortedMap from (key, value) pairs in any order.
+        """
+
+        items = sorted(items)
+        return cls([k for k, v in items], [v for k, v in items])
+
+
+    def _find(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+
+    def get(self, key, default=None):
+        try:
+            i = self._find(key)
+        except TypeError:  # (eg. None can't be compared to strings)
+            return default
+        return default if i is None else self.values[i]
+
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        return self.values[i]
+
+
+    def __contains__(self, key):
+        try:
+            return self._find(key) is not None
+        except TypeError:
+            return False
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+
+
+def write_segment(path, arrays):
+    """
+    Write a dict of name -> array (a list of str/None, a list of ints, a list
+    of lists of ints, or bytes) to a segment file at 'path', replacing it
+    atomically.
+    """
+
+    header = {}
+    sections = []
+    offset = 0
+
+    def add(data):
+        nonlocal offset
+        start = offset
+        sections.append(data)
+        offset += len(data)
+        padding = -offset % 8
+        if padding:
+            sections.append(b'\0' * padding)
+            offset += padding
+        return start
+
+    def add_ints(values):
+        return add(struct.pack('=%d%s' % (len(values), INT_FORMAT), *values))
+
+    for name, array in sorted(arrays.items()):
+        if isinstance(array, (bytes, bytearray)):
+            header[name] = {'kind': 'bytes', 'start': add(bytes(array)), 'length': len(array)}
+
+        elif array and all(isinstance(v, int) for v in array):
+            header[name] = {'kind': 'int', 'start': add_ints(array), 'length': len(array)}
+
+        elif array and all(isinstance(v, (list, tuple)) for v in array):
+            offsets = [0]
+            for values in array:
+                offsets.append(offsets[-1] + len(values))
+            header[name] = {'kind': 'ragged', 'length': len(array),
+                'offsets': add_ints(offsets), 'start': add_ints([v for values in array for v in values])}
+
+        else:
+            encoded = [(s or '').encode('utf-8') for s in array]
+            offsets = [0]
+            for s in encoded:
+                offsets.append(offsets[-1] + len(s))
+            header[name] = {'kind': 'str', 'length': len(array),
+                'nulls': [i for i, s in enumerate(array) if s is None],
+                'offsets': add_ints(offsets), 'start': add(b''.join(encoded))}
+
+    header = json.dumps(header).encode('utf-8')
+    preamble = MAGIC + struct.pack('=Q', len(header)) + header
+    preamble += b'\0' * (-len(preamble) % 8)
+
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(preamble)
+        for data in sections:
+            f.write(data)
+    os.replace(temp_path, path)
+
+
+
+
+class Segment(object):
+    """
+    A segment file mapped read-only.  segment[name] is the array 'name'.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a segment file' % path)
+
+        header_length, = struct.unpack_from('=Q', self.mmap, len(MAGIC))
+        header_start = len(MAGIC) + 8
+        self.header = json.loads(self.mmap[header_start:header_start + header_length].decode('utf-8'))
+        self.data_start = header_start + header_length + (-(header_start + header_length) % 8)
+        self.view = memoryview(self.mmap)
+
+
+    def _ints(self, start, length):
+        start += self.data_start
+        return self.view[start:start + length * 8].cast(INT_FORMAT)
+
+
+    def __getitem__(self, name):
+        entry = self.header[name]
+        kind = entry['kind']
+
+        if kind == 'bytes':
+            start = self.data_start + entry['start']
+            return self.view[start:start + entry['length']]
+
+        elif kind == 'int':
+            return self._ints(entry['start'], entry['length'])
+
+        elif kind == 'ragged':
+            offsets = self._ints(entry['offsets'], entry['length'] + 1)
+            return RaggedArray(offsets, self._ints(entry['start'], offsets[-1]))
+
+        else:
+            offsets = self._ints(entry['offsets'], entry['length'] + 1)
+            start = self.data_start + entry['start']
+            return StringArray(offsets, self.view[start:start + offsets[-1]], entry['nulls'])
+
+
+    def __contains__(self, name):
+        return name in self.header
+
+
+
+
+class SharedSegments(object):
+    """
+    Segment files in 'directory', one for each index name and data version.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+
+    def path(self, name, version):
+        # (a pinned data version could be any string)
+        version = re.sub(r'[^\w.]', '_', str(version))
+        return os.path.join(self.directory, '%s-%s.segment' % (name, version))
+
+
+    def attach(self, name, version, build):
+        """
+        Return the Segment for 'name' at data version 'version'.  If there
+        isn't one yet, call 'build' (which returns a dict of arrays for
+        write_segment) to make it, in one process at a time.
+        """
+
+        path = self.path(name, version)
+        try:
+            return Segment(path)
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '%s.lock' % name), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # another process may have built it while we waited
+            if not os.path.exists(path):
+                write_segment(path, build())
+                self._remove_old_versions(name)
+
+        return Segment(path)
+
+
+    def _remove_old_versions(self, name):
+        """
+        Delete all but the newest KEEP_VERSIONS segments for 'name'.  (Processes
+        that have them mapped keep them until they let go of them.)
+        """
+
+        prefix = name + '-'
+        paths = [os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                 if f.startswith(prefix) and f.endswith('.segment')]
+        for path in sorted(paths, key=os.path.getmtime, reverse=True)[KEEP_VERSIONS:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,144 @@
+"""
+Read-only snapshots of the AntMaps data, for serving the API without Postgres.
+
+export_snapshot() copies the tables and materialized views that the API reads
+(see queries/schema.py) into one SQLite file, with the indexes the views use
+and the data version it was made from.  When settings.ANTMAPS_SNAPSHOT is set
+to the path of a snapshot, the snapshot is the (read-only) database, so every
+endpoint works as usual without a database server: queries are answered
+in-process from the file, which SQLite reads through a memory map (see
+configure_connection,) so the worker processes on a machine share one copy
+of it in the OS page cache.
+
+The data version of a snapshot is the version of the database it was made
+from, so ETags and cached responses are the same on snapshot and database
+servers with the same data.
+"""
+
+import os
+import sqlite3
+from decimal import Decimal
+from itertools import islice
+from time import gmtime, strftime
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from queries.schema import TABLES, INDEXES, column_names
+from queries.dataversion import get_data_version, invalidate_data_version
+from queries.views import server_side_sql_rows
+
+
+# the table with the snapshot's data version, and when it was made
+SNAPSHOT_INFO_TABLE = 'snapshot_info'
+
+# rows per INSERT batch
+BATCH_SIZE = 5000
+
+# (the same as Django's SQLite backend, for numeric columns)
+sqlite3.register_adapter(Decimal, str)
+
+
+
+
+def export_snapshot(path, using='default', progress=None):
+    """
+    Write a snapshot of the database 'using' to the file 'path', and return
+    its data version.  The file is written next to 'path' and moved into
+    place when it's done, so servers reading an older snapshot at 'path'
+    always see a whole file.  'progress' is called with (table, rows copied)
+    after each table.
+    """
+
+    source = connections[using]
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    snapshot = sqlite3.connect(temp_path)
+    try:
+        snapshot.execute('PRAGMA journal_mode = OFF')
+        snapshot.execute('PRAGMA synchronous = OFF')
+
+        with transaction.atomic(using=using):
+            if source.vendor == 'postgresql':
+                # read every table as of the same moment
+                with source.cursor() as cursor:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+
+            invalidate_data_version()
+            version = get_data_version(using)
+
+            for table, columns in TABLES:
+                rows = _copy_table(using, snapshot, table, columns)
+                if progress is not None:
+                    progress(table, rows)
+
+        for table, column in INDEXES:
+            snapshot.execute('CREATE INDEX "%s_%s" ON "%s" ("%s")' % (table, column, table, column))
+
+        snapshot.execute('CREATE TABLE "%s" ("key" text PRIMARY KEY, "value" text)' % SNAPSHOT_INFO_TABLE)
+        snapshot.executemany('INSERT INTO "%s" VALUES (?, ?)' % SNAPSHOT_INFO_TABLE, [
+            ('data_version', version),
+            ('created', strftime('%Y-%m-%dT%H:%M:%SZ', gmtime())) ])
+
+        snapshot.execute('ANALYZE')
+        snapshot.commit()
+        snapshot.execute('VACUUM')
+        snapshot.close()
+
+        os.replace(temp_path, path)
+
+    finally:
+        snapshot.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return version
+
+
+
+
+def _copy_table(using, snapshot, table, columns):
+    """
+    Create 'table' in the snapshot, with the columns in the TABLES definition
+    'columns' that the source has, and copy its rows.  Return the number of
+    rows.
+    """
+
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT * FROM "%s" LIMIT 0' % table)
+        available = set(column[0] for column in cursor.description)
+
+    names = [name for name in column_names(columns) if name in available]
+    primary_key = column_names(columns)[0] if 'PRIMARY KEY' in columns.split(',')[0] else None
+
+    # The columns don't have types, so SQLite keeps each value the type the
+    # source database gave it (eg. coordinates stay numbers or text.)
+    snapshot.execute('CREATE TABLE "%s" (%s)' % (table, ', '.join(
+        '"%s" PRIMARY KEY' % name if name == primary_key else '"%s"' % name for name in names)))
+
+    insert = 'INSERT INTO "%s" VALUES (%s)' % (table, ', '.join('?' * len(names)))
+    rows = server_side_sql_rows(using, 'SELECT %s FROM "%s"' % (', '.join('"%s"' % name for name in names), table))
+
+    count = 0
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if not batch:
+            break
+        snapshot.executemany(insert, batch)
+        count += len(batch)
+
+    return count
+
+
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    connection_created signal handler: read the snapshot through a memory
+    map, when serving from a snapshot.
+    """
+
+    if settings.ANTMAPS_SNAPSHOT and connection.vendor == 'sqlite':
+        connection.connection.execute('PRAGMA mmap_size = %d' % settings.ANTMAPS_SNAPSHOT_MMAP_BYTES)
@@ -0,0 +1,348 @@
+"""
+In-memory spatial index of the points in map_species_points.
+
+The lat/lon columns in map_species_points are text, so filtering them in SQL
+compares strings ('-10' < '-9', '5' > '40') and can't use a range scan.  This
+index parses every point's coordinates to floats once per data version, and
+answers bounding-box and exact-point queries with numeric comparisons:
+
+- for one species, with bisect on the species' points sorted by latitude
+- across all species (eg. "every point in this map viewport",) with a grid of
+  GRID_DEGREES x GRID_DEGREES cells
+
+Queries return the primary keys (gabi_acc_number) of the matching points,
+for the view to fetch from the database.  The index also keeps the set of
+bentities with points in each grid cell, to find which bentities are on a map
+tile (see queries/tiles.py.)
+
+This module also clusters a species' points into grid cells for a map zoom
+level (see species_clusters,) so zoomed-out maps don't need every point.
+"""
+
+import hashlib
+from array import array
+from bisect import bisect_left, bisect_right
+from math import floor
+
+from django.core.cache import cache
+
+from queries.dataversion import get_data_version
+from queries.indexes import VersionedIndex
+from queries.models import SpeciesPoints
+
+
+# highest zoom level for clustering (cells are about 1 meter wide at zoom 22)
+MAX_CLUSTER_ZOOM = 22
+
+# how many cluster cells across one 256-pixel map tile (so about 32 pixels per cell)
+CLUSTER_CELLS_PER_TILE = 8
+
+
+
+
+class Bounds(object):
+    """
+    A latitude/longitude bounding box, inclusive.  Any side can be None (no
+    limit on that side.)  If min_lon > max_lon, the box wraps around the
+    antimeridian (longitude 180.)
+    """
+
+    def __init__(self, min_lat=None, max_lat=None, min_lon=None, max_lon=None):
+        self.min_lat = min_lat
+        self.max_lat = max_lat
+        self.min_lon = min_lon
+        self.max_lon = max_lon
+
+
+    def is_complete(self):
+        """
+        True if all four sides are given.
+        """
+
+        return None not in (self.min_lat, self.max_lat, self.min_lon, self.max_lon)
+
+
+    def wraps(self):
+        return self.min_lon is not None and self.max_lon is not None and self.min_lon > self.max_lon
+
+
+    def contains_lon(self, lon):
+        if self.wraps():
+            return lon >= self.min_lon or lon <= self.max_lon
+        return ((self.min_lon is None or lon >= self.min_lon)
+            and (self.max_lon is None or lon <= self.max_lon))
+
+
+    def contains(self, lat, lon):
+        return ((self.min_lat is None or lat >= self.min_lat)
+            and (self.max_lat is None or lat <= self.max_lat)
+            and self.contains_lon(lon))
+
+
+
+
+def parse_coordinate(value):
+    """
+    Return 'value' (a string from the database or the query string) as a
+    float, or None if it isn't a finite number.
+    """
+
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    if value != value or value in (float('inf'), float('-inf')):
+        return None
+    return value
+
+
+
+
+def _clamp(value, limit):
+    return max(-limit, min(limit, value))
+
+
+
+
+class PointIndex(object):
+    """
+    Spatial index of species points.  Points are numbered in the order they're
+    loaded, with their coordinates in the 'lats' and 'lons' arrays and their
+    primary keys in 'pks'.  'bentity_extents' is a dict of bentity ID -> 
+    [min_lat, max_lat, min_lon, max_lon] of its points.
+    """
+
+    GRID_DEGREES = 1.0
+
+    def __init__(self, points):
+        """
+        'points' is an iterable of (gabi_acc_number, taxon_code, lat, lon,
+        bentity_id).  Points without numeric coordinates are left out.
+        """
+
+        self.pks = []
+        self.lats = array('d')
+        self.lons = array('d')
+
+        by_species = {}
+        grid = {}
+        self.cell_bentities = {}
+        self.bentity_extents = {}
+
+        for pk, taxon_code, lat, lon, bentity_id in points:
+            lat = parse_coordinate(lat)
+            lon = parse_coordinate(lon)
+            if lat is None or lon is None:
+                continue
+
+            i = len(self.pks)
+            self.pks.append(pk)
+            self.lats.append(lat)
+            self.lons.append(lon)
+            by_species.setdefault(taxon_code, []).append(i)
+            cell = self._cell(lat, lon)
+            grid.setdefault(cell, []).append(i)
+            self.cell_bentities.setdefault(cell, set()).add(bentity_id)
+            
+            extent = self.bentity_extents.get(bentity_id)
+            if extent is None:
+                self.bentity_extents[bentity_id] = [lat, lat, lon, lon]
+            else:
+                extent[0] = min(extent[0], lat)
+                extent[1] = max(extent[1], lat)
+                extent[2] = min(extent[2], lon)
+                extent[3] = max(extent[3], lon)
+
+        # for each species, (latitudes, point numbers) sorted by latitude
+        self.species = {}
+        for taxon_code, numbers in by_species.items():
+            numbers.sort(key=self.lats.__getitem__)
+            self.species[taxon_code] = (array('d', (self.lats[i] for i in numbers)), array('l', numbers))
+
+        self.grid = dict((cell, array('l', numbers)) for cell, numbers in grid.items())
+
+
+    def _cell(self, lat, lon):
+        return (int(floor(lat / self.GRID_DEGREES)), int(floor(lon / self.GRID_DEGREES)))
+
+
+    def species_points(self, taxon_code, bounds):
+        """
+        Return the primary keys of the species' points inside 'bounds', in the
+        order they were loaded.
+        """
+
+        if taxon_code not in self.species:
+            return []
+
+        lats, numbers = self.species[taxon_code]
+        lo = 0 if bounds.min_lat is None else bisect_left(lats, bounds.min_lat)
+        hi = len(lats) if bounds.max_lat is None else bisect_right(lats, bounds.max_lat)
+
+        found = sorted(i for i in numbers[lo:hi] if bounds.contains_lon(self.lons[i]))
+        return [self.pks[i] for i in found]
+
+
+    def _cells(self, bounds):
+        """
+        Generate the grid cells that overlap 'bounds' (which must be complete.)
+        Only cells on the globe are generated, however big the box is.
+        """
+
+        first_row, first_col = self._cell(_clamp(bounds.min_lat, 90), _clamp(bounds.min_lon, 180))
+        last_row, last_col = self._cell(_clamp(bounds.max_lat, 90), _clamp(bounds.max_lon, 180))
+
+        if bounds.wraps():
+            # from min_lon east to the antimeridian, then from -180 to max_lon
+            cols = (list(range(first_col, self._cell(0, 180)[1] + 1))
+                  + list(range(self._cell(0, -180)[1], last_col + 1)))
+        else:
+            cols = range(first_col, last_col + 1)
+
+        for row in range(first_row, last_row + 1):
+            for col in cols:
+                yield (row, col)
+
+
+    def points(self, bounds):
+        """
+        Return the primary keys of every species' points inside 'bounds'
+        (which must be complete,) in the order they were loaded.
+        """
+
+        found = []
+        for cell in self._cells(bounds):
+            for i in self.grid.get(cell, ()):
+                if bounds.contains(self.lats[i], self.lons[i]):
+                    found.append(i)
+
+        return [self.pks[i] for i in sorted(found)]
+
+
+    def bentities(self, bounds):
+        """
+        Return the set of bentity ID's with points in the grid cells that
+        overlap 'bounds' (which must be complete.)  Cells are only 
+        GRID_DEGREES wide, so this is a close (slightly generous) approximation
+        of the bentities with points inside 'bounds'.
+        """
+
+        found = set()
+        for cell in self._cells(bounds):
+            found.update(self.cell_bentities.get(cell, ()))
+        return found
+
+
+    def bentities_overlapping(self, bounds):
+        """
+        Return the set of bentity ID's whose extent (the bounding box of their 
+        points) overlaps 'bounds' (which must be complete, and not wrap.)  
+        Unlike bentities(), this includes bentities that cover 'bounds' 
+        without having any points inside it.  (Bentities that cross longitude
+        180 have extents that go all the way around.)
+        """
+
+        return set(b for b, (min_lat, max_lat, min_lon, max_lon) in self.bentity_extents.items()
+            if min_lat <= bounds.max_lat and max_lat >= bounds.min_lat
+            and min_lon <= bounds.max_lon and max_lon >= bounds.min_lon)
+
+
+
+
+def _build_point_index():
+    points = ( SpeciesPoints.objects
+               .values_list('gabi_acc_number', 'valid_species_name', 'lat', 'lon', 'bentity') )
+
+    return PointIndex(points.iterator())
+
+
+point_index = VersionedIndex(_build_point_index)
+
+
+
+
+
+def cluster_cell_degrees(zoom):
+    """
+    Width (and height) in degrees of a cluster cell at a map zoom level.  The
+    whole world is 2**zoom tiles across, with CLUSTER_CELLS_PER_TILE cells 
+    across each tile.
+    """
+    
+    return 360.0 / (2 ** zoom * CLUSTER_CELLS_PER_TILE)
+
+
+
+
+def cluster_points(rows, zoom):
+    """
+    Group points into square grid cells for a map zoom level.
+    
+    'rows' is an iterable of (lat, lon, status, num_records, literature_count,
+    museum_count, database_count).  Return a list of (lat, lon, status, 
+    num_points, num_records, literature_count, museum_count, database_count)
+    for each cell that has points, where lat/lon is the mean position of the 
+    points in the cell, the counts are summed, and status is the status with
+    the most records in the cell.  Cells are sorted by position.
+    """
+    
+    degrees = cluster_cell_degrees(zoom)
+    cells = {}
+    
+    for lat, lon, status, num_records, literature_count, museum_count, database_count in rows:
+        lat = parse_coordinate(lat)
+        lon = parse_coordinate(lon)
+        if lat is None or lon is None:
+            continue
+        
+        key = (int(floor(lat / degrees)), int(floor(lon / degrees)))
+        if key not in cells:
+            # [sum of lats, sum of lons, {status: records}, num_points, num_records, literature_count, museum_count, database_count]
+            cells[key] = [0.0, 0.0, {}, 0, 0, 0, 0, 0]
+        cell = cells[key]
+        
+        num_records = int(num_records or 0)
+        cell[0] += lat
+        cell[1] += lon
+        cell[2][status] = cell[2].get(status, 0) + num_records
+        cell[3] += 1
+        cell[4] += num_records
+        cell[5] += int(literature_count or 0)
+        cell[6] += int(museum_count or 0)
+        cell[7] += int(database_count or 0)
+        
+    clusters = []
+    for key in sorted(cells):
+        cell = cells[key]
+        status = max(sorted(cell[2], key=str), key=cell[2].get)
+        clusters.append((round(cell[0] / cell[3], 5), round(cell[1] / cell[3], 5), status) + tuple(cell[3:]))
+    
+    return clusters
+
+
+
+
+def species_clusters(taxon_code, zoom, bentity_id=None):
+    """
+    Return cluster_points() for a species' points (optionally only in one
+    bentity) at a zoom level.  Each species/zoom level is only computed once
+    per data version, and then kept in the Django cache.
+    """
+    
+    # hash the arguments from the user, since memcached keys can't have spaces etc.
+    arguments = repr((taxon_code, zoom, bentity_id or '')).encode('utf-8')
+    key = 'clusters:%s:%s' % (get_data_version(), hashlib.md5(arguments).hexdigest())
+    
+    clusters = cache.get(key)
+    if clusters is None:
+        records = SpeciesPoints.objects.filter(valid_species_name=taxon_code)
+        if bentity_id:
+            records = records.filter(bentity_id=bentity_id)
+        records = records.values_list('lat', 'lon', 'status', 'num_records', 
+            'literature_count', 'museum_count', 'database_count')
+        
+        clusters = cluster_points(records.iterator(), zoom)
+        cache.set(key, clusters, None)
+    
+    return clusters
@@ -1,3 +1,1183 @@
-from django.test import TestCase
+"""
+Tests for the queries app.
 
-# Create your tests here.
+The tables AntMaps reads from are unmanaged (they're GABI's materialized
+views,) so the test database doesn't have them.  SyntheticDataTestCase makes
+them with a small set of made-up data (see the make_synthetic_data command,)
+eg. to check the in-memory indexes against SQL.  Run with
+
+    ./manage.py test queries --settings=antmaps_dataserver.benchmark_settings
+"""
+
+import asyncio
+import csv
+import gzip
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from base64 import urlsafe_b64encode
+from collections import OrderedDict
+from io import StringIO
+from unittest import mock, skipIf
+from urllib.request import pathname2url
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.db import connection
+from django.db import connections
+from django.db.models import Count, Q
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from queries import middleware, pointformat, serializers
+from queries.bulkexport import byte_range, export_bulk_data
+from queries.dataversion import get_data_version, invalidate_data_version
+from queries.deltas import record_species_hashes
+from queries.indexes import BentityNgramIndex, DiversityRollup, NativeSpeciesMatrix, ReferenceRegistry, SpeciesPrefixIndex, bentity_ngram_index, diversity_rollup, native_species_matrix, reference_registry, species_prefix_index
+from queries.management.commands import warm_cache
+from queries.models import Bentity, Genus, Record, Species, SpeciesPoints, SpeciesBentityPair, Subfamily
+from queries.routers import ReplicaRouter
+from queries.sharedarrays import SharedSegments
+from queries.snapshot import export_snapshot
+from queries.spatial import Bounds, PointIndex, cluster_points, parse_coordinate
+from queries.tiles import TILE_EXTENT, tile_bounds
+from queries.views import MAX_BATCH_SPECIES, bentity_counts
+
+
+
+
+@override_settings(ALLOWED_HOSTS=['testserver'], ANTMAPS_DATA_VERSION='test')
+class SyntheticDataTestCase(TestCase):
+    """
+    A TestCase with synthetic data in the AntMaps tables, made once for the
+    class.  The data version is pinned, so no request checks it.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('make_synthetic_data', scale=0.005, seed=1, stdout=StringIO())
+
+
+    def setUp(self):
+        cache.clear()
+
+
+    def make_temp_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+
+    def json(self, response):
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return json.loads(content.decode('utf-8'))
+
+
+    def species_with_points(self):
+        return ( SpeciesPoints.objects
+                 .exclude(valid_species_name=None)
+                 .order_by('valid_species_name')
+                 .values_list('valid_species_name', flat=True)[0] )
+
+
+
+
+class SpeciesPointsTests(SyntheticDataTestCase):
+
+    def test_one_species_is_streamed_and_cached(self):
+        species = self.species_with_points()
+        expected = SpeciesPoints.objects.filter(valid_species_name=species, lat__isnull=False, lon__isnull=False).count()
+
+        for format in ('json', 'csv'):
+            response = self.client.get('/species-points.' + format, {'species': species})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            content = b''.join(response.streaming_content)
+            if format == 'json':
+                self.assertEqual(len(json.loads(content.decode('utf-8'))['records']), expected)
+            else:
+                self.assertEqual(len(content.decode('utf-8').splitlines()), expected + 1)
+
+            # the second request comes from the page cache
+            with self.assertNumQueries(0):
+                cached = self.client.get('/species-points.' + format, {'species': species})
+            self.assertEqual(cached.content, content)
+            self.assertEqual(cached['Content-Type'], response['Content-Type'])
+
+
+    def test_long_responses_are_not_cached(self):
+        species = self.species_with_points()
+        with self.settings(ANTMAPS_CACHE_STREAMING_MAX_BYTES=100):
+            for i in range(2):
+                response = self.client.get('/species-points.json', {'species': species})
+                self.assertTrue(response.streaming)
+                self.assertGreater(len(b''.join(response.streaming_content)), 100)
+
+        # (a client that goes away before the end doesn't leave a partial copy)
+        response = self.client.get('/species-points.csv', {'species': species})
+        next(iter(response.streaming_content))
+        response.close()
+        self.assertTrue(self.client.get('/species-points.csv', {'species': species}).streaming)
+
+
+    def test_one_species_is_stored_precompressed(self):
+        species = self.species_with_points()
+        response = self.client.get('/species-points.json', {'species': species})
+        b''.join(response.streaming_content)
+
+        with self.assertNumQueries(0):
+            cached = self.client.get('/species-points.json', {'species': species}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(cached['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(cached.content), self.client.get('/species-points.json', {'species': species}).content)
+
+
+    def test_every_species_in_a_box_is_streamed(self):
+        response = self.client.get('/species-points.json', {'min_lat': -90, 'max_lat': 90, 'min_lon': -180, 'max_lon': 180})
+        self.assertTrue(response.streaming)
+        records = json.loads(b''.join(response.streaming_content).decode('utf-8'))['records']
+        self.assertEqual(len(records), SpeciesPoints.objects.filter(lat__isnull=False, lon__isnull=False).count())
+
+
+    def test_box_off_the_globe_is_an_error(self):
+        for args in ({'min_lat': -1e9, 'max_lat': 90, 'min_lon': -180, 'max_lon': 180},
+                     {'min_lat': -90, 'max_lat': 90, 'min_lon': -180, 'max_lon': 181},
+                     {'species': self.species_with_points(), 'lon': 'inf'}):
+            response = self.client.get('/species-points.json', args)
+            self.assertTrue(json.loads(response.content.decode('utf-8'))['error'])
+
+
+
+
+class DiversityRollupTests(SyntheticDataTestCase):
+
+    def test_matches_sql(self):
+        genus, subfamily = SpeciesBentityPair.objects.filter(category='N').values_list('genus_name', 'subfamily_name')[0]
+        rollup = diversity_rollup.get()
+
+        for column, taxon, rows in (('genus_name', genus, rollup.genus(genus)), ('subfamily_name', subfamily, rollup.subfamily(subfamily))):
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT "bentity2_id", count(distinct "valid_species_name"), sum("num_records"),
+                        sum("literature_count"), sum("museum_count"), sum("database_count")
+                    FROM "map_species_bentity_pair"
+                    WHERE "{}" = %s AND "category" = 'N'
+                    GROUP BY "bentity2_id"
+                    ORDER BY "bentity2_id"
+                    """.format(column), [taxon])
+                self.assertTrue(rows)
+                self.assertEqual([tuple(row) for row in rows], [tuple(row) for row in cursor.fetchall()])
+
+
+    def test_null_taxa_and_species(self):
+        rollup = DiversityRollup([
+            (None, None, 'a.b', '1', 5, 1, 2, 2),
+            ('G', 'S', None, '1', 3, 3, 0, 0),
+            ('G', 'S', 'g.x', '1', 2, 0, 2, 0),
+            ('G', None, 'g.y', '2', 1, 0, 0, 1),
+        ])
+
+        # a NULL species isn't counted, but its records are (like count(distinct))
+        self.assertEqual(rollup.genus('G'), [('1', 1, 5, 3, 2, 0), ('2', 1, 1, 0, 0, 1)])
+        self.assertEqual(rollup.subfamily('S'), [('1', 1, 5, 3, 2, 0)])
+        self.assertEqual(rollup.genus(None), [])
+        self.assertEqual(DiversityRollup.from_arrays(rollup.to_arrays()).genus('G'), rollup.genus('G'))
+
+
+
+
+class CompressionTests(SyntheticDataTestCase):
+
+    def test_content_length_matches_encoding(self):
+        codings = ['gzip', 'identity'] + (['br'] if middleware.brotli is not None else [])
+
+        for coding in codings:
+            cache.clear()
+            # (the first request fills the cache, the second is served from it)
+            for i in range(2):
+                response = self.client.get('/species-per-bentity.json', HTTP_ACCEPT_ENCODING=coding)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.get('Content-Encoding', 'identity'), coding)
+                self.assertEqual(int(response['Content-Length']), len(response.content))
+
+
+
+
+class PointIndexTests(TestCase):
+
+    def test_huge_box_only_checks_cells_on_the_globe(self):
+        index = PointIndex([(1, 'a.b', '10.5', '20.5', 'B1'), (2, 'a.b', '-89.5', '179.5', 'B2')])
+
+        cells = list(index._cells(Bounds(-1e12, 1e12, -1e12, 1e12)))
+        self.assertEqual(len(cells), 181 * 361)
+        self.assertEqual(index.points(Bounds(-1e12, 1e12, -1e12, 1e12)), [1, 2])
+
+        # wrapping around the antimeridian
+        self.assertEqual(index.points(Bounds(-90, 90, 170, -1e12)), [2])
+
+    
+    def test_bentities_overlapping_without_points_inside(self):
+        index = PointIndex([(1, 'a.b', '10', '10', 'B1'), (2, 'a.b', '20', '30', 'B1'), (3, 'a.b', '-40', '-60', 'B2')])
+        
+        self.assertEqual(index.bentities(Bounds(14.5, 15.5, 19.5, 20.5)), set())
+        self.assertEqual(index.bentities_overlapping(Bounds(14.5, 15.5, 19.5, 20.5)), {'B1'})
+        self.assertEqual(index.bentities_overlapping(Bounds(-90, 90, -180, 180)), {'B1', 'B2'})
+        self.assertEqual(index.bentities_overlapping(Bounds(21, 30, 0, 90)), set())
+
+
+
+
+class PointFormatTests(TestCase):
+
+    ROWS = [
+        ('10.123456', '-20.5', 'N', 'B1', 'Bentity one', 3, 1, 2, 0),
+        (-45.5, 170.00001, 'I', 'B2', 'Bentity two', 1, 0, 0, 1),
+        ('10.1', '-20.5', 'N', 'B1', 'Bentity one', 7, 7, 0, 0),
+    ]
+
+    def test_round_trip(self):
+        species, rows = pointformat.decode_points(pointformat.encode_points('a.b', self.ROWS))
+        self.assertEqual(species, 'a.b')
+
+        expected = sorted((round(float(r[0]), 5), round(float(r[1]), 5)) + tuple(r[2:]) for r in self.ROWS)
+        self.assertEqual([(round(r[0], 5), round(r[1], 5)) + r[2:] for r in rows], expected)
+
+
+    def test_bad_coordinates_are_left_out(self):
+        bad = [(lat, lon, 'N', 'B1', 'Bentity one', 1, 1, 0, 0)
+               for lat, lon in ((None, 1), ('x', 1), ('nan', 1), (float('inf'), 1), (1, '-inf'), (1e300, 1), (91, 1), (1, 180.5))]
+        species, rows = pointformat.decode_points(pointformat.encode_points('a.b', bad + self.ROWS[:1]))
+        self.assertEqual(len(rows), 1)
+
+
+
+
+class SpeciesSearchTests(SyntheticDataTestCase):
+
+    def test_prefix_index_matches_sql(self):
+        species = Species.objects.exclude(genus_name=None).order_by('taxon_code')[0]
+        genus = species.genus_name_id
+
+        for tokens in ([genus[:2]], [genus.lower(), species.species_name[:2]], [species.species_name[:1].upper()], ['zzz']):
+            matches = Species.objects.all()
+            for token in tokens:
+                matches = matches.filter(Q(species_name__istartswith=token) | Q(genus_name__genus_name__istartswith=token))
+            expected = list(matches.order_by('taxon_code').values_list('taxon_code', flat=True))
+
+            self.assertEqual([code for code, label in species_prefix_index.get().search(tokens)], expected)
+            self.assertEqual(len(species_prefix_index.get().search(tokens, limit=1)), min(1, len(expected)))
+
+
+    def test_autocomplete(self):
+        species = Species.objects.exclude(genus_name=None).order_by('taxon_code')[0]
+        response = self.client.get('/species-search.json', {'q': '%s %s' % (species.genus_name_id, species.species_name)})
+        self.assertIn({'value': species.taxon_code, 'label': species.genus_name_id + ' ' + species.species_name},
+            json.loads(response.content.decode('utf-8'))['species'])
+
+
+
+
+class SpeciesInCommonTests(SyntheticDataTestCase):
+
+    def test_matrix_matches_sql(self):
+        bentity_id = SpeciesBentityPair.objects.filter(category='N').values_list('bentity', flat=True)[0]
+
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT b."bentity2_id", count(distinct b."valid_species_name")
+                FROM "map_species_bentity_pair" a
+                JOIN "map_species_bentity_pair" b ON a."valid_species_name" = b."valid_species_name"
+                WHERE a."bentity2_id" = %s AND a."category" = 'N' AND b."category" = 'N'
+                GROUP BY b."bentity2_id"
+                ORDER BY b."bentity2_id"
+                """, [bentity_id])
+            expected = [tuple(row) for row in cursor.fetchall()]
+
+        self.assertTrue(expected)
+        self.assertEqual(native_species_matrix.get().in_common(bentity_id), expected)
+
+        response = self.client.get('/species-in-common.json', {'bentity_id': bentity_id})
+        self.assertEqual([(b['gid'], b['species_count']) for b in json.loads(response.content.decode('utf-8'))['bentities']], expected)
+
+
+
+
+class BulkDownloadTests(SyntheticDataTestCase):
+
+    def test_byte_range(self):
+        self.assertEqual(byte_range(None, 100), None)
+        self.assertEqual(byte_range('bytes=10-19', 100), (10, 19))
+        self.assertEqual(byte_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(byte_range('bytes=90-200', 100), (90, 99))
+        self.assertEqual(byte_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(byte_range('bytes=-1000', 100), (0, 99))
+        self.assertEqual(byte_range('bytes=0-1,5-6', 100), None)  # (several ranges)
+        self.assertEqual(byte_range('bytes=20-10', 100), None)
+        self.assertEqual(byte_range('items=0-1', 100), None)
+        for header in ('bytes=100-', 'bytes=100-200', 'bytes=-0'):
+            with self.assertRaises(ValueError):
+                byte_range(header, 100)
+
+
+    def test_download_ranges(self):
+        directory = self.make_temp_dir()
+        manifest = export_bulk_data(directory)
+        filename = 'species-points.csv.gz'
+        with open(os.path.join(directory, filename), 'rb') as f:
+            data = f.read()
+        self.assertEqual(manifest['files'][filename]['size'], len(data))
+        self.assertEqual(len(gzip.decompress(data).splitlines()),
+            SpeciesPoints.objects.exclude(valid_species_name=None).filter(lat__isnull=False, lon__isnull=False).count() + 1)
+
+        with self.settings(ANTMAPS_BULK_EXPORT_DIR=directory):
+            self.assertEqual(self.json(self.client.get('/bulk'))['data_version'], 'test')
+
+            response = self.client.get('/bulk/' + filename)
+            self.assertEqual(b''.join(response.streaming_content), data)
+
+            response = self.client.get('/bulk/' + filename, HTTP_RANGE='bytes=10-19')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes 10-19/%d' % len(data))
+            self.assertEqual(b''.join(response.streaming_content), data[10:20])
+
+            # (a Range for a different copy of the file sends the whole file)
+            response = self.client.get('/bulk/' + filename, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"other"')
+            self.assertEqual(response.status_code, 200)
+            response.close()
+
+            response = self.client.get('/bulk/' + filename, HTTP_RANGE='bytes=%d-' % len(data))
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response['Content-Range'], 'bytes */%d' % len(data))
+
+            self.assertEqual(self.client.get('/bulk/nothing.csv.gz').status_code, 404)
+
+
+    def test_bentity_counts_match_the_view(self):
+        directory = self.make_temp_dir()
+        export_bulk_data(directory)
+        with open(os.path.join(directory, 'bentity-counts.ndjson.gz'), 'rb') as f:
+            exported = [json.loads(line) for line in gzip.decompress(f.read()).decode('utf-8').splitlines()]
+
+        counts = self.json(self.client.get('/species-per-bentity.json'))['bentities']
+        self.assertTrue(counts)
+        self.assertEqual(sorted((b['bentity_id'], b['species_count'], b['num_records']) for b in exported),
+                         sorted((b['gid'], b['species_count'], b['num_records']) for b in counts))
+
+
+
+
+class SpeciesChangesTests(SyntheticDataTestCase):
+
+    def setUp(self):
+        super(SpeciesChangesTests, self).setUp()
+        settings_override = self.settings(ANTMAPS_BULK_EXPORT_DIR=self.make_temp_dir())
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+    def test_changes(self):
+        record_species_hashes('v1', {'a.a': ['1', '2'], 'b.b': ['3', None], 'c.c': ['4', '5']})
+        record_species_hashes('v2', {'a.a': ['1', '2'], 'b.b': ['3', '6'], 'd.d': ['7', None]})
+
+        changes = self.json(self.client.get('/species-changes.json', {'since': 'v1', 'to': 'v2'}))
+        self.assertEqual(changes, {'since': 'v1', 'data_version': 'v2', 'changed': ['b.b', 'd.d'], 'removed': ['c.c']})
+
+        changes = self.json(self.client.get('/species-changes.json', {'since': 'v0', 'to': 'v2'}))
+        self.assertTrue(changes['error'])
+        self.assertTrue(changes['full_refresh'])
+
+        # the records are only for the current data version ('test')
+        changes = self.json(self.client.get('/species-changes.json', {'since': 'v1', 'to': 'v2', 'include': 'range'}))
+        self.assertTrue(changes['error'])
+
+
+    def test_changes_with_records(self):
+        species = self.species_with_points()
+        record_species_hashes('v1', {})
+        record_species_hashes('test', {species: ['1', '2']})
+
+        changes = self.json(self.client.get('/species-changes.json', {'since': 'v1', 'include': 'range,points'}))
+        self.assertEqual(changes['changed'], [species])
+        self.assertEqual(len(changes['records'][species]),
+            SpeciesPoints.objects.filter(valid_species_name=species, lat__isnull=False, lon__isnull=False).count())
+        self.assertEqual(len(changes['bentities'][species]), SpeciesBentityPair.objects.filter(valid_species_name=species).count())
+
+
+    def test_exports_record_hashes(self):
+        species = self.species_with_points()
+        export_bulk_data(settings.ANTMAPS_BULK_EXPORT_DIR)
+        record_species_hashes('v1', {})
+
+        changes = self.json(self.client.get('/species-changes.json', {'since': 'v1'}))
+        self.assertIn(species, changes['changed'])
+
+
+    def test_changes_not_exported_yet(self):
+        response = self.client.get('/species-changes.json', {'since': 'v1'})
+        self.assertTrue(self.json(response)['error'])
+        self.assertIn('no-cache', response['Cache-Control'])
+
+
+
+
+class ConditionalGetTests(SyntheticDataTestCase):
+
+    def test_not_modified_for_every_encoding(self):
+        codings = ['gzip', 'identity'] + (['br'] if middleware.brotli is not None else [])
+
+        for coding in codings:
+            cache.clear()
+            first = self.client.get('/species-per-bentity.json', HTTP_ACCEPT_ENCODING=coding)
+            cached = self.client.get('/species-per-bentity.json', HTTP_ACCEPT_ENCODING=coding)
+            self.assertEqual(cached['ETag'], first['ETag'])
+            self.assertFalse(cached['ETag'].startswith('W/'))
+
+            # a cache hit, with the ETag the client got
+            with self.assertNumQueries(0):
+                response = self.client.get('/species-per-bentity.json', HTTP_ACCEPT_ENCODING=coding, HTTP_IF_NONE_MATCH=cached['ETag'])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+
+
+    def test_encodings_have_different_etags(self):
+        plain = self.client.get('/species-per-bentity.json')
+        compressed = self.client.get('/species-per-bentity.json', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertNotEqual(plain['ETag'], compressed['ETag'])
+
+        response = self.client.get('/species-per-bentity.json', HTTP_IF_NONE_MATCH=compressed['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+
+
+    def test_views_answer_if_none_match_without_queries(self):
+        species = self.species_with_points()
+        bentity_id = SpeciesBentityPair.objects.filter(valid_species_name=species).values_list('bentity', flat=True)[0]
+        paths = ['/subfamilies.json', '/species-per-bentity.json', '/species-range.json?species=' + species,
+                 '/species-in-common.json?bentity_id=' + bentity_id, '/species-points.csv?species=' + species]
+        
+        for path in paths:
+            etag = self.client.get(path)['ETag']
+            
+            # (not from the page cache: the view's etag decorator answers it)
+            cache.clear()
+            with self.assertNumQueries(0):
+                response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, path)
+        
+        # other arguments, or new data, get a new ETag
+        etag = self.client.get('/species-range.json?species=' + species)['ETag']
+        other = Species.objects.exclude(taxon_code=species)[0].taxon_code
+        self.assertNotEqual(self.client.get('/species-range.json?species=' + other)['ETag'], etag)
+        with self.settings(ANTMAPS_DATA_VERSION='test2'):
+            response = self.client.get('/species-range.json?species=' + species, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+
+
+class CitationsTests(SyntheticDataTestCase):
+
+    def citation_pages(self, args):
+        """
+        Get every page of citations for 'args' and return the records.
+        """
+
+        records = []
+        args = dict(args, count=1)
+        while True:
+            page = self.json(self.client.get('/citations.json', args))
+            self.assertNotIn('error', page)
+            records.extend(page['records'])
+            if page['next_cursor'] is None:
+                self.assertEqual(page['total_count'], len(records))
+                return records
+            args['cursor'] = page['next_cursor']
+
+
+    def species_and_bentity(self):
+        return ( Record.objects.exclude(valid_species_name=None).exclude(bentity=None)
+                 .values_list('valid_species_name', 'bentity')[0] )
+
+
+    def test_pages_cover_every_record_once(self):
+        species, bentity_id = self.species_and_bentity()
+        expected = list(Record.objects.filter(valid_species_name=species, bentity=bentity_id)
+                        .order_by('gabi_acc_number').values_list('gabi_acc_number', flat=True))
+        self.assertGreater(len(expected), 3)
+
+        for limit in (1, 3, len(expected)):
+            records = self.citation_pages({'species': species, 'bentity_id': bentity_id, 'limit': limit})
+            self.assertEqual([r['gabi_acc_number'] for r in records], expected)
+
+
+    def test_repeated_accession_numbers(self):
+        species, bentity_id = self.species_and_bentity()
+
+        # (map_record is a view, the same gabi_acc_number can be in more than one row)
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE "map_record_copy" AS SELECT * FROM "map_record"')
+            cursor.execute('DROP TABLE "map_record"')
+            cursor.execute('ALTER TABLE "map_record_copy" RENAME TO "map_record"')
+            cursor.execute('''
+                INSERT INTO "map_record" ("gabi_acc_number", "valid_species_name", "bentity2_id", "citation")
+                VALUES ('GABI00000000', %s, %s, 'a'), ('GABI00000000', %s, %s, 'b'),
+                       ('GABI00000000', %s, %s, 'b'), ('GABI00000000', %s, %s, 'c')
+                ''', [species, bentity_id] * 4)
+
+        expected = list(Record.objects.filter(valid_species_name=species, bentity=bentity_id)
+                        .values_list('gabi_acc_number', 'citation').distinct().order_by('gabi_acc_number', 'citation'))
+        self.assertEqual(expected[:3], [('GABI00000000', 'a'), ('GABI00000000', 'b'), ('GABI00000000', 'c')])
+
+        for limit in (1, 2, 4):
+            records = self.citation_pages({'species': species, 'bentity_id': bentity_id, 'limit': limit})
+            self.assertEqual([(r['gabi_acc_number'], r['citation']) for r in records], expected)
+
+
+    def test_cursors(self):
+        species, bentity_id = self.species_and_bentity()
+        args = {'species': species, 'bentity_id': bentity_id, 'limit': 1}
+        first, second = [r['gabi_acc_number'] for r in self.citation_pages(args)[:2]]
+
+        # (a cursor from before cursors had a count)
+        old_cursor = urlsafe_b64encode(first.encode('utf-8')).decode('ascii').rstrip('=')
+        page = self.json(self.client.get('/citations.json', dict(args, cursor=old_cursor)))
+        self.assertEqual(page['records'][0]['gabi_acc_number'], second)
+
+        page = self.json(self.client.get('/citations.json', dict(args, cursor='!!')))
+        self.assertTrue(page['error'])
+
+
+
+
+class DataVersionTests(SyntheticDataTestCase):
+    
+    def test_marked_version(self):
+        self.addCleanup(invalidate_data_version)
+        with self.settings(ANTMAPS_DATA_VERSION=None):
+            invalidate_data_version()
+            unmarked = get_data_version()
+            
+            call_command('mark_data_version', data_version='v1', stdout=StringIO())
+            self.assertEqual(get_data_version(), 'v1')
+            
+            # (a server that hasn't been told about the new version checks
+            # the table again)
+            call_command('mark_data_version', stdout=StringIO())
+            marked = get_data_version()
+            invalidate_data_version()
+            self.assertEqual(get_data_version(), marked)
+            self.assertNotIn(marked, ('v1', unmarked))
+            
+            # the page cache keys follow it
+            species = self.species_with_points()
+            b''.join(self.client.get('/species-points.json', {'species': species}).streaming_content)
+            self.assertFalse(self.client.get('/species-points.json', {'species': species}).streaming)
+            call_command('mark_data_version', stdout=StringIO())
+            self.assertTrue(self.client.get('/species-points.json', {'species': species}).streaming)
+
+
+
+
+class SharedIndexTests(SyntheticDataTestCase):
+    
+    def test_shared_segments_match_the_built_indexes(self):
+        segments = SharedSegments(self.make_temp_dir())
+        
+        for name, index_class, index in (('prefix', SpeciesPrefixIndex, species_prefix_index.get()),
+                                         ('matrix', NativeSpeciesMatrix, native_species_matrix.get()),
+                                         ('rollup', DiversityRollup, diversity_rollup.get())):
+            shared = index_class.from_arrays(segments.attach(name, 'test', index.to_arrays))
+            # (attaching again maps the file that's there instead of building it)
+            self.assertEqual(segments.attach(name, 'test', None).header, segments.attach(name, 'test', index.to_arrays).header)
+            
+            if index_class is SpeciesPrefixIndex:
+                for token in ('a', 'ca', 'x'):
+                    self.assertEqual(shared.search([token]), index.search([token]))
+            elif index_class is NativeSpeciesMatrix:
+                for bentity_id in index.bentity_ids[:20]:
+                    self.assertEqual(shared.in_common(bentity_id), index.in_common(bentity_id))
+            else:
+                for genus in list(index.genera)[:20]:
+                    self.assertEqual(shared.genus(genus), index.genus(genus))
+    
+    
+    def test_wsgi_loads_the_indexes_once_in_the_background(self):
+        from antmaps_dataserver import wsgi
+        self.addCleanup(setattr, wsgi, '_indexes_loader', None)
+        
+        started = threading.Event()
+        finish = threading.Event()
+        calls = []
+        def load_indexes():
+            calls.append(threading.current_thread())
+            started.set()
+            finish.wait(5)
+        
+        with mock.patch('queries.indexes.load_indexes', load_indexes):
+            # concurrent first requests don't wait for it, or start it again
+            requests = [threading.Thread(target=wsgi._load_indexes) for i in range(8)]
+            for thread in requests:
+                thread.start()
+            for thread in requests:
+                thread.join(5)
+            self.assertTrue(started.wait(5))
+            self.assertTrue(wsgi._indexes_loader.is_alive())
+            
+            wsgi._load_indexes()
+            finish.set()
+            wsgi._indexes_loader.join(5)
+        
+        self.assertEqual(calls, [wsgi._indexes_loader])
+
+
+
+
+class WarmCacheTests(SyntheticDataTestCase):
+    
+    def test_site_options(self):
+        options = {'host': 'antmaps.org', 'script_name': '', 'secure': False, 'base_url': None}
+        self.assertEqual(warm_cache.site_options(options), ('antmaps.org', '', False))
+        options['base_url'] = 'https://antmaps.org:8443/api/v01/'
+        self.assertEqual(warm_cache.site_options(options), ('antmaps.org:8443', '/api/v01', True))
+    
+    
+    def test_warmed_https_responses_are_hits(self):
+        self.addCleanup(warm_cache._start_worker, None, '', False)
+        path = '/species-range.json?species=' + self.species_with_points()
+        
+        warm_cache._start_worker('testserver', '', True)
+        self.assertEqual(warm_cache._render(path)[2], 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(path, secure=True).status_code, 200)
+        
+        # (the cache key has the scheme)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(path)
+        self.assertTrue(queries.captured_queries)
+
+
+
+
+class TileTests(SyntheticDataTestCase):
+    
+    def tiles(self, z, **query):
+        for x in range(2 ** z):
+            for y in range(2 ** z):
+                yield (x, y, self.json(self.client.get('/tiles/%d/%d/%d.json' % (z, x, y), query)))
+    
+    
+    def test_every_bentity_is_on_a_tile(self):
+        expected = set(row[0] for row in bentity_counts())
+        
+        for z in (0, 2):
+            on_tiles = set()
+            for x, y, tile in self.tiles(z):
+                self.assertNotIn('points', tile)
+                self.assertEqual(tile['bentities']['fields'][:2], ['gid', 'species_count'])
+                on_tiles.update(row[0] for row in tile['bentities']['rows'])
+            self.assertEqual(on_tiles, expected)
+    
+    
+    def test_species_points_are_on_their_tiles(self):
+        species = self.species_with_points()
+        expected = SpeciesPoints.objects.filter(valid_species_name=species, lat__isnull=False, lon__isnull=False).count()
+        bentities = set(SpeciesBentityPair.objects.filter(valid_species_name=species).values_list('bentity', flat=True))
+        
+        num_points = 0
+        for x, y, tile in self.tiles(1, species=species):
+            bounds = tile_bounds(1, x, y)
+            fields = tile['points']['fields']
+            for row in tile['points']['rows']:
+                point = dict(zip(fields, row))
+                self.assertTrue(0 <= point['x'] <= TILE_EXTENT and 0 <= point['y'] <= TILE_EXTENT)
+                self.assertTrue(bounds.contains(point['lat'], point['lon']))
+                num_points += point['num_points']
+            self.assertLessEqual(set(row[0] for row in tile['bentities']['rows']), bentities)
+        
+        # (clusters on the edge between two tiles are on both)
+        self.assertGreaterEqual(num_points, expected)
+
+
+
+
+class SpeciesListTests(SyntheticDataTestCase):
+    
+    def test_bentity_modes_match_sql(self):
+        bentity_ids = list( SpeciesBentityPair.objects.filter(category='N').values('bentity')
+                            .annotate(n=Count('valid_species_name')).order_by('-n', 'bentity')
+                            .values_list('bentity', flat=True)[:3] )
+        native = 'SELECT "valid_species_name" FROM "map_species_bentity_pair" WHERE "category" = \'N\' AND "bentity2_id" '
+        conditions = {
+            'intersection': ' AND '.join(['"taxon_code" IN (' + native + '= %s)'] * 3),
+            'union': '"taxon_code" IN (' + native + 'IN (%s, %s, %s))',
+            'difference': '"taxon_code" IN (' + native + '= %s) AND "taxon_code" NOT IN (' + native + 'IN (%s, %s))',
+        }
+        
+        for mode, condition in conditions.items():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT "taxon_code" FROM "species" WHERE ' + condition + ' ORDER BY "taxon_code"', bentity_ids)
+                expected = [row[0] for row in cursor.fetchall()]
+            
+            # (any mix of repeated arguments and commas)
+            response = self.json(self.client.get('/species.json', 
+                {'bentity_id': ','.join(bentity_ids[:2]), 'bentity2_id': bentity_ids[2], 'bentity_mode': mode}))
+            self.assertEqual([s['key'] for s in response['species']], expected)
+            self.assertTrue(expected or mode == 'intersection')
+        
+        response = self.json(self.client.get('/species.json', {'bentity_id': bentity_ids, 'bentity_mode': 'xor'}))
+        self.assertTrue(response['error'])
+    
+    
+    def test_matrix_keeps_the_database_order(self):
+        # (eg. a case-insensitive collation)
+        matrix = NativeSpeciesMatrix([('a.b', 'B1'), ('A.c', 'B2'), ('b.a', 'B1'), ('B.b', 'B2')])
+        self.assertEqual(matrix.species(matrix.combine(['B1', 'B2'], 'union')), ['a.b', 'A.c', 'b.a', 'B.b'])
+        self.assertEqual(matrix.species(matrix.combine(['B2'])), ['A.c', 'B.b'])
+
+
+
+
+@skipIf(sys.version_info < (3, 6), 'antmaps_dataserver.asgi needs Python 3.6')
+class AsgiTests(TestCase):
+    
+    def test_stops_streaming_when_the_client_disconnects(self):
+        from antmaps_dataserver import asgi
+        
+        made = []
+        closed = threading.Event()
+        def chunks():
+            try:
+                for i in range(1000):
+                    made.append(i)
+                    yield b'x' * 100
+            finally:
+                closed.set()
+        
+        def wsgi_application(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return chunks()
+        
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        first_body = asyncio.Event(loop=loop)
+        requested = []
+        sent = []
+        
+        # (the client goes away after the first part of the response)
+        @asyncio.coroutine
+        def receive():
+            if not requested:
+                requested.append(True)
+                return {'type': 'http.request', 'body': b''}
+            yield from first_body.wait()
+            return {'type': 'http.disconnect'}
+        
+        @asyncio.coroutine
+        def send(message):
+            sent.append(message)
+            if message['type'] == 'http.response.body':
+                first_body.set()
+        
+        scope = {'type': 'http', 'method': 'GET', 'path': '/species-points.json', 'query_string': b'', 'headers': []}
+        with mock.patch.object(asgi, '_application', wsgi_application):
+            loop.run_until_complete(asgi.application(scope, receive, send))
+        
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertLess(len(made), 1000)
+        self.assertTrue(closed.is_set())
+
+
+
+
+class MetricsTests(SyntheticDataTestCase):
+    
+    def responses_total(self, endpoint):
+        with self.settings(ANTMAPS_METRICS_ALLOWED_IPS=['127.0.0.1']):
+            response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        match = re.search(r'^antmaps_responses_total\{endpoint="%s",status="200"\} (\d+)$' % endpoint,
+                          response.content.decode('utf-8'), re.MULTILINE)
+        return int(match.group(1)) if match else 0
+    
+    
+    def test_metrics_are_only_for_allowed_ips(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with self.settings(ANTMAPS_METRICS_ALLOWED_IPS=['10.0.0.5']):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.5').status_code, 200)
+    
+    
+    def test_responses_are_counted(self):
+        path = '/species-range.json?species=' + self.species_with_points()
+        before = self.responses_total('species-range')
+        self.client.get(path)
+        self.client.get(path)
+        self.assertEqual(self.responses_total('species-range'), before + 2)
+    
+    
+    def test_server_timing_counts_queries(self):
+        path = '/species-range.json?species=' + self.species_with_points()
+        
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertTrue(queries.captured_queries)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="%d queries"' % len(queries.captured_queries), response['Server-Timing'])
+        
+        # (from the cache, and the header isn't cached with the response)
+        self.assertIn('desc="0 queries"', self.client.get(path)['Server-Timing'])
+
+
+
+
+class BentitySearchTests(SyntheticDataTestCase):
+    
+    def test_ngram_index_matches_sql(self):
+        names = [n for n in Bentity.objects.order_by('bentity').values_list('bentity', flat=True) if n and len(n) >= 4]
+        for name in names[:10]:
+            words = name.lower().split()
+            # one and two characters, trigrams, longer tokens, and two tokens
+            for tokens in ([name[1]], [words[0][-2:]], [words[0][:3]], [words[0][1:]], [words[0][:2], words[-1][-3:]], ['zzzz']):
+                expected = Bentity.objects.all()
+                for token in tokens:
+                    expected = expected.filter(bentity__icontains=token)
+                found = bentity_ngram_index.get().search(tokens)
+                self.assertEqual(sorted(found), sorted(expected.values_list('gid', 'bentity')))
+    
+    
+    def test_ranking(self):
+        index = BentityNgramIndex([('B4', 'Albania'), ('B1', 'Alberta'), ('B2', 'New Albania'), ('B3', 'Zalbonia')])
+        self.assertEqual([gid for gid, name in index.search(['alb'])], ['B4', 'B1', 'B2', 'B3'])
+        self.assertEqual([gid for gid, name in index.search(['ALB', 'ia'])], ['B4', 'B2', 'B3'])
+        self.assertEqual([gid for gid, name in index.search(['new', 'alb'])], ['B2'])
+        self.assertEqual([gid for gid, name in index.search(['alb'], limit=2)], ['B4', 'B1'])
+    
+    
+    def test_endpoint(self):
+        gid, name = Bentity.objects.exclude(bentity=None).order_by('bentity').values_list('gid', 'bentity')[0]
+        token = name.split()[0][:3]
+        bentity_ngram_index.get()
+        
+        with self.assertNumQueries(0):
+            response = self.json(self.client.get('/bentity-search.json', {'q': token, 'limit': 3}))
+        self.assertLessEqual(len(response['bentities']), 3)
+        self.assertTrue(response['bentities'][0]['bentity_name'].lower().startswith(token.lower()))
+        self.assertIn('bentity_id', response['bentities'][0])
+        
+        self.assertTrue(self.json(self.client.get('/bentity-search.json', {'q': token, 'limit': -1}))['error'])
+
+
+
+
+class ClusterTests(SyntheticDataTestCase):
+    
+    def test_cluster_points(self):
+        rows = [('10', '10', 'N', 2, 1, 1, 0), ('20.0', '20', 'I', 3, 3, 0, 0), ('-10', '100', 'N', 1, 0, 0, 1),
+                ('', '5', 'N', 1, 1, 0, 0), ('nan', '5', 'N', 1, 1, 0, 0)]
+        
+        # zoom 0 cells are 45 degrees wide
+        self.assertEqual(cluster_points(rows, 0), [
+            (-10.0, 100.0, 'N', 1, 1, 0, 0, 1),
+            (15.0, 15.0, 'I', 2, 5, 4, 1, 0)])
+        self.assertEqual(len(cluster_points(rows, 5)), 3)
+    
+    
+    def test_counts_at_each_zoom(self):
+        species = self.species_with_points()
+        points = [p for p in SpeciesPoints.objects.filter(valid_species_name=species).values_list('lat', 'lon', 'num_records')
+                  if parse_coordinate(p[0]) is not None and parse_coordinate(p[1]) is not None]
+        
+        previous = 0
+        for zoom in (0, 2, 5, 10, 22):
+            clusters = self.json(self.client.get('/species-points.json', {'species': species, 'zoom': zoom}))['records']
+            self.assertEqual(sum(c['num_points'] for c in clusters), len(points))
+            self.assertEqual(sum(c['num_records'] for c in clusters), sum(p[2] or 0 for p in points))
+            # (more, smaller cells as the map zooms in)
+            self.assertGreaterEqual(len(clusters), previous)
+            previous = len(clusters)
+        
+        self.assertEqual(previous, len(set((float(p[0]), float(p[1])) for p in points)))
+        
+        for zoom in ('-1', '23', 'x'):
+            self.assertTrue(self.json(self.client.get('/species-points.json', {'species': species, 'zoom': zoom}))['error'])
+
+
+
+
+class SpeciesBatchTests(SyntheticDataTestCase):
+    
+    def test_grouped_like_the_single_species_endpoints(self):
+        species = list(SpeciesPoints.objects.exclude(valid_species_name=None).order_by('valid_species_name')
+                       .values_list('valid_species_name', flat=True).distinct()[:3]) + ['nosuch.species']
+        
+        def sort(objects):
+            return sorted(objects, key=lambda o: json.dumps(o, sort_keys=True))
+        
+        # (any mix of repeated arguments and commas, and repeats)
+        batch = self.json(self.client.get('/species-batch.json', {'species': [','.join(species[:2]), species[2], species[3], species[0]]}))
+        self.assertEqual(sorted(batch), ['bentities', 'records'])
+        self.assertEqual(list(batch['bentities']), species)
+        self.assertEqual(list(batch['records']), species)
+        
+        for code in species:
+            species_range = self.json(self.client.get('/species-range.json', {'species': code}))
+            species_points = self.json(self.client.get('/species-points.json', {'species': code}))
+            self.assertEqual(sort(batch['bentities'][code]), sort(species_range['bentities']))
+            self.assertEqual(sort(batch['records'][code]), sort(species_points['records']))
+        self.assertEqual(batch['records'][species[3]], [])
+        
+        points = self.json(self.client.get('/species-batch.json', {'species': species, 'include': 'points'}))
+        self.assertEqual(list(points), ['records'])
+        self.assertEqual(points['records'], batch['records'])
+        
+        csv = b''.join(self.client.get('/species-batch.csv', {'species': species, 'include': 'points'}).streaming_content)
+        self.assertEqual(len(csv.decode('utf-8').splitlines()), 1 + sum(len(records) for records in batch['records'].values()))
+    
+    
+    def test_errors(self):
+        for query in ({}, {'species': ','.join('a.%d' % i for i in range(MAX_BATCH_SPECIES + 1))},
+                      {'species': 'a.b', 'include': 'range,everything'}):
+            self.assertTrue(self.json(self.client.get('/species-batch.json', query))['error'])
+        
+        response = self.client.get('/species-batch.csv', {'species': 'a.b'})
+        self.assertIn(b'errormessage', response.content)
+
+
+
+
+class SerializerTests(TestCase):
+    
+    VALUES = ['', 'Lasius niger', 'Côte d\'Ivoire', 'quote " backslash \\ newline \n tab \t', ' ', '\U0001F41C',
+              0, -1, 10 ** 20, True, False, None, 0.1, -2.5, 1e300, 1e-7, float('nan'), float('inf'), float('-inf'), [1, 'a']]
+    
+    def test_values_match_json_dumps(self):
+        for value in self.VALUES:
+            self.assertEqual(serializers.encode_value(value), json.dumps(value))
+            self.assertEqual(serializers.encode_cached(value), json.dumps(value))
+            self.assertEqual(serializers.encode_cached(value), json.dumps(value))
+    
+    
+    def test_objects_match_json_dumps(self):
+        fields = ('a', 'b', 'name with "quotes"', 'c')
+        columns = (2, 0, 1, 2)
+        encoder = serializers.ObjectEncoder(fields, columns, cached=('b',))
+        rows = [tuple(self.VALUES[i:i + 3]) for i in range(len(self.VALUES) - 2)]
+        
+        objects = [OrderedDict((f, row[c]) for f, c in zip(fields, columns)) for row in rows]
+        for row, obj in zip(rows, objects):
+            self.assertEqual(encoder(row), json.dumps(obj))
+        
+        self.assertEqual(serializers.encode_object_list('records', rows, encoder, [('next_cursor', None), ('total_count', 3)]),
+            json.dumps(OrderedDict([('records', objects), ('next_cursor', None), ('total_count', 3)])))
+        self.assertEqual(serializers.ObjectEncoder(())(rows[0]), '{}')
+    
+    
+    def test_fragment_cache_is_bounded(self):
+        self.addCleanup(serializers._fragments.clear)
+        with mock.patch.object(serializers, 'MAX_CACHED_FRAGMENTS', 10):
+            for i in range(25):
+                self.assertEqual(serializers.encode_cached('bentity %d' % i), json.dumps('bentity %d' % i))
+            self.assertLessEqual(len(serializers._fragments), 10)
+    
+    
+    def test_csv_rows_match_dictwriter(self):
+        fields = ('species', 'lat', 'count')
+        columns = (1, 0, 2)
+        rows = [('1.5', 'a.b', 3), ('-2', 'comma, "quote"', None)]
+        
+        expected = StringIO()
+        writer = csv.DictWriter(expected, fields)
+        for row in rows:
+            writer.writerow(dict((f, row[c]) for f, c in zip(fields, columns)))
+        
+        out = StringIO()
+        csv.writer(out).writerows(map(serializers.csv_row_getter(columns), rows))
+        self.assertEqual(out.getvalue(), expected.getvalue())
+        self.assertEqual(serializers.csv_row_getter((1,))(rows[0]), ('a.b',))
+
+
+
+
+class ReferenceRegistryTests(SyntheticDataTestCase):
+    
+    def test_lists_match_sql(self):
+        subfamilies = list(Subfamily.objects.order_by('subfamily_name').values_list('subfamily_name', flat=True))
+        self.assertEqual([s['key'] for s in self.json(self.client.get('/subfamilies.json'))['subfamilies']], subfamilies)
+        
+        genera = list(Genus.objects.filter(subfamily_name=subfamilies[0]).order_by('genus_name').values_list('genus_name', flat=True))
+        self.assertEqual([g['key'] for g in self.json(self.client.get('/genera.json', {'subfamily': subfamilies[0]}))['genera']], genera)
+        
+        bentities = self.json(self.client.get('/bentities.json'))['bentities']
+        self.assertEqual([(b['key'], b['display']) for b in bentities], list(Bentity.objects.order_by('bentity').values_list('gid', 'bentity')))
+        
+        registry = reference_registry.get()
+        shared = ReferenceRegistry.from_arrays(registry.to_arrays())
+        self.assertEqual((shared.bentities, shared.genera, shared.subfamilies, shared.genus_subfamily),
+                         (registry.bentities, registry.genera, registry.subfamilies, registry.genus_subfamily))
+    
+    
+    def test_bentity_names_without_more_queries(self):
+        species = ( SpeciesPoints.objects.exclude(valid_species_name=None).values('valid_species_name')
+                    .annotate(n=Count('bentity', distinct=True)).order_by('-n').values_list('valid_species_name', flat=True)[0] )
+        names = dict(Bentity.objects.values_list('gid', 'bentity'))
+        reference_registry.get()
+        
+        # one query for the points, however many bentities they're in
+        with self.assertNumQueries(1):
+            response = self.client.get('/species-points.json', {'species': species})
+            records = json.loads(b''.join(response.streaming_content).decode('utf-8'))['records']
+        self.assertGreater(len(set(r['bentity_id'] for r in records)), 1)
+        for record in records:
+            self.assertEqual(record['bentity_name'], names.get(record['bentity_id']))
+        
+        with self.assertNumQueries(0):
+            self.client.get('/subfamilies.json')
+            self.client.get('/bentities.csv')
+
+
+
+
+class FakeConnection(object):
+    """
+    Stands in for a replica's django.db connection, which is up or down.
+    """
+    
+    def __init__(self):
+        self.up = True
+        self.connection = None
+        self.in_atomic_block = False
+    
+    def ensure_connection(self):
+        if not self.up:
+            raise DatabaseError('could not connect to server')
+        self.connection = object()
+    
+    def is_usable(self):
+        return self.up
+    
+    def close(self):
+        self.connection = None
+
+
+
+
+@override_settings(ANTMAPS_DB_RETRY_SECONDS=30, ANTMAPS_DB_HEALTH_CHECK_SECONDS=5)
+class ReplicaRouterTests(TestCase):
+    
+    def setUp(self):
+        self.now = 1000.0
+        self.connections = {'replica1': FakeConnection(), 'replica2': FakeConnection()}
+        for target, value in (('connections', self.connections), ('time', lambda: self.now),
+                              ('replica_aliases', lambda: ['replica1', 'replica2'])):
+            patcher = mock.patch('queries.routers.' + target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        
+        self.router = ReplicaRouter()
+        self.router.preferred = 0
+    
+    
+    def test_failover(self):
+        replica1, replica2 = self.connections['replica1'], self.connections['replica2']
+        self.assertEqual(self.router.db_for_read(Species), 'replica1')
+        
+        # (the connection isn't checked again until ANTMAPS_DB_HEALTH_CHECK_SECONDS)
+        replica1.up = False
+        self.assertEqual(self.router.db_for_read(Species), 'replica1')
+        self.now += 5
+        with self.assertLogs('queries.routers', 'WARNING'):
+            self.assertEqual(self.router.db_for_read(Species), 'replica2')
+        self.assertIsNone(replica1.connection)
+        
+        replica2.up = False
+        self.now += 5
+        with self.assertLogs('queries.routers', 'WARNING'):
+            self.assertEqual(self.router.db_for_read(Species), 'default')
+        self.assertEqual(self.router.status(), {'replica1': 25, 'replica2': 30})
+        
+        # a replica that's back up is retried after ANTMAPS_DB_RETRY_SECONDS
+        replica1.up = replica2.up = True
+        self.now += 10
+        self.assertEqual(self.router.db_for_read(Species), 'default')
+        self.now += 15
+        self.assertEqual(self.router.db_for_read(Species), 'replica1')
+    
+    
+    def test_transactions_stay_on_their_replica(self):
+        replica1 = self.connections['replica1']
+        self.assertEqual(self.router.db_for_read(Species), 'replica1')
+        replica1.up = False
+        replica1.in_atomic_block = True
+        self.now += 60
+        self.assertEqual(self.router.db_for_read(Species), 'replica1')
+    
+    
+    def test_other_apps_and_writes_use_the_primary(self):
+        other_app_model = mock.Mock(_meta=mock.Mock(app_label='other'))
+        self.assertIsNone(self.router.db_for_read(other_app_model))
+        self.assertIsNone(self.router.db_for_write(Species))
+        self.assertFalse(self.router.allow_migrate('replica1', 'queries'))
+        self.assertIsNone(self.router.allow_migrate('default', 'queries'))
+
+
+
+
+class SnapshotTests(SyntheticDataTestCase):
+    
+    def responses(self, paths):
+        cache.clear()
+        contents = []
+        for path in paths:
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200, path)
+            contents.append(b''.join(response.streaming_content) if response.streaming else response.content)
+        return contents
+    
+    
+    def test_snapshot_responses_match_the_database(self):
+        species = self.species_with_points()
+        bentity_id = SpeciesBentityPair.objects.filter(valid_species_name=species).values_list('bentity', flat=True)[0]
+        genus = Species.objects.get(taxon_code=species).genus_name_id
+        paths = ['/subfamilies.json', '/genera.csv', '/bentities.json', '/species.json?genus=' + genus,
+                 '/species.json?bentity_id=' + bentity_id, '/species-search.json?q=' + species[:2],
+                 '/bentity-search.json?q=a', '/species-range.json?species=' + species,
+                 '/species-points.json?species=' + species, '/species-points.csv?species=' + species,
+                 '/species-points.json?species=%s&zoom=3' % species, '/species-per-bentity.json',
+                 '/species-per-bentity.json?genus=' + genus, '/species-in-common.json?bentity_id=' + bentity_id,
+                 '/citations.json?species=%s&bentity_id=%s' % (species, bentity_id),
+                 '/species-batch.json?species=' + species]
+        expected = self.responses(paths)
+        
+        path = os.path.join(self.make_temp_dir(), 'snapshot.sqlite3')
+        self.assertEqual(export_snapshot(path), 'test')
+        
+        connections.databases['snapshot'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': 'file:%s?mode=ro&immutable=1' % pathname2url(path),
+            'OPTIONS': {'uri': True},
+        }
+        self.addCleanup(connections.databases.pop, 'snapshot')
+        self.addCleanup(lambda: connections['snapshot'].close())
+        
+        # read everything from the snapshot (with a new data version, so the
+        # in-memory indexes are built from it too)
+        with mock.patch('queries.routers.ReplicaRouter.db_for_read',
+                        lambda router, model, **hints: 'snapshot' if model._meta.app_label == 'queries' else None), \
+                self.settings(ANTMAPS_DATA_VERSION='snapshot'):
+            with CaptureQueriesContext(connections['snapshot']) as queries:
+                contents = self.responses(paths)
+            self.assertTrue(queries.captured_queries)
+        
+        for path, expected_content, content in zip(paths, expected, contents):
+            self.assertEqual(content, expected_content, path)
+        
+        with connections['snapshot'].cursor() as cursor:
+            cursor.execute('SELECT "value" FROM "snapshot_info" WHERE "key" = %s', ['data_version'])
+            self.assertEqual(cursor.fetchone()[0], 'test')
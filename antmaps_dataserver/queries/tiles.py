@@ -0,0 +1,136 @@
+"""
+Map tiles (z/x/y, in the usual Web Mercator tiling) with the data for the part
+of the map the user is looking at, so the front end doesn't need to download
+all of the points and bentities at once.
+
+A tile has up to two layers:
+
+- "points": a species' points, clustered for the tile's zoom level (see
+  queries.spatial.cluster_points,) clipped to the tile, with x/y positions as
+  integers from 0 to TILE_EXTENT relative to the tile's top-left corner
+- "bentities": attributes (eg. species counts) for the bentities that may be
+  on the tile, for coloring the front end's bentity polygons.  There are no
+  bentity shapes in the database, so a bentity is on every tile that 
+  overlaps the bounding box of all of its points (not only the species' 
+  points,) and bentities without any points are on every tile.
+
+Each layer is {"fields": [...], "rows": [[...], ...]}, so field names aren't
+repeated for every row.
+
+Tiles are generated when they're first requested, and kept in the Django cache
+(which evicts old tiles) under a key with the data version.  The seed_tiles
+management command pre-generates the tiles for low zoom levels.
+"""
+
+import hashlib
+import json
+from math import atan, degrees, log, pi, radians, sinh, tan
+
+from django.conf import settings
+from django.core.cache import cache
+
+from queries.dataversion import get_data_version
+from queries.spatial import Bounds, point_index, MAX_CLUSTER_ZOOM
+
+
+# tile positions go from 0 to TILE_EXTENT (the same as Mapbox vector tiles)
+TILE_EXTENT = 4096
+
+MAX_TILE_ZOOM = MAX_CLUSTER_ZOOM
+
+# Web Mercator doesn't reach the poles
+MAX_LATITUDE = 85.0511287798
+
+POINT_FIELDS = ('x', 'y', 'lat', 'lon', 'status', 'num_points', 'num_records', 'literature_count', 'museum_count', 'database_count')
+
+
+
+
+def tile_bounds(z, x, y):
+    """
+    Return the queries.spatial.Bounds of tile z/x/y.
+    """
+
+    n = 2.0 ** z
+    return Bounds(
+        min_lat=degrees(atan(sinh(pi * (1 - 2 * (y + 1) / n)))),
+        max_lat=degrees(atan(sinh(pi * (1 - 2 * y / n)))),
+        min_lon=x / n * 360.0 - 180.0,
+        max_lon=(x + 1) / n * 360.0 - 180.0 )
+
+
+
+
+def _world_position(lat, lon):
+    """
+    Return the Web Mercator position of a point, scaled so the whole world
+    is 0 to 1 (from the top-left corner.)
+    """
+
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    wx = (lon + 180.0) / 360.0
+    wy = (1 - log(tan(pi / 4 + radians(lat) / 2)) / pi) / 2
+    return wx, wy
+
+
+
+
+def render_tile(z, x, y, bentity_fields=None, bentity_rows=None, clusters=None):
+    """
+    Return the contents of tile z/x/y as a dict.
+
+    'bentity_fields' and 'bentity_rows' are the field names and rows for the
+    bentities layer, with the bentity ID as the first field of each row.  Only
+    rows for bentities that may be on the tile (see above) are included.  'clusters' is a list of
+    species point clusters for the points layer (from
+    queries.spatial.species_clusters,) which are clipped to the tile.
+    """
+
+    tile = {'z': z, 'x': x, 'y': y, 'extent': TILE_EXTENT}
+    bounds = tile_bounds(z, x, y)
+
+    if clusters is not None:
+        n = 2 ** z
+        rows = []
+        for c in clusters:
+            if not bounds.contains(c[0], c[1]):
+                continue
+            wx, wy = _world_position(c[0], c[1])
+            px = min(TILE_EXTENT, max(0, int(round((wx * n - x) * TILE_EXTENT))))
+            py = min(TILE_EXTENT, max(0, int(round((wy * n - y) * TILE_EXTENT))))
+            rows.append([px, py] + list(c))
+
+        tile['points'] = {'fields': POINT_FIELDS, 'rows': rows}
+
+    if bentity_rows is not None:
+        index = point_index.get()
+        on_tile = index.bentities_overlapping(bounds)
+        tile['bentities'] = {
+            'fields': bentity_fields,
+            'rows': [list(row) for row in bentity_rows 
+                     if row[0] in on_tile or row[0] not in index.bentity_extents] }
+
+    return tile
+
+
+
+
+def get_tile(layer_key, z, x, y, render):
+    """
+    Return the JSON for tile z/x/y from the cache, calling render() to make
+    the tile dict if it isn't cached yet.
+
+    'layer_key' is a tuple identifying what's on the tile (eg. ('genus',
+    'Lasius'),) so different tiles for the same z/x/y get different cache keys.
+    """
+
+    arguments = repr((layer_key, z, x, y)).encode('utf-8')
+    key = 'tile:%s:%s' % (get_data_version(), hashlib.md5(arguments).hexdigest())
+
+    content = cache.get(key)
+    if content is None:
+        content = json.dumps(render())
+        cache.set(key, content, settings.ANTMAPS_TILE_CACHE_SECONDS)
+
+    return content
+
@@ -5,14 +5,27 @@ for Ant Maps.
 
 import csv
 import json
-from re import split
+from base64 import urlsafe_b64encode, b64decode
+from itertools import groupby
+from operator import itemgetter
+from re import split, fullmatch, DOTALL
 from io import StringIO
+from uuid import uuid4
 
+from django.conf import settings
 from django.http import HttpResponse, StreamingHttpResponse
-from django.db.models import Q
+from django.db import connections, router, transaction
 from django.views.decorators.cache import never_cache
+from django.views.decorators.http import etag
 
-from queries.models import Subfamily, Genus, Species, Record, Bentity, SpeciesBentityPair, Taxonomy, SpeciesPoints
+from queries.models import Species, Record, SpeciesBentityPair, Taxonomy, SpeciesPoints
+from queries import pointformat
+from queries.serializers import ObjectEncoder, encode_object_list, csv_row_getter
+from queries.dataversion import data_version_etag
+from queries.metrics import serializing
+from queries.spatial import point_index, Bounds, parse_coordinate, species_clusters, MAX_CLUSTER_ZOOM
+from queries.tiles import get_tile, render_tile, MAX_TILE_ZOOM
+from queries.indexes import reference_registry, species_prefix_index, bentity_ngram_index, native_species_matrix, diversity_rollup
 
 
 
@@ -23,19 +36,37 @@ class JSONResponse(HttpResponse):
     An HttpResponse that renders its content into JSON.
     """
     def __init__(self, data, **kwargs):
-        content = json.dumps(data)
+        with serializing():
+            content = json.dumps(data)
         kwargs['content_type'] = 'application/json'
         super(JSONResponse, self).__init__(content, **kwargs)
 
 
+class JSONRowsResponse(HttpResponse):
+    """
+    An HttpResponse with {key: [object, object, ...]} JSON, with each object
+    encoded straight from a row tuple by 'encoder' (a 
+    queries.serializers.ObjectEncoder,) without building dicts.  'extra' is a
+    list of (key, value) pairs to add after the list.
+    """
+    def __init__(self, key, rows, encoder, extra=(), **kwargs):
+        with serializing():
+            content = encode_object_list(key, rows, encoder, extra)
+        kwargs['content_type'] = 'application/json'
+        super(JSONRowsResponse, self).__init__(content, **kwargs)
+
+
 class CSVResponse(HttpResponse):
     """
     An HttpResponse that renders its contents as a CSV.
     
     'rows' should be a list of dict objects, with each entry corresponding to 1 CSV field.
     'fields' is the ordered list of field names in the CSV.
+    
+    If 'columns' is given, 'rows' are tuples instead of dicts, and columns[i]
+    is the index of fields[i] in each tuple.
     """
-    def __init__(self, rows, fields, **kwargs):
+    def __init__(self, rows, fields, columns=None, **kwargs):
                
         csvfile = StringIO()
         
@@ -44,9 +75,13 @@ class CSVResponse(HttpResponse):
         headerwriter.writerow(fields)
                                       
         # Write CSV rows
-        writer = csv.DictWriter(csvfile, fields, extrasaction='ignore')
-        for row in rows:
-            writer.writerow(row)
+        with serializing():
+            if columns is not None:
+                csv.writer(csvfile).writerows(map(csv_row_getter(columns), rows))
+            else:
+                writer = csv.DictWriter(csvfile, fields, extrasaction='ignore')
+                for row in rows:
+                    writer.writerow(row)
             
             
         kwargs['content_type'] = 'text/csv'
@@ -56,6 +91,218 @@ class CSVResponse(HttpResponse):
 
 
 
+# How many rows to read from the database (and write to the client) at a time
+# when streaming a response.
+STREAMING_CHUNK_SIZE = 2000
+
+
+def server_side_rows(queryset, chunk_size=STREAMING_CHUNK_SIZE):
+    """
+    Generator that yields the rows of a values_list() queryset as tuples, 
+    without ever loading the whole result set into memory.
+    
+    On Postgres, the rows are read through a named (server-side) cursor, 
+    'chunk_size' rows per round trip.  Other databases (eg. SQLite for testing)
+    fall back to fetchmany() on a regular cursor.
+    
+    Since this bypasses the Django ORM, values come straight from the database
+    driver (no field conversion.)
+    """
+    
+    sql, params = queryset.query.sql_with_params()
+    yield from server_side_sql_rows(queryset.db, sql, params, chunk_size)
+    
+    
+def server_side_sql_rows(using, sql, params=(), chunk_size=STREAMING_CHUNK_SIZE):
+    """
+    Like server_side_rows, but for an SQL query on database 'using'.
+    """
+    
+    connection = connections[using]
+    
+    if connection.vendor == 'postgresql':
+        # named cursors only live inside a transaction
+        with transaction.atomic(using=using):
+            connection.ensure_connection()
+            cursor = connection.connection.cursor(name='antmaps_stream_' + uuid4().hex)
+            cursor.itersize = chunk_size
+            cursor = connection.make_cursor(cursor)  # (so it's measured, see queries/metrics.py)
+            try:
+                cursor.execute(sql, params)
+                yield from _fetch_in_chunks(cursor, chunk_size)
+            finally:
+                cursor.close()
+    
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            yield from _fetch_in_chunks(cursor, chunk_size)
+            
+            
+def server_side_rows_for_pks(queryset, pks, chunk_size=STREAMING_CHUNK_SIZE):
+    """
+    Like server_side_rows, but only for the rows of 'queryset' with primary
+    keys in 'pks' (eg. from one of the in-memory indexes,) looked up 
+    'chunk_size' keys at a time.
+    """
+    
+    for start in range(0, len(pks), chunk_size):
+        yield from server_side_rows(queryset.filter(pk__in=pks[start:start+chunk_size]), chunk_size)
+        
+        
+def _fetch_in_chunks(cursor, chunk_size):
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield from rows
+        
+        
+def with_bentity_names(rows, column):
+    """
+    Insert the bentity name after the bentity ID in column 'column' of each
+    row, looked up in the reference registry (see queries/indexes.py) instead
+    of joining bentity2 in the query.  The rows are read lazily.
+    """
+    
+    names = reference_registry.get().bentity_names
+    return (row[:column+1] + (names.get(row[column]),) + row[column+1:] for row in rows)
+
+
+
+
+class StreamingJSONResponse(StreamingHttpResponse):
+    """
+    A StreamingHttpResponse that renders its content into JSON incrementally.
+    
+    The output is {key: [row, row, ...]}, byte-for-byte the same as 
+    JSONResponse({key: list(rows)}), but 'rows' can be any iterable of 
+    JSON-serializable objects (eg. a generator reading from server_side_rows,)
+    and is only consumed as the response is sent.
+    
+    'encoder' turns each row into JSON text, eg. a 
+    queries.serializers.ObjectEncoder to write row tuples as objects.  'extra'
+    is a list of (key, value) pairs to add after the list (the same as 
+    JSONRowsResponse.)
+    """
+    def __init__(self, key, rows, encoder=json.dumps, chunk_size=STREAMING_CHUNK_SIZE, extra=(), **kwargs):
+        kwargs['content_type'] = 'application/json'
+        super(StreamingJSONResponse, self).__init__(self._render(key, rows, encoder, chunk_size, extra), **kwargs)
+        
+        
+    @staticmethod
+    def _render(key, rows, encoder, chunk_size, extra):
+        yield '{' + json.dumps(key) + ': ['
+        
+        chunk = []
+        separator = ''
+        for row in rows:
+            chunk.append(separator + encoder(row))
+            separator = ', '
+            if len(chunk) >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+        
+        yield ''.join(chunk) + ']' + ''.join(', ' + json.dumps(k) + ': ' + json.dumps(v) for k, v in extra) + '}'
+
+
+class StreamingCSVResponse(StreamingHttpResponse):
+    """
+    A StreamingHttpResponse that renders its contents as a CSV incrementally.
+    
+    Takes the same arguments as CSVResponse, but 'rows' can be any iterable of
+    dict objects (or tuples, with 'columns',) and is only consumed as the 
+    response is sent.
+    """
+    def __init__(self, rows, fields, columns=None, chunk_size=STREAMING_CHUNK_SIZE, **kwargs):
+        kwargs['content_type'] = 'text/csv'
+        super(StreamingCSVResponse, self).__init__(self._render(rows, fields, columns, chunk_size), **kwargs)
+        self['Content-Disposition'] = 'attachment'
+        
+        
+    @staticmethod
+    def _render(rows, fields, columns, chunk_size):
+        csvfile = StringIO()
+        
+        # Write header with field names
+        headerwriter = csv.writer(csvfile)
+        headerwriter.writerow(fields)
+        
+        # Write CSV rows, emptying the buffer every chunk_size rows
+        if columns is not None:
+            write = csv.writer(csvfile).writerow
+            rows = map(csv_row_getter(columns), rows)
+        else:
+            write = csv.DictWriter(csvfile, fields, extrasaction='ignore').writerow
+        
+        for i, row in enumerate(rows, 1):
+            write(row)
+            if i % chunk_size == 0:
+                yield csvfile.getvalue()
+                csvfile.seek(0)
+                csvfile.truncate()
+        
+        yield csvfile.getvalue()
+
+
+class StreamingGroupedJSONResponse(StreamingHttpResponse):
+    """
+    A StreamingHttpResponse that renders rows grouped by a key into JSON
+    incrementally.
+
+    'sections' is a list of (section key, rows, encoder), where 'rows' is an
+    iterable of tuples with the group key in the first column and all rows for
+    a group next to each other (eg. ordered by the group key,) and
+    encoder(row) makes the JSON for a row (see queries.serializers.)  The output is
+    {section key: {group key: [object, object, ...], ...}, ...}, with a key
+    (and an empty list) for every group in 'group_keys' that has no rows.
+    'extra' is a list of (key, value) pairs to add before the sections.
+    """
+    def __init__(self, sections, group_keys, chunk_size=STREAMING_CHUNK_SIZE, extra=(), **kwargs):
+        kwargs['content_type'] = 'application/json'
+        super(StreamingGroupedJSONResponse, self).__init__(self._render(sections, group_keys, chunk_size, extra), **kwargs)
+
+
+    @staticmethod
+    def _render(sections, group_keys, chunk_size, extra):
+        section_separator = '{'
+        if extra:
+            yield '{' + ', '.join(json.dumps(k) + ': ' + json.dumps(v) for k, v in extra)
+            section_separator = ', '
+
+        for section_key, rows, encoder in sections:
+            yield section_separator + json.dumps(section_key) + ': {'
+            section_separator = ', '
+
+            chunk = []
+            group_separator = ''
+            seen = set()
+            for group_key, group in groupby(rows, key=itemgetter(0)):
+                seen.add(group_key)
+                chunk.append(group_separator + json.dumps(group_key) + ': [')
+                group_separator = ', '
+
+                separator = ''
+                for row in group:
+                    chunk.append(separator + encoder(row))
+                    separator = ', '
+                    if len(chunk) >= chunk_size:
+                        yield ''.join(chunk)
+                        chunk = []
+                chunk.append(']')
+
+            for group_key in group_keys:
+                if group_key not in seen:
+                    chunk.append(group_separator + json.dumps(group_key) + ': []')
+                    group_separator = ', '
+
+            yield ''.join(chunk) + '}'
+
+        yield '}' if sections or extra else '{}'
+
+
+
+
 def errorResponse(errormessage, format, extraJSON={}):
     """
     A nice standardized way to show the user an error message.
@@ -75,6 +322,100 @@ def errorResponse(errormessage, format, extraJSON={}):
 
 
 
+def limit_argument(request):
+    """
+    Return the 'limit' argument from the URL query string as an int, or None if
+    it's not given.  Raise a ValueError with a message for the user if it's 
+    not a non-negative integer.
+    """
+    
+    if not request.GET.get('limit'):
+        return None
+    
+    try:
+        limit = int(request.GET.get('limit'))
+    except ValueError:
+        limit = -1
+    
+    if limit < 0:
+        raise ValueError("The 'limit' argument must be a non-negative integer.")
+    
+    return limit
+
+
+
+
+def page_cursor(key, count):
+    """
+    Return the opaque "cursor" argument for the page of results after the 
+    first 'count' rows with (string) key 'key'.  (Rows can share a key, so
+    the cursor says how many of them have been seen.)
+    """
+    
+    cursor = '%d:%s' % (count, key)
+    return urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def cursor_argument(request):
+    """
+    Return (key, count) from the "cursor" argument in the URL query string 
+    (see page_cursor,) or None if it's not given.  'count' is None for a
+    cursor from before rows could share a key, which means all of the rows
+    with the key have been seen.  Raise a ValueError with a message for the 
+    user if it isn't a valid cursor.
+    """
+    
+    cursor = request.GET.get('cursor')
+    if not cursor:
+        return None
+    
+    try:
+        cursor = b64decode(cursor + '=' * (-len(cursor) % 4), b'-_', validate=True).decode('utf-8')
+        parts = fullmatch(r'(\d+):(.*)', cursor, DOTALL)
+        if parts:
+            return parts.group(2), int(parts.group(1))
+        return cursor, None
+    except ValueError:
+        raise ValueError("The 'cursor' argument isn't valid, use the 'next_cursor' from the previous page.")
+
+
+
+
+def bounds_arguments(request):
+    """
+    Return a queries.spatial.Bounds from the "lat", "lon", "min_lat", "max_lat",
+    "min_lon" and "max_lon" arguments in the URL query string ("lat" and "lon"
+    select an exact point,) or None if none of them are given.  Raise a 
+    ValueError with a message for the user if any of them aren't numbers, or
+    are off the globe.
+    """
+    
+    values = {}
+    for arg in ('lat', 'lon', 'min_lat', 'max_lat', 'min_lon', 'max_lon'):
+        if request.GET.get(arg):
+            values[arg] = parse_coordinate(request.GET.get(arg))
+            if values[arg] is None:
+                raise ValueError("The '%s' argument must be a number." % arg)
+            
+            limit = 90 if arg.endswith('lat') else 180
+            if not -limit <= values[arg] <= limit:
+                raise ValueError("The '%s' argument must be between -%d and %d." % (arg, limit, limit))
+    
+    if not values:
+        return None
+    
+    # an exact lat or lon is a box with the same min and max
+    for axis in ('lat', 'lon'):
+        if axis in values:
+            values['min_' + axis] = max(values[axis], values.get('min_' + axis, values[axis]))
+            values['max_' + axis] = min(values[axis], values.get('max_' + axis, values[axis]))
+    
+    return Bounds(values.get('min_lat'), values.get('max_lat'), values.get('min_lon'), values.get('max_lon'))
+
+
+
+
+@etag(data_version_etag)
 def subfamily_list(request, format='csv'):
     """
     Return a CSV or JSON response with a sorted list of subfamilies.  
@@ -83,11 +424,9 @@ def subfamily_list(request, format='csv'):
     names to use as a database key, and to display to the user (the same for now.)
     """
     
-    subfamilies = ( Subfamily.objects.all()
-                    .order_by('subfamily_name')
-                    .values_list('subfamily_name', flat=True) )
-                    
-                        
+    subfamilies = reference_registry.get().subfamilies
+    
+    
     
     if format == 'csv':
         return CSVResponse(
@@ -103,6 +442,7 @@ def subfamily_list(request, format='csv'):
     
     
     
+@etag(data_version_etag)
 def genus_list(request, format='csv'):
     """
     Return a CSV or JSON response with a sorted list of genera. 
@@ -115,13 +455,12 @@ def genus_list(request, format='csv'):
     """
 
 
-    genera = ( Genus.objects.all()
-                .order_by('genus_name')
-                .values_list('genus_name', flat=True) )
+    registry = reference_registry.get()
+    genera = registry.genera
                 
     # if the user supplied a subfamily, get genuses with that subfamily
     if request.GET.get('subfamily'):
-        genera = genera.filter(subfamily_name=request.GET.get('subfamily').capitalize())
+        genera = registry.subfamily_genera.get(request.GET.get('subfamily').capitalize(), [])
     
     
     
@@ -142,6 +481,7 @@ def genus_list(request, format='csv'):
     
     
     
+@etag(data_version_etag)
 def species_list(request, format='csv'):
     """
     Return a CSV or JSON response with a sorted list of species. 
@@ -152,36 +492,40 @@ def species_list(request, format='csv'):
     If there's a "genus", "subfamily", "bentity_id", or "bentity2_id" in the query 
     string, return only species matching these supplied parameters.  
     
-    Bentity and bentity2 functionally both do the same thing, and are useful
-    for finding species that are present in both bentities.  If you just need one,
-    use "bentity_id" instead of "bentity2_id" for slightly better performance.
+    Any number of bentities can be given, by repeating "bentity_id" (or 
+    "bentity2_id") and/or separating bentity ID's with commas.  By default,
+    return species native to all of the bentities.  Set "bentity_mode" to 
+    "union" for species native to any of them, or "difference" for species
+    native to the first bentity but none of the others.
+    
+    Bentity filters are answered from the in-memory native species matrix (see
+    queries/indexes.py,) so adding more bentities doesn't add more SQL joins.
     """
     
     
     filtered = False # make sure we're filtering by something
+    filtered_by_taxonomy = False # only query the species table if filtering by genus or subfamily
     species = Species.objects.all().order_by('taxon_code')
     
     if request.GET.get('genus'):
-        filtered = True
+        filtered = filtered_by_taxonomy = True
         species = species.filter(genus_name=request.GET.get('genus').capitalize())
         
     if request.GET.get('subfamily'):
-        filtered = True
+        filtered = filtered_by_taxonomy = True
         species = species.filter(genus_name__subfamily_name=request.GET.get('subfamily').capitalize())
         
-    # speciesbentitypair__status='N' for only native species
-    bentity = request.GET.get('bentity_id') 
-    if bentity:
-        filtered = True
-        species = species.filter(speciesbentitypair__bentity=bentity, speciesbentitypair__category='N')
-    
-    # supply 'bentity2' to get species overlapping between 2 bentities
-    # speciesbentitypair__status='N' for only native species    
-    bentity2 = request.GET.get('bentity2_id')
-    if bentity2: 
+    # native species for any number of bentities
+    bentity_ids = [b for arg in request.GET.getlist('bentity_id') + request.GET.getlist('bentity2_id')
+                     for b in arg.split(',') if b]
+    in_bentities = None
+    if bentity_ids:
         filtered = True
-        species_in_bentity2 = species.filter(speciesbentitypair__bentity=bentity2, speciesbentitypair__category='N').distinct()
-        species = species.filter(pk__in=species_in_bentity2) # intersection
+        matrix = native_species_matrix.get()
+        try:
+            in_bentities = matrix.species(matrix.combine(bentity_ids, request.GET.get('bentity_mode') or 'intersection'))
+        except ValueError:
+            return errorResponse("The 'bentity_mode' argument must be 'intersection', 'union', or 'difference'.", format, {"species":[]})
 
 
     	
@@ -192,20 +536,31 @@ def species_list(request, format='csv'):
          
     
     # return species list if it was filtered by something
-    # s.genus_name_id gets the actual text of the genus_name, instead of the related object     
+    # as (taxon_code, display name) tuples sorted by taxon_code
     else:
        
+        if filtered_by_taxonomy:
+            # s.genus_name_id gets the actual text of the genus_name, instead of the related object
+            species = [(s.taxon_code, s.genus_name_id + ' ' + s.species_name) for s in species]
+            if in_bentities is not None:
+                in_bentities = set(in_bentities)
+                species = [s for s in species if s[0] in in_bentities]
+        
+        else:
+            labels = species_prefix_index.get().labels_by_taxon_code
+            species = [(code, labels[code]) for code in in_bentities if code in labels]
+        
         
         if format == 'csv':
             # serialize to CSV
             return CSVResponse( 
-                [{'species': s.taxon_code} for s in species], 
+                [{'species': taxon_code} for taxon_code, display in species], 
                 fields=('species',)    )
             
         
         else:
             # serialize to JSON
-            json_objects = [{'key': s.taxon_code, 'display': (s.genus_name_id + ' ' + s.species_name)} for s in species]
+            json_objects = [{'key': taxon_code, 'display': display} for taxon_code, display in species]
             return JSONResponse({'species': json_objects})
 
 
@@ -216,6 +571,7 @@ def species_list(request, format='csv'):
 
 # currently doesn't do anything with the format argument
 # (not a part of the public API)
+@etag(data_version_etag)
 def antweb_links(request, format='csv'):
 	"""
 	Given a taxon code in the URL query string, returns a JSON response with the species,
@@ -261,12 +617,18 @@ def antweb_links(request, format='csv'):
 
 
 @never_cache
+@etag(data_version_etag)
 def species_autocomplete(request, format='csv'):
     """
     Given a query 'q' in the URL query string, split q into tokens and return
     a list of species for which the tokens in q are a prefix of the genus name
     or species name.  (Used for species-search autocomplete.)
     
+    If a 'limit' is given in the query string, return at most that many species.
+    
+    The search is answered from an in-memory index of species names (see 
+    queries/indexes.py,) so it doesn't hit the database on every keystroke.
+    
     JSON: For each species, return a 
     {label: -species name-, value: -species_code-} object.
     """
@@ -274,14 +636,16 @@ def species_autocomplete(request, format='csv'):
     if request.GET.get('q'):
         q = request.GET.get('q')
         
-        species = Species.objects.all().order_by('taxon_code')
+        try:
+            limit = limit_argument(request)
+        except ValueError as e:
+            return errorResponse(str(e), format, {'species': []})
         
         # split tokens by period or white space
         q_tokens = split(r'[.\s]+', q)
         
         # prefix match for each token in the search string against genus name or species name
-        for token in q_tokens:
-            species = species.filter(Q(species_name__istartswith=token) | Q(genus_name__genus_name__istartswith=token))
+        species = species_prefix_index.get().search(q_tokens, limit)
         
     
     
@@ -296,39 +660,48 @@ def species_autocomplete(request, format='csv'):
     if format == 'csv':
         # serialize results as CSV
         return CSVResponse(
-             [{'species': s.taxon_code} for s in species], 
+             [{'species': taxon_code} for taxon_code, label in species], 
              fields=('species',)  )
         
                 
     else:
         # serialize results as JSON
-        JSON_objects = [{'label': (s.genus_name_id + ' ' + s.species_name), 'value': s.taxon_code} for s in species]
+        JSON_objects = [{'label': label, 'value': taxon_code} for taxon_code, label in species]
         return JSONResponse({'species': JSON_objects})
         
         
+        
+        
 
 
 
-
-
-
+@etag(data_version_etag)
 def bentity_autocomplete(request, format='csv'):
     """
     Return a list of bentities with names containing the query argument 'q'.
     Return an empty list if no argument given.
+    
+    Bentities with names starting with one of the tokens in 'q' are listed 
+    first.  If a 'limit' is given in the query string, return at most that 
+    many bentities.
+    
+    The search is answered from an in-memory n-gram index of bentity names
+    (see queries/indexes.py,) so it doesn't hit the database on every keystroke.
     """
         
     if request.GET.get('q'):
         q = request.GET.get('q')
         
-        bentities = Bentity.objects.all().order_by('bentity')
+        try:
+            limit = limit_argument(request)
+        except ValueError as e:
+            return errorResponse(str(e), format, {'bentities': []})
     
         # split tokens by period or white space
         q_tokens = split(r'[.\s]+', q)
    
-        # prefix match for each token in the search string against genus name or species name
-        for token in q_tokens:
-            bentities = bentities.filter(bentity__icontains=token)
+        # substring match for each token in the search string against bentity name
+        bentities = bentity_ngram_index.get().search(q_tokens, limit)
         
     
     else:
@@ -338,15 +711,15 @@ def bentity_autocomplete(request, format='csv'):
     if format == 'csv':
         # Serislize CSV for API
         return CSVResponse(
-            [{'bentity_id': b.gid, 'bentity_name': b.bentity} for b in bentities],
+            [{'bentity_id': gid, 'bentity_name': name} for gid, name in bentities],
             ('bentity_id', 'bentity_name')   )
     
     else:
         # Serialize JSON for bentity-list widget
         json_objects = [{
-            'bentity_id': b.gid,
-            'bentity_name': b.bentity,
-            } for b in bentities]
+            'bentity_id': gid,
+            'bentity_name': name,
+            } for gid, name in bentities]
         return JSONResponse({'bentities' : json_objects})
 
 
@@ -355,6 +728,7 @@ def bentity_autocomplete(request, format='csv'):
        
        
 
+@etag(data_version_etag)
 def bentity_list(request, format='csv'):
     """
     Return a CSV or JSON response with a list of bentities for the diversity mode.
@@ -364,21 +738,19 @@ def bentity_list(request, format='csv'):
     """
        
        
-    bentities = Bentity.objects.all().order_by('bentity')
+    bentities = reference_registry.get().bentities
     
     
     if format == 'csv':
         # Serislize CSV for API
-        return CSVResponse(
-            [{'bentity_id': b.gid, 'bentity_name': b.bentity} for b in bentities],
-            ('bentity_id', 'bentity_name')   )
+        return CSVResponse(bentities, ('bentity_id', 'bentity_name'), columns=(0, 1))
     
     else:
         # Serialize JSON for bentity-list widget
         json_objects = [{
-           'key': b.gid,
-           'display': b.bentity,
-        } for b in bentities]
+           'key': gid,
+           'display': name,
+        } for gid, name in bentities]
     
         return JSONResponse({'bentities' : json_objects})
     
@@ -387,6 +759,17 @@ def bentity_list(request, format='csv'):
     
     
     
+# species_points JSON objects, from the values_list rows in species_points
+POINT_ENCODER = ObjectEncoder(
+    ('gabi_acc_number', 'species', 'lat', 'lon', 'status', 'bentity_id', 'bentity_name', 
+        'num_records', 'literature_count', 'museum_count', 'database_count'),
+    cached=('species', 'status', 'bentity_id', 'bentity_name') )
+
+# species_points CSV fields, and their columns in the values_list rows
+POINT_CSV_FIELDS = ('species', 'lat', 'lon', 'bentity_id', 'bentity_name', 'status', 'num_records', 'literature_count', 'museum_count', 'database_count')
+POINT_CSV_COLUMNS = (1, 2, 3, 5, 6, 4, 7, 8, 9, 10)
+
+@etag(data_version_etag)
 def species_points(request, format='csv'):
     """
     Return a CSV or JSON response with a list of geo points for a species.  
@@ -394,67 +777,77 @@ def species_points(request, format='csv'):
     JSON: For each record, include a 
     {gabi_acc_number:xxx, lat:xxx, lon:xxx, status:x} object.
     
+    BIN: The same points in a compact binary format with one column per field,
+    see queries/pointformat.py.
+    
     A "species" must be provided in the URL query string, to specify the species.
+    
+    Points can be filtered by "lat" and "lon" (exact point,) and/or by a 
+    bounding box with "min_lat", "max_lat", "min_lon" and "max_lon".  These
+    are compared as numbers, using the in-memory spatial index (see 
+    queries/spatial.py.)  If min_lon > max_lon, the box wraps around longitude
+    180.  If all four bounding box arguments are given, "species" can be left
+    out to get the points for every species in the box (except in BIN format.)
+    
+    JSON and CSV are streamed from a server-side cursor, so widespread species
+    don't take more memory than rare ones.  Responses up to 
+    settings.ANTMAPS_CACHE_STREAMING_MAX_BYTES long are still cached, see 
+    queries/middleware.py.
+    
+    If a map "zoom" level is given (with a "species",) return the points 
+    grouped into grid cells instead, see species_clusters.
     """
     
     
     species = request.GET.get('species')
-    if species:
+    
+    try:
+        bounds = bounds_arguments(request)
+    except ValueError as e:
+        return errorResponse(str(e), format, {'records':[]})
+    
+    
+    if species and request.GET.get('zoom'):
+        return species_clusters_response(request, species, bounds, format)
+    
+    elif species or (bounds is not None and bounds.is_complete() and format != 'bin'):
         records = ( SpeciesPoints.objects
-            .filter(valid_species_name=species)
             .filter(lon__isnull=False)
             .filter(lat__isnull=False) )
         
-        
-        if request.GET.get('lon'):
-            records = records.filter(lon=request.GET.get('lon'))
-            
-        if request.GET.get('lat'):
-            records = records.filter(lat=request.GET.get('lat'))
-            
-        if request.GET.get('max_lat'):
-            records = records.filter(lat__lte=request.GET.get('max_lat'))
-            
-        if request.GET.get('max_lon'):
-            records = records.filter(lon__lte=request.GET.get('max_lon'))
-        
-        if request.GET.get('min_lat'):
-            records = records.filter(lat__gte=request.GET.get('min_lat'))
-            
-        if request.GET.get('min_lon'):
-            records = records.filter(lon__gte=request.GET.get('min_lon'))
+        if species:
+            records = records.filter(valid_species_name=species)
         
         if request.GET.get('bentity_id'):
             records = records.filter(bentity_id=request.GET.get('bentity_id'))        
         
         
         
-        # fetch all the bentitites at once, so we don't have to hit the database once for each record
-        records = records.prefetch_related('bentity') 
+        records = records.values_list('gabi_acc_number', 'valid_species_name', 'lat', 'lon', 'status', 
+            'bentity', 'num_records', 'literature_count', 'museum_count', 'database_count')
         
-        # serialize to JSON
-        export_objects = [{
-            'gabi_acc_number': r.gabi_acc_number,
-            'species': species,
-            'lat': r.lat,
-            'lon': r.lon,
-            'status':r.status,
-            'bentity_id': r.bentity_id,
-            'bentity_name': r.bentity.bentity,
-            'num_records': r.num_records,
-            'literature_count': r.literature_count,
-            'museum_count': r.museum_count,
-            'database_count': r.database_count,
-        } for r in records]
+        # read the rows from a server-side cursor, only the points inside
+        # the bounds if there are any
+        if bounds is None:
+            rows = server_side_rows(records)
+        elif species:
+            rows = server_side_rows_for_pks(records, point_index.get().species_points(species, bounds))
+        else:
+            rows = server_side_rows_for_pks(records, point_index.get().points(bounds))
         
+        # (bentity names are added after the bentity ID, column 5)
+        rows = with_bentity_names(rows, 5)
         
-        if format == 'csv':
-            return CSVResponse(
-                export_objects,
-                fields=('species', 'lat', 'lon', 'bentity_id', 'bentity_name', 'status', 'num_records', 'literature_count', 'museum_count', 'database_count') )
+        if format == 'bin':
+            return HttpResponse(
+                pointformat.encode_points(species, (r[2:] for r in rows)),
+                content_type=pointformat.CONTENT_TYPE )
+        
+        elif format == 'csv':
+            return StreamingCSVResponse(rows, fields=POINT_CSV_FIELDS, columns=POINT_CSV_COLUMNS)
         
-        else:        
-            return JSONResponse({'records': export_objects})
+        else:
+            return StreamingJSONResponse('records', rows, POINT_ENCODER)
     
     else: # punt if the request doesn't have a species
         return errorResponse("Please supply a 'species' argument.", format, {'records':[]})
@@ -464,6 +857,68 @@ def species_points(request, format='csv'):
         
         
         
+def species_clusters_response(request, species, bounds, format):
+    """
+    The species_points response when a map "zoom" level is given: the species'
+    points grouped into grid cells about 32 pixels wide at that zoom level (see
+    queries/spatial.py,) so the response size is bounded no matter how many
+    points the species has.  Each zoom level is computed once per species and
+    cached.
+    
+    For each cell, include the mean position of its points, the number of 
+    points, the summed record counts, and the status with the most records.
+    Only cells with their position inside the bounding box are returned.
+    
+    JSON: For each cell, include a {species:xxx, lat:xxx, lon:xxx, status:x, 
+    num_points:xxx, num_records:xxx, literature_count:xxx, museum_count:xxx, 
+    database_count:xxx} object.
+    """
+    
+    try:
+        zoom = int(request.GET.get('zoom'))
+        if not 0 <= zoom <= MAX_CLUSTER_ZOOM:
+            raise ValueError
+    except ValueError:
+        return errorResponse("The 'zoom' argument must be an integer from 0 to %d." % MAX_CLUSTER_ZOOM, format, {'records':[]})
+    
+    if format == 'bin':
+        return errorResponse("The 'zoom' argument isn't supported in BIN format.", format, {'records':[]})
+    
+    clusters = species_clusters(species, zoom, request.GET.get('bentity_id'))
+    if bounds is not None:
+        clusters = [c for c in clusters if bounds.contains(c[0], c[1])]
+    
+    export_objects = [{
+        'species': species,
+        'lat': c[0],
+        'lon': c[1],
+        'status': c[2],
+        'num_points': c[3],
+        'num_records': c[4],
+        'literature_count': c[5],
+        'museum_count': c[6],
+        'database_count': c[7],
+    } for c in clusters]
+    
+    if format == 'csv':
+        return CSVResponse(
+            export_objects,
+            fields=('species', 'lat', 'lon', 'status', 'num_points', 'num_records', 'literature_count', 'museum_count', 'database_count') )
+    
+    else:
+        return JSONResponse({'records': export_objects})
+        
+        
+        
+        
+        
+        
+# citations JSON objects, from the values_list rows in citations
+CITATION_ENCODER = ObjectEncoder(
+    ('gabi_acc_number', 'species', 'bentity_id', 'bentity_name', 'status', 'type_of_data', 'lat', 'lon', 'citation'),
+    cached=('species', 'bentity_id', 'bentity_name', 'status', 'type_of_data') )
+
+@etag(data_version_etag)
 def citations(request, format='csv'):
     """
     Citations -- each record from this resource represents one 
@@ -477,10 +932,33 @@ def citations(request, format='csv'):
     1) gabi_acc_number
     2) species AND bentity
     3) lat AND lon
+    
+    Results are also returned in pages ordered by gabi_acc_number, of at most 
+    settings.ANTMAPS_MAX_PAGE_SIZE records (or "limit" records, if that's 
+    smaller.)  If there are more records, the "next_cursor" in the JSON (or the
+    X-Next-Cursor header for CSV) is the "cursor" argument for the next page; 
+    it's null (or there's no header) on the last page.  Each page seeks to 
+    the last gabi_acc_number, so every page costs about the same: one query 
+    for the page's keys (to make the next cursor,) and one for the rows, 
+    which are streamed.  If "count" is given, the total number of records (for
+    all pages) is included as "total_count" (or the X-Total-Count header for 
+    CSV,) which takes another query.
     """
     
+    try:
+        limit = limit_argument(request)
+        after = cursor_argument(request)
+    except ValueError as e:
+        return errorResponse(str(e), format, {'records': []})
+    
+    if limit == 0:
+        return errorResponse("The 'limit' argument must be at least 1.", format, {'records': []})
+    
+    page_size = min(limit or settings.ANTMAPS_MAX_PAGE_SIZE, settings.ANTMAPS_MAX_PAGE_SIZE)
+    
+    
     filtered = False # make sure we're filtering by something
-    records = Record.objects.distinct() #.order_by('gabi_acc_number')
+    records = Record.objects.all()
     
     
     # accession number
@@ -514,28 +992,62 @@ def citations(request, format='csv'):
         return errorResponse("Please supply at least one these argument-combinations: 'gabi_acc_number', ('species' and 'bentity_id'), or ('lat' and 'lon').", format, {'records': []})
          
     
-    # fetch all the bentitites at once, so we don't have to hit the database once for each record
-    records = records.prefetch_related('bentity') 
-        
-    output_objects = [{
-            'gabi_acc_number': r.gabi_acc_number,
-            'species': r.valid_species_name_id,
-            'bentity_id': r.bentity_id,
-            'bentity_name': r.bentity.bentity,
-            'status': r.status,
-            'type_of_data': r.type_of_data,
-            'lat': r.lat,
-            'lon': r.lon,  
-            'citation': r.citation,
-        } for r in records]
+    # map_record has a row for each species-location-citation combination,
+    # which can come up more than once (so the rows are distinct,) and more
+    # than one row can have the same gabi_acc_number.  So the rows are 
+    # ordered by every column, and the cursor has the last gabi_acc_number
+    # on the page and how many rows with it have been sent.
+    records = ( records
+        .values_list('gabi_acc_number', 'valid_species_name', 
+            'bentity', 'status', 'type_of_data', 'lat', 'lon', 'citation')
+        .distinct()
+        .order_by('gabi_acc_number', 'valid_species_name_id', 
+            'bentity_id', 'status', 'type_of_data', 'lat', 'lon', 'citation') )
+    
+    total_count = records.count() if request.GET.get('count') else None
+    
+    
+    skip = 0
+    if after is not None:
+        after_key, skip = after
+        if skip is None:
+            records = records.filter(gabi_acc_number__gt=after_key)
+            skip = 0
+        else:
+            # (the rows with after_key come first, skip the ones already sent)
+            records = records.filter(gabi_acc_number__gte=after_key)
+    
+    # read the keys of one more row than the page size first, to tell if 
+    # there's a next page, and make its cursor (for the CSV header,) then 
+    # stream the rows, with the bentity name after the bentity ID (column 2)
+    sql, params = records[skip:skip + page_size + 1].query.sql_with_params()
+    keys = [row[0] for row in server_side_sql_rows(records.db, 'SELECT "gabi_acc_number" FROM (%s) AS "page"' % sql, params)]
+    rows = with_bentity_names(server_side_rows(records[skip:skip + page_size]), 2)
+    
+    next_cursor = None
+    if len(keys) > page_size:
+        keys = keys[:page_size]
+        count = keys.count(keys[-1])
+        if after is not None and keys[-1] == after_key:
+            count += skip
+        next_cursor = page_cursor(keys[-1], count)
     
     
     
     if format == 'csv':
-        return CSVResponse(output_objects, ('gabi_acc_number', 'species', 'bentity_id', 'bentity_name', 'lat', 'lon', 'status', 'type_of_data', 'citation'))
+        response = StreamingCSVResponse(rows, ('gabi_acc_number', 'species', 'bentity_id', 'bentity_name', 'lat', 'lon', 'status', 'type_of_data', 'citation'),
+            columns=(0, 1, 2, 3, 6, 7, 4, 5, 8))
+        if next_cursor is not None:
+            response['X-Next-Cursor'] = next_cursor
+        if total_count is not None:
+            response['X-Total-Count'] = str(total_count)
+        return response
     
     else:
-        return JSONResponse({'records': output_objects})
+        extra = [('next_cursor', next_cursor)]
+        if total_count is not None:
+            extra.append(('total_count', total_count))
+        return StreamingJSONResponse('records', rows, CITATION_ENCODER, extra=extra)
     
     
     
@@ -543,6 +1055,12 @@ def citations(request, format='csv'):
     
         
         
+# species_range JSON objects, from the values_list rows in species_range
+RANGE_ENCODER = ObjectEncoder(
+    ('gid', 'category', 'num_records', 'literature_count', 'museum_count', 'database_count'),
+    cached=('gid', 'category') )
+
+@etag(data_version_etag)
 def species_range(request, format='csv'):
     """
     Given a 'species' in the URL query string, return a JSON or CSV response with a
@@ -560,10 +1078,11 @@ def species_range(request, format='csv'):
     species = request.GET.get('species')
     
     if species:
-        # look up category for this species for each bentity from the database        
+        # look up category for this species for each bentity from the database
+        # (bentity names come from the reference registry)
         bentities = ( SpeciesBentityPair.objects
                      .filter(valid_species_name=species.capitalize())
-                     .only('bentity', 'category','num_records','literature_count','museum_count','database_count') )
+                     .values_list('bentity', 'category', 'num_records', 'literature_count', 'museum_count', 'database_count') )
     
    
     else: # punt if the request doesn't have a species
@@ -573,32 +1092,184 @@ def species_range(request, format='csv'):
     if format == 'csv':
         # return CSV
         return CSVResponse(
-            [{
-                'species': species,
-                'bentity_id': b.bentity_id,
-                'bentity_name': b.bentity.bentity,
-                'status': b.category,
-                'num_records': b.num_records,
-                'literature_count': b.literature_count,
-                'museum_count': b.museum_count,
-                'database_count': b.database_count,
-                 
-            } for b in bentities],
-            fields=('species', 'bentity_id', 'bentity_name', 'status', 'num_records', 'literature_count', 'museum_count', 'database_count')  )
+            [(species,) + b for b in with_bentity_names(bentities, 0)],
+            fields=('species', 'bentity_id', 'bentity_name', 'status', 'num_records', 'literature_count', 'museum_count', 'database_count'),
+            columns=(0, 1, 2, 3, 4, 5, 6, 7)  )
     
     else:
         # serialize to JSON    
-        json_objects = [{'gid': b.bentity_id, 'category': b.category, 'num_records':b.num_records, 'literature_count':b.literature_count, 
-        'museum_count':b.museum_count, 'database_count':b.database_count} for b in bentities]
+        return JSONRowsResponse('bentities', bentities, RANGE_ENCODER)
+
+
+
+
+
+
+# most species in one species_batch request
+MAX_BATCH_SPECIES = 200
+
+# species_range and species_points JSON objects, from the values_list rows in species_batch
+BATCH_RANGE_ENCODER = ObjectEncoder(
+    ('gid', 'category', 'num_records', 'literature_count', 'museum_count', 'database_count'),
+    columns=(1, 2, 3, 4, 5, 6),
+    cached=('gid', 'category') )
+BATCH_POINT_ENCODER = ObjectEncoder(
+    ('gabi_acc_number', 'species', 'lat', 'lon', 'status', 'bentity_id', 'bentity_name',
+        'num_records', 'literature_count', 'museum_count', 'database_count'),
+    columns=(1, 0, 2, 3, 4, 5, 6, 7, 8, 9, 10),
+    cached=('species', 'status', 'bentity_id', 'bentity_name') )
+
+@etag(data_version_etag)
+def species_batch(request, format='json'):
+    """
+    Return the species_range and/or species_points data for several species
+    in one response, with one query per table for all of the species.
+
+    Species are given by repeating "species" and/or separating taxon codes
+    with commas (up to MAX_BATCH_SPECIES.)  "include" is "range", "points", or
+    "range,points" (the default.)
+
+    JSON: {"bentities": {taxon_code: [...], ...}, "records": {taxon_code: [...], ...}},
+    where the lists are the same objects as in the species_range "bentities"
+    and species_points "records" lists, with a (possibly empty) list for
+    every species.
+
+    CSV: the same rows as species_range or species_points for all of the
+    species, so "include" must be "range" or "points".
+
+    The response is streamed from server-side cursors, species by species,
+    with bentity names from the reference registry.
+    """
+
+    taxon_codes = []
+    for arg in request.GET.getlist('species'):
+        for code in arg.split(','):
+            if code and code not in taxon_codes:
+                taxon_codes.append(code)
+
+    include = [i for i in (request.GET.get('include') or 'range,points').split(',') if i]
+
+    if not taxon_codes:
+        return errorResponse("Please supply a 'species' argument.", format, {'bentities': {}, 'records': {}})
+
+    if len(taxon_codes) > MAX_BATCH_SPECIES:
+        return errorResponse("Please supply at most %d species." % MAX_BATCH_SPECIES, format, {'bentities': {}, 'records': {}})
+
+    if not include or not set(include) <= set(['range', 'points']):
+        return errorResponse("The 'include' argument must be 'range', 'points', or 'range,points'.", format, {'bentities': {}, 'records': {}})
+
+    if format == 'csv' and len(set(include)) != 1:
+        return errorResponse("For CSV, the 'include' argument must be 'range' or 'points'.", format)
+
+
+    ranges, points = batch_querysets(taxon_codes)
+
+    if format == 'csv':
+        if include[0] == 'range':
+            return StreamingCSVResponse(
+                with_bentity_names(server_side_rows(ranges), 1),
+                fields=('species', 'bentity_id', 'bentity_name', 'status', 'num_records', 'literature_count', 'museum_count', 'database_count'),
+                columns=(0, 1, 2, 3, 4, 5, 6, 7) )
+
+        else:
+            return StreamingCSVResponse(
+                with_bentity_names(server_side_rows(points), 5),
+                fields=('species', 'lat', 'lon', 'bentity_id', 'bentity_name', 'status', 'num_records', 'literature_count', 'museum_count', 'database_count'),
+                columns=(0, 2, 3, 5, 6, 4, 7, 8, 9, 10) )
+
+    else:
+        return StreamingGroupedJSONResponse(batch_json_sections(ranges, points, include), taxon_codes)
+
+
+
+
+def batch_querysets(taxon_codes):
+    """
+    Return the (ranges, points) values_list querysets for species_batch, for
+    the species in 'taxon_codes'.
+    """
+
+    # rows are ordered by species, to stream them grouped by species
+    ranges = ( SpeciesBentityPair.objects
+               .filter(valid_species_name__in=taxon_codes)
+               .order_by('valid_species_name', 'bentity')
+               .values_list('valid_species_name', 'bentity', 'category',
+                   'num_records', 'literature_count', 'museum_count', 'database_count') )
+
+    points = ( SpeciesPoints.objects
+               .filter(valid_species_name__in=taxon_codes)
+               .filter(lon__isnull=False)
+               .filter(lat__isnull=False)
+               .order_by('valid_species_name', 'gabi_acc_number')
+               .values_list('valid_species_name', 'gabi_acc_number', 'lat', 'lon', 'status',
+                   'bentity', 'num_records', 'literature_count', 'museum_count', 'database_count') )
+
+    return ranges, points
+
+
+
+
+def batch_json_sections(ranges, points, include):
+    """
+    Return the StreamingGroupedJSONResponse sections for species_batch JSON,
+    from the batch_querysets, for the tables in 'include' ('range' and/or
+    'points'.)
+    """
+
+    sections = []
+
+    if 'range' in include:
+        sections.append(('bentities', server_side_rows(ranges), BATCH_RANGE_ENCODER))
+
+    if 'points' in include:
+        sections.append(('records', with_bentity_names(server_side_rows(points), 5), BATCH_POINT_ENCODER))
+
+    return sections
+
+
+
+
+
+
+def bentity_counts(genus=None, subfamily=None, using=None):
+    """
+    Return the data for species_per_bentity: a list of (bentity_id, 
+    species_count, num_records, literature_count, museum_count, database_count)
+    for every bentity with native species in the genus or subfamily (or any 
+    species if neither is given.)  'using' is the database alias to read 
+    map_bentity_count from (by default, the router's choice.)
+    """
+    
+    if genus: # use genus name
+        return diversity_rollup.get().genus(genus.capitalize())
         
-        return JSONResponse({'bentities': json_objects})
+        
+    elif subfamily: # use subfamily name
+        return diversity_rollup.get().subfamily(subfamily.capitalize())
     
-   
+    else: # no filter supplied, return total species richness
+        with connections[using or router.db_for_read(SpeciesBentityPair)].cursor() as cursor:
+            cursor.execute("""
+                SELECT "bentity2_id", "species_count", 
+                    CAST("num_records" AS integer), 
+                    CAST("literature_count" AS integer), 
+                    CAST("museum_count" AS integer), 
+                    CAST("database_count" AS integer)
+                FROM "map_bentity_count";
+            """)
+            return cursor.fetchall()
         
         
         
         
+        
+        
+# species_per_bentity JSON objects, from the bentity_counts rows
+BENTITY_COUNT_ENCODER = ObjectEncoder(
+    ('gid', 'species_count', 'num_records', 'literature_count', 'museum_count', 'database_count'),
+    cached=('gid',) )
 
+@etag(data_version_etag)
 def species_per_bentity(request, format='csv'):
     """
     Return a JSON or CSV response with a list of bentities, the number of native
@@ -608,8 +1279,10 @@ def species_per_bentity(request, format='csv'):
     if present in the URL query string.  If both are presetnt, only "genus"
     will be used.
     
-    This view will query the "map_species_bentity_pair" view if "genus_name" or 
-    "subfamily_name" is supplied in the query string, and will query the 
+    If "genus_name" or "subfamily_name" is supplied in the query string, this 
+    view looks up the counts in the in-memory diversity rollup (see 
+    queries/indexes.py,) which is computed from the "map_species_bentity_pair" 
+    view in one pass for every genus and subfamily.  It will query the 
     "map_bentity_count" view if neither is supplied.
     
     Outputted JSON is a list with {gid:xxx, species_count:xxx, num_records:xxx, 
@@ -619,72 +1292,30 @@ def species_per_bentity(request, format='csv'):
     be an object for the bentity in the results.
     """
     
-    bentities = []
-    
-    genus = request.GET.get('genus')
-    subfamily = request.GET.get('subfamily')
-    
-    if genus: # use genus name
-        bentities = Bentity.objects.raw("""
-            SELECT "bentity2_id" AS "bentity2_id", count(distinct "valid_species_name") AS "species_count",
-            		sum("literature_count"::int) AS "literature_count", 
-            		sum("museum_count"::int) AS "museum_count",
-            		sum("database_count"::int) AS "database_count",
-            		sum("num_records"::int) AS "num_records"
-            FROM "map_species_bentity_pair"
-            WHERE "genus_name" = %s
-            AND "category" = 'N'
-            GROUP BY "bentity2_id"     
-            """, [genus.capitalize()]) 
-        
-        
-    elif subfamily: # use subfamily name
-        bentities = Bentity.objects.raw("""
-            SELECT "bentity2_id" AS "bentity2_id", count(distinct "valid_species_name") AS "species_count",
-            		sum("literature_count"::int) AS "literature_count", 
-            		sum("museum_count"::int) AS "museum_count",
-            		sum("database_count"::int) AS "database_count",
-            		sum("num_records"::int) AS "num_records"
-            FROM "map_species_bentity_pair"
-            WHERE "subfamily_name" = %s
-            AND "category" = 'N'
-            GROUP BY "bentity2_id"  
-            """, [subfamily.capitalize()]) 
-    
-    else: # no filter supplied, return total species richness
-        bentities = Bentity.objects.raw("""
-            SELECT "bentity2_id", "species_count", "literature_count"::int, "museum_count"::int, "database_count"::int, "num_records"::int 
-            FROM "map_bentity_count";
-        """)
-        
+    bentities = bentity_counts(request.GET.get('genus'), request.GET.get('subfamily'))
     
     
     
     if format == 'csv':
         return CSVResponse(
-            [{
-                'bentity_id': b.gid,
-                'bentity_name': b.bentity,
-                'species_count': b.species_count,
-                'num_records': b.num_records,
-                'literature_count': b.literature_count, 
-                'museum_count': b.museum_count,
-                'database_count': b.database_count
-            } for b in bentities],
-            fields=('bentity_id', 'bentity_name', 'species_count', 'num_records', 'literature_count', 'museum_count', 'database_count')   )
+            list(with_bentity_names(bentities, 0)),
+            fields=('bentity_id', 'bentity_name', 'species_count', 'num_records', 'literature_count', 'museum_count', 'database_count'),
+            columns=(0, 1, 2, 3, 4, 5, 6)   )
     
     
     else:  
         # serialize to JSON    
-        json_objects = [{'gid': b.gid, 'species_count': b.species_count, 'num_records':b.num_records,
-        'literature_count':b.literature_count, 'museum_count': b.museum_count,'database_count':b.database_count} for b in bentities]
-        return JSONResponse({'bentities': json_objects})
+        return JSONRowsResponse('bentities', bentities, BENTITY_COUNT_ENCODER)
     
     
     
     
     
     
+# species_in_common JSON objects, from the (gid, species_count) rows
+IN_COMMON_ENCODER = ObjectEncoder(('gid', 'species_count'), cached=('gid',))
+
+@etag(data_version_etag)
 def species_in_common(request, format='csv'):
     """
     Given a 'bentity' in the URL query string, return a CSV or JSON response with a list
@@ -698,22 +1329,16 @@ def species_in_common(request, format='csv'):
     
     If the bentity does not have any species matching the query, there will not
     be an object for the bentity in the results.
+    
+    The counts come from an in-memory species x bentity matrix of native species
+    (see queries/indexes.py) instead of self-joining map_species_bentity_pair.
     """
     
     query_bentity_id = request.GET.get('bentity_id')
     
     if query_bentity_id:
-        bentities = Bentity.objects.raw("""
-            SELECT r2."bentity2_id" AS "bentity2_id", 
-                count(distinct r2."valid_species_name") AS "species_count"
-            FROM "map_species_bentity_pair" AS r1
-            INNER JOIN "map_species_bentity_pair" AS r2
-            ON r1."valid_species_name" = r2."valid_species_name"
-            WHERE r1."bentity2_id" = %s
-            AND r1."category" = 'N'
-            AND r2."category" = 'N'
-            GROUP BY r2."bentity2_id";
-            """, [query_bentity_id])
+        matrix = native_species_matrix.get()
+        bentities = matrix.in_common(query_bentity_id)
     
     
     else:
@@ -724,21 +1349,61 @@ def species_in_common(request, format='csv'):
       
     if format == 'csv':
         return CSVResponse(
-            [{
-                'query_bentity_id': query_bentity_id,
-                'bentity_id': b.gid,
-                'bentity_name': b.bentity,
-                'species_in_common': b.species_count
-            } for b in bentities],
-            fields=('query_bentity_id', 'bentity_id', 'bentity_name', 'species_in_common')   )
+            [(query_bentity_id,) + b for b in with_bentity_names(bentities, 0)],
+            fields=('query_bentity_id', 'bentity_id', 'bentity_name', 'species_in_common'),
+            columns=(0, 1, 2, 3)   )
         
     else:  
         # serialize to JSON
-        json_objects = [{
-            'gid': b.gid, 
-            'species_count': b.species_count
-            } for b in bentities]
-        return JSONResponse({'bentities': json_objects})
+        return JSONRowsResponse('bentities', bentities, IN_COMMON_ENCODER)
+        
+        
         
         
         
+        
+@etag(data_version_etag)
+def tile(request, z, x, y, format='json'):
+    """
+    Return map tile z/x/y as JSON (see queries/tiles.py for the format.)
+    
+    If a "species" is given in the URL query string, the tile has a "points"
+    layer with the species' points (clustered for the zoom level,) and a 
+    "bentities" layer with the same fields as species_range. Otherwise, the 
+    tile has a "bentities" layer with the same fields as species_per_bentity,
+    filtered by "genus" or "subfamily" if given.  A tile's bentities are the
+    ones whose points' bounding box overlaps it, plus any without points (see
+    queries/tiles.py.)
+    
+    Tiles are generated the first time they're requested, then cached.
+    """
+    
+    z, x, y = int(z), int(x), int(y)
+    if z > MAX_TILE_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        return errorResponse("There's no tile %d/%d/%d." % (z, x, y), format)
+    
+    species = request.GET.get('species')
+    genus = request.GET.get('genus')
+    subfamily = request.GET.get('subfamily')
+    
+    if species:
+        layer_key = ('species', species)
+        
+        def render():
+            bentities = ( SpeciesBentityPair.objects
+                          .filter(valid_species_name=species.capitalize())
+                          .values_list('bentity', 'category', 'num_records', 'literature_count', 'museum_count', 'database_count') )
+            return render_tile(z, x, y, 
+                ('gid', 'category', 'num_records', 'literature_count', 'museum_count', 'database_count'), 
+                bentities, species_clusters(species, z))
+        
+    else:
+        layer_key = ('genus', genus) if genus else ('subfamily', subfamily) if subfamily else ('all',)
+        
+        def render():
+            bentities = bentity_counts(genus, subfamily)
+            return render_tile(z, x, y, 
+                ('gid', 'species_count', 'num_records', 'literature_count', 'museum_count', 'database_count'), 
+                bentities)
+    
+    return HttpResponse(get_tile(layer_key, z, x, y, render), content_type='application/json')